@@ -8,7 +8,7 @@ from keras.optimizers import adam, AdamAnneal
 # noinspection PyUnresolvedReferences
 from models import LangModel, Graph, optimizers, categorical_crossentropy, objective_fnc, slice_X, \
     np, theano, TableSampler, Split, containers, T, LookupProb, logger, Embedding, math, make_batches, \
-    PartialSoftmax, Dense, LogInfo, MAX_SETN_LEN, grouped_sentences, time, chunk_sentences, LangLSTMLayer
+    PartialSoftmax, Dense, LangLSTMLayer, token_batch_size, Trainer
 from layers import ActivationLayer
 
 
@@ -135,12 +135,14 @@ class NCELangModelV0(Graph, LangModel):
         if order == 0:
             ret = np.empty(shape=(self.nb_negative+1,) + X.shape, dtype=X.dtype)
             ret[0] = X
-            ret[1:] = self.sampler.sample(shape=ret[1:].shape)
+            sampler = self.sampler if self.noise_pool is None else self.noise_pool
+            sampler.sample_into(ret[1:])
         else:
             raise NotImplementedError('Only support order=0 now')
         return ret
 
-    def _loop_train(self, data, batch_size):
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, data.shape[-1], words_per_batch)
         nb = data.shape[1]
         nb_words = data[0].size
         loss = 0.0
@@ -156,73 +158,8 @@ class NCELangModelV0(Graph, LangModel):
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
               validation_interval=1800, log_file=None):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size, log_file)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            # loss, ce, nb_wrd = self._train(chunk, chunk)
-            x = self.negative_sample(chunk)
-            loss = self._loop_train(x, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.1f - speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, speed1, speed2))
-            log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                log_file.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size, log_file)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
-
-        log_file.close()
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file).run()
 
     def validation(self, val_sents, batch_size, log_file=None):
         """
@@ -6,7 +6,6 @@ from utils import get_unigram_probtable
 import optparse
 from keras.optimizers import adam, AdamAnneal
 import cPickle as pickle
-from time import time
 import math
 import numpy as np
 import theano
@@ -14,13 +13,13 @@ import theano.sparse as tsp
 import theano.tensor as T
 from layers import SharedWeightsDense, ActivationLayer
 from keras import optimizers
-from utils import chunk_sentences, categorical_crossentropy, objective_fnc, TableSampler
-from models import logger, LogInfo, floatX, Graph, LangModel, make_batches, slice_X, \
-    Identity, PartialSoftmaxV4, SparseEmbedding, LangLSTMLayer, Dense, LookupProb
+from utils import categorical_crossentropy, objective_fnc, TableSampler, token_batch_size
+from models import logger, floatX, Graph, LangModel, make_batches, slice_X, \
+    Identity, PartialSoftmaxV4, SparseEmbedding, LangLSTMLayer, Dense, LookupProb, Trainer
 # noinspection PyUnresolvedReferences
-from lm.utils.preprocess import import_wordmap, grouped_sentences
-
-MAX_SETN_LEN = 65  # actually 64
+from lm.utils.preprocess import import_wordmap
+# noinspection PyUnresolvedReferences
+from lm.utils.csr_gather import gather_rows, unique_rows
 
 
 class NCELangModelV4(Graph, LangModel):
@@ -57,13 +56,14 @@ class NCELangModelV4(Graph, LangModel):
         self.add_node(Identity(inputs={True: pos_codes, False: pos_codes}), name='codes_flat')
         self.add_node(Identity(inputs={True: shape, False: shape}), name='sents_shape')
         self.add_node(Identity(inputs={True: codes, False: codes}), name='sparse_codes')
+        self.add_input(name='code_poses', ndim=1, dtype='int32')
 
         self.add_node(SparseEmbedding(self.nb_base+1, embed_dims, weights=init_embeddings),
                       name='embedding', inputs=('codes_flat', 'sents_shape'))
         self.add_node(LangLSTMLayer(embed_dims, output_dim=context_dims), name='encoder', inputs='embedding')
         # seq.add(Dropout(0.5))
         self.add_node(PartialSoftmaxV4(input_dim=context_dims, base_size=self.nb_base+1),
-                      name='part_prob', inputs=('idxes', 'sparse_codes', 'encoder'))
+                      name='part_prob', inputs=('idxes', 'sparse_codes', 'code_poses', 'encoder'))
         self.add_node(Dense(input_dim=context_dims, output_dim=1, activation='exponential'),
                       name='normalizer', inputs='encoder')
         self.add_node(LookupProb(negprob_table), name='lookup_prob', inputs='idxes')
@@ -120,6 +120,7 @@ class NCELangModelV4(Graph, LangModel):
 
         input0 = self.inputs['idxes'].get_output(True)
         input1 = self.nodes['sparse_codes'].get_output(True)
+        input2 = self.inputs['code_poses'].get_output(True)
 
         true_labels = input0[0]
         encode_len, nb_words = self.encode_length(true_labels, pre_prob_tst)
@@ -131,10 +132,11 @@ class NCELangModelV4(Graph, LangModel):
         updates = self.optimizer.get_updates(self.params, self.constraints, train_loss)
         updates += self.updates
 
-        self._train = theano.function([input0, input1], outputs=train_loss,
+        self._train = theano.function([input0, input1, input2], outputs=train_loss,
                                       updates=updates)
-        self._test = theano.function([input0, input1],
+        self._test = theano.function([input0, input1, input2],
                                      outputs=[test_loss, encode_len, nb_words, sum_unrm, squre_urm])
+        self.compile_decode()
 
         self._train.out_labels = ('loss', )
         self._test.out_labels = ('loss', 'encode_len', 'nb_words', 'sum_unnorm', 'square_unrom')
@@ -169,82 +171,21 @@ class NCELangModelV4(Graph, LangModel):
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
               validation_interval=1800, log_file=None):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size, log_file)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            # loss, ce, nb_wrd = self._train(chunk, chunk)
-            x = self.negative_sample(chunk)
-            loss = self._loop_train(x, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.1f - speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, speed1, speed2))
-            log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                log_file.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size, log_file)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file).run()
 
     def negative_sample(self, X, order=0):
         if order == 0:
             ret = np.empty(shape=(self.nb_negative+1,) + X.shape, dtype=X.dtype)
             ret[0] = X
-            ret[1:] = self.sampler.sample(shape=ret[1:].shape)
+            sampler = self.sampler if self.noise_pool is None else self.noise_pool
+            sampler.sample_into(ret[1:])
         else:
             raise NotImplementedError('Only support order=0 now')
         return ret
 
-    def _loop_train(self, data, batch_size):
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, data.shape[-1], words_per_batch)
         nb = data.shape[1]
         nb_words = data[0].size
         loss = 0.0
@@ -255,6 +196,7 @@ class NCELangModelV4(Graph, LangModel):
             loss_ = self._train(*ins)
             loss += loss_ * ins0[0].size
 
+        self._decoded = False
         loss /= nb_words
         return loss
 
@@ -264,10 +206,11 @@ class NCELangModelV4(Graph, LangModel):
         :type data: numpy.ndarray
         :return:
         """
-        x = [None] * 2
+        x = [None] * 3
         x[0] = data
-        idx = x[0].ravel()
-        x[1] = self.sparse_coding[idx]
+        # the codes of the labels come first and as they are, the embedding reads them
+        rows, x[2] = unique_rows(x[0], x[0][0].size)
+        x[1] = gather_rows(self.sparse_coding, rows)
         return x
 
     def validation(self, val_sents, batch_size, log_file=None):
@@ -282,6 +225,7 @@ class NCELangModelV4(Graph, LangModel):
         unrm = 0.0
         sq_unrm = 0.0
 
+        self.decode_output_weights()
         for sents in val_sents:
             x = [self.negative_sample(sents)]
             loss_, code_len_, nb_words_, unrm_, sq_unrm_ = self._test_loop(self._test, x, batch_size)
@@ -304,6 +248,7 @@ class NCELangModelV4(Graph, LangModel):
         return loss, ppl, mean_unrm, std_unrm
 
     def _test_loop(self, f, ins, batch_size=128, verbose=0):
+        self.ensure_decoded()
         nb_sample = ins[0].shape[1]
         outs = [[] for _ in range(f.n_returned_outputs)]
         batch_info = []
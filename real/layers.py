@@ -12,6 +12,59 @@ import theano.sparse as tsp
 import numpy as np
 from keras.utils.theano_utils import shared_zeros
 from utils import floatX as float_t, epsilon
+from ops import gather_dot_exp, csr_dot, blocked_label_log_softmax
+
+
+def noise_idxes(idxes):
+    """
+    :param idxes: labels followed by the noise words shared by all of them, (k+1, ...), i.e.
+    idxes[i] is filled with a single word for i > 0
+    :return: the k noise words, (k, )
+    """
+    return T.flatten(idxes[1:], 2)[:, 0]
+
+
+def code_positions(idxes, poses):
+    """
+    :param poses: for each of idxes.flatten(), the row of the sparse codes holding its code,
+    see lm.utils.csr_gather.unique_rows
+    :return: poses in the shape of idxes
+    """
+    return T.reshape(poses, idxes.shape, ndim=idxes.ndim)
+
+
+def shared_noise_rows(idxes, sparse_codings, poses, W):
+    """
+    :param idxes: labels followed by the shared noise words, (k+1, ...)
+    :param sparse_codings: sparse codes of the rows, each decoded once
+    :param poses: rows of sparse_codings holding the codes of the labels followed by those
+    of the k noise words
+    :param W: (B+1, d)
+    :return: W decoded for the labels, (..., d), and for the noise words, (k, d)
+    """
+    labels = idxes[0]
+    nb_labels = labels.size
+    rows = csr_dot(sparse_codings, W)
+    label_rows = T.reshape(rows[poses[:nb_labels]], T.concatenate([labels.shape, [-1]]), ndim=labels.ndim+1)
+    return label_rows, rows[poses[nb_labels:]]
+
+
+def shared_noise_output(features, label_weights, label_bias, noise_weights, noise_bias):
+    """
+    Output of the partial softmax layers when all the labels share the same k noise words.
+    The scores of the noise words are then a single dense product of the features and the
+    k noise weights, instead of a gather of (k, ..., d) weights.
+    :param features: (..., d)
+    :param label_weights: (..., d)
+    :param label_bias: (...)
+    :param noise_weights: (k, d)
+    :param noise_bias: (k, )
+    :return: exponentiated scores of the labels followed by those of the noise words, (k+1, ...)
+    """
+    label_scores = T.sum(label_weights * features, axis=-1) + label_bias
+    noise_scores = T.dot(features, noise_weights.T) + noise_bias                      # (..., k)
+    noise_scores = noise_scores.dimshuffle([features.ndim-1] + range(features.ndim-1))  # (k, ...)
+    return T.exp(T.concatenate([T.shape_padleft(label_scores), noise_scores], axis=0))
 
 
 class LangLSTMLayer(Recurrent):
@@ -641,11 +694,12 @@ class Split(LayerList):
 class PartialSoftmax(Dense, MultiInputLayer):
     def __init__(self, input_dim, output_dim, init='glorot_uniform', weights=None, name=None,
                  W_regularizer=None, b_regularizer=None, activity_regularizer=None,
-                 W_constraint=None, b_constraint=None):
+                 W_constraint=None, b_constraint=None, shared_noise=False):
         MultiInputLayer.__init__(self, slot_names=['idxes', 'features'])
         Dense.__init__(self, input_dim, output_dim, init=init, weights=weights, name=name, W_regularizer=W_regularizer,
                        b_regularizer=b_regularizer, activity_regularizer=activity_regularizer,
                        W_constraint=W_constraint, b_constraint=b_constraint)
+        self.shared_noise = shared_noise
 
         self.__input_slots = None
 
@@ -661,22 +715,25 @@ class PartialSoftmax(Dense, MultiInputLayer):
         ins = self.get_input(train)
         idxes = ins['idxes']
         features = ins['features']
-        weights = self.W.T.take(idxes, axis=0)
-        bias = self.b.T.take(idxes, axis=0)
-        return T.exp(T.sum(weights * features, axis=-1) + bias)
+        if self.shared_noise:
+            noise = noise_idxes(idxes)
+            return shared_noise_output(features, self.W.T.take(idxes[0], axis=0), self.b.take(idxes[0], axis=0),
+                                       self.W.T.take(noise, axis=0), self.b.take(noise, axis=0))
+        return gather_dot_exp(self.W.T, self.b, idxes, features)
 
 
 class PartialSoftmaxV4(Dense, MultiInputLayer):
     def __init__(self, input_dim, base_size, init='glorot_uniform', weights=None, name=None,
                  W_regularizer=None, b_regularizer=None, activity_regularizer=None,
-                 W_constraint=None, b_constraint=None):
-        MultiInputLayer.__init__(self, slot_names=['idxes', 'sparse_codings', 'features'])
+                 W_constraint=None, b_constraint=None, shared_noise=False):
+        MultiInputLayer.__init__(self, slot_names=['idxes', 'sparse_codings', 'poses', 'features'])
         Dense.__init__(self, base_size, input_dim, init=init, weights=weights, name=name, W_regularizer=W_regularizer,
                        b_regularizer=b_regularizer, activity_regularizer=activity_regularizer,
                        W_constraint=W_constraint, b_constraint=b_constraint)
         self.params.remove(self.b)
         self.b = shared_zeros((base_size, 1), dtype=float_t)
         self.params.append(self.b)
+        self.shared_noise = shared_noise
 
         self.__input_slots = None
 
@@ -692,27 +749,30 @@ class PartialSoftmaxV4(Dense, MultiInputLayer):
         ins = self.get_input(train)
         idxes = ins['idxes']
         sparse_codings = ins['sparse_codings']  # (M, B+1)
+        poses = ins['poses']
         features = ins['features']   # (ns, nt, dl)
-        detectors_flat = tsp.structured_dot(sparse_codings, self.W)   # (M, dl)
-        bias_flat = tsp.structured_dot(sparse_codings, self.b)
-        bias = T.reshape(bias_flat, idxes.shape, ndim=idxes.ndim)
-        detec_shape = T.concatenate([idxes.shape, [-1]])
-        detectors = T.reshape(detectors_flat, detec_shape, ndim=idxes.ndim+1)   # (ns, nt, dl)
-        return T.exp(T.sum(detectors * features, axis=-1) + bias)
-        # return T.exp(T.sum(detectors * features, axis=-1))
+        if self.shared_noise:
+            weights, noise_weights = shared_noise_rows(idxes, sparse_codings, poses, self.W)
+            bias, noise_bias = shared_noise_rows(idxes, sparse_codings, poses, self.b)
+            return shared_noise_output(features, weights, T.flatten(bias, idxes.ndim-1),
+                                       noise_weights, T.flatten(noise_bias, 1))
+        detectors_flat = csr_dot(sparse_codings, self.W)   # (M, dl)
+        bias_flat = csr_dot(sparse_codings, self.b)
+        return gather_dot_exp(detectors_flat, bias_flat, code_positions(idxes, poses), features)
 
 
 class PartialSoftmaxV7(Dense, MultiInputLayer):
     def __init__(self, input_dim, base_size, vocab_size, init='glorot_uniform', weights=None, name=None,
                  W_regularizer=None, b_regularizer=None, activity_regularizer=None,
-                 W_constraint=None, b_constraint=None):
-        MultiInputLayer.__init__(self, slot_names=['idxes', 'sparse_codings', 'features'])
+                 W_constraint=None, b_constraint=None, shared_noise=False):
+        MultiInputLayer.__init__(self, slot_names=['idxes', 'sparse_codings', 'poses', 'features'])
         Dense.__init__(self, base_size, input_dim, init=init, weights=weights, name=name, W_regularizer=W_regularizer,
                        b_regularizer=b_regularizer, activity_regularizer=activity_regularizer,
                        W_constraint=W_constraint, b_constraint=b_constraint)
         self.params.remove(self.b)
         self.b = shared_zeros((vocab_size, ), dtype=float_t)
         self.params.append(self.b)
+        self.shared_noise = shared_noise
 
         self.__input_slots = None
 
@@ -728,20 +788,23 @@ class PartialSoftmaxV7(Dense, MultiInputLayer):
         ins = self.get_input(train)
         idxes = ins['idxes']
         sparse_codings = ins['sparse_codings']  # (M, B+1)
+        poses = ins['poses']
         features = ins['features']   # (ns, nt, dl)
-        detectors_flat = tsp.structured_dot(sparse_codings, self.W)   # (M, dl)
-        bias = self.b[idxes]
-        detec_shape = T.concatenate([idxes.shape, [-1]])
-        detectors = T.reshape(detectors_flat, detec_shape, ndim=idxes.ndim+1)   # (ns, nt, dl)
-        return T.exp(T.sum(detectors * features, axis=-1) + bias)
-        # return T.exp(T.sum(detectors * features, axis=-1))
+        if self.shared_noise:
+            weights, noise_weights = shared_noise_rows(idxes, sparse_codings, poses, self.W)
+            return shared_noise_output(features, weights, self.b[idxes[0]], noise_weights, self.b[noise_idxes(idxes)])
+        detectors_flat = csr_dot(sparse_codings, self.W)   # (M, dl)
+        # the bias goes by word, not by row of the codes
+        scores = gather_dot_exp(detectors_flat, T.zeros_like(detectors_flat[:, 0]), code_positions(idxes, poses),
+                                features)
+        return scores * T.exp(self.b[idxes])
 
 
 class PartialSoftmaxV8(Dense, MultiInputLayer):
     def __init__(self, input_dim, base_size, init='glorot_uniform', weights=None, name=None,
                  W_regularizer=None, b_regularizer=None, activity_regularizer=None,
-                 W_constraint=None, b_constraint=None):
-        MultiInputLayer.__init__(self, slot_names=['idxes', 'sparse_codings', 'features'])
+                 W_constraint=None, b_constraint=None, shared_noise=False):
+        MultiInputLayer.__init__(self, slot_names=['idxes', 'sparse_codings', 'poses', 'features'])
         Dense.__init__(self, base_size, input_dim, init=init, weights=weights, name=name, W_regularizer=W_regularizer,
                        b_regularizer=b_regularizer, activity_regularizer=activity_regularizer,
                        W_constraint=W_constraint, b_constraint=b_constraint)
@@ -749,6 +812,7 @@ class PartialSoftmaxV8(Dense, MultiInputLayer):
         self.b = shared_zeros((base_size+1, ), dtype=float_t)
         self.params.append(self.b)
         self.base_size = base_size
+        self.shared_noise = shared_noise
 
         self.__input_slots = None
 
@@ -764,52 +828,98 @@ class PartialSoftmaxV8(Dense, MultiInputLayer):
         ins = self.get_input(train)
         idxes = ins['idxes']
         sparse_codings = ins['sparse_codings']                        # (M, B+1)
+        poses = ins['poses']
         features = ins['features']                                    # (ns, nt, dl)
-        detectors_flat = tsp.structured_dot(sparse_codings, self.W)   # (M, dl)
-        detec_shape = T.concatenate([idxes.shape, [-1]])
-        detectors = T.reshape(detectors_flat, detec_shape, ndim=idxes.ndim+1)   # (ns, nt, dl)
+        if self.shared_noise:
+            weights, noise_weights = shared_noise_rows(idxes, sparse_codings, poses, self.W)
+            bias_idxes = T.minimum(idxes, self.base_size)
+            return shared_noise_output(features, weights, self.b[bias_idxes[0]],
+                                       noise_weights, self.b[noise_idxes(bias_idxes)])
+        detectors_flat = csr_dot(sparse_codings, self.W)   # (M, dl)
         exceed_idxes = (idxes > self.base_size).nonzero()
         bias_idxes = T.set_subtensor(idxes[exceed_idxes], self.base_size)
-        bias = self.b[bias_idxes]
-        return T.exp(T.sum(detectors * features, axis=-1) + bias)
+        # the bias goes by word, not by row of the codes
+        scores = gather_dot_exp(detectors_flat, T.zeros_like(detectors_flat[:, 0]), code_positions(idxes, poses),
+                                features)
+        return scores * T.exp(self.b[bias_idxes])
 
 
-class SharedWeightsDense(Layer):
+class DecodedOutputWeights(object):
+    """
+    The full softmax over the vocabulary of the layers whose weights are decoded from sparse
+    codes. The parameters do not change during a validation, so the test output reads the
+    weights decoded once into W_full (dl, V) and b_full (V, ) by decode_updates, instead of
+    decoding them again for each batch. They hold the weights of the last decode, see
+    LangModel.compile_decode; the training output decodes them on the fly.
+    """
+    W_full = None
+    b_full = None
+    # number of words of the vocabulary scored at a time by label_log_prob
+    block_size = 8192
+
+    def init_decoded(self, sparse_codes, W):
+        self.sparse_codes = tsp.as_sparse_variable(sparse_codes)
+        self.W_full = theano.shared(np.zeros((W.get_value(borrow=True).shape[1], sparse_codes.shape[0]),
+                                             dtype=float_t), name='W_full', borrow=True)
+        self.b_full = theano.shared(np.zeros((sparse_codes.shape[0],), dtype=float_t), name='b_full', borrow=True)
+
+    def decode(self):
+        """
+        :return: W (dl, V) and b (V, ) decoded from the parameters
+        """
+        raise NotImplementedError
+
+    def decode_updates(self):
+        W, b = self.decode()
+        return [(self.W_full, W.astype(self.W_full.dtype)), (self.b_full, b.astype(self.b_full.dtype))]
+
+    def get_output(self, train=False):
+        ins = self.get_input(train)
+        W, b = self.decode() if train else (self.W_full, self.b_full)
+        return self.activation(T.dot(ins, W) + b)
+
+    def label_log_prob(self, labels, train=False):
+        """
+        The log of the softmax output at the labels only, see blocked_label_log_softmax.
+        :param labels: word indexes, the shape of the input without its last axis
+        :return: log probabilities, the shape of labels
+        """
+        assert self.activation is activations.softmax, 'label_log_prob needs the softmax activation'
+        W, b = self.decode() if train else (self.W_full, self.b_full)
+        return blocked_label_log_softmax(self.get_input(train), W, b, labels, self.block_size)
+
+
+class SharedWeightsDense(DecodedOutputWeights, Layer):
     def __init__(self, W, b, sparse_codes, activation='linear'):
         super(SharedWeightsDense, self).__init__()
         self.params = []
         self.W = W
         self.b = b
         self.__input_slots = None
-        self.sparse_codes = tsp.as_sparse_variable(sparse_codes)
+        self.init_decoded(sparse_codes, W)
         self.activation = activations.get(activation)
 
-    def get_output(self, train=False):
-        ins = self.get_input(train)
-        W = tsp.structured_dot(self.sparse_codes, self.W).T
-        b = tsp.structured_dot(self.sparse_codes, self.b).T
-        b = T.addbroadcast(b, 0)
-        return self.activation(T.dot(ins, W) + b)
+    def decode(self):
+        W = csr_dot(self.sparse_codes, self.W).T
+        b = T.flatten(csr_dot(self.sparse_codes, self.b), 1)
+        return W, b
 
 
-class SharedWeightsDenseV7(Layer):
+class SharedWeightsDenseV7(DecodedOutputWeights, Layer):
     def __init__(self, W, b, sparse_codes, activation='linear'):
         super(SharedWeightsDenseV7, self).__init__()
         self.params = []
         self.W = W
         self.b = b
         self.__input_slots = None
-        self.sparse_codes = tsp.as_sparse_variable(sparse_codes)
+        self.init_decoded(sparse_codes, W)
         self.activation = activations.get(activation)
 
-    def get_output(self, train=False):
-        ins = self.get_input(train)
-        W = tsp.structured_dot(self.sparse_codes, self.W).T
-        b = self.b
-        return self.activation(T.dot(ins, W) + b)
+    def decode(self):
+        return csr_dot(self.sparse_codes, self.W).T, self.b
 
 
-class SharedWeightsDenseV8(Layer):
+class SharedWeightsDenseV8(DecodedOutputWeights, Layer):
     def __init__(self, W, b, sparse_codes, activation='linear'):
         super(SharedWeightsDenseV8, self).__init__()
         self.params = []
@@ -820,13 +930,11 @@ class SharedWeightsDenseV8(Layer):
         tmp_b[:b_value.shape[0]] = b_value
         self.b = theano.shared(tmp_b, borrow=True)
         self.__input_slots = None
-        self.sparse_codes = tsp.as_sparse_variable(sparse_codes)
+        self.init_decoded(sparse_codes, W)
         self.activation = activations.get(activation)
 
-    def get_output(self, train=False):
-        ins = self.get_input(train)
-        W = tsp.structured_dot(self.sparse_codes, self.W).T
-        return self.activation(T.dot(ins, W) + self.b)
+    def decode(self):
+        return csr_dot(self.sparse_codes, self.W).T, self.b
 
 
 class LookupProb(Layer):
@@ -842,11 +950,12 @@ class LookupProb(Layer):
 class PartialSoftmaxV1(Dense, MultiInputLayer):
     def __init__(self, input_dim, output_dim, init='glorot_uniform', weights=None, name=None,
                  W_regularizer=None, b_regularizer=None, activity_regularizer=None,
-                 W_constraint=None, b_constraint=None):
+                 W_constraint=None, b_constraint=None, shared_noise=False):
         MultiInputLayer.__init__(self, slot_names=['unique_idxes', 'poses', 'features'])
         Dense.__init__(self, input_dim, output_dim, init=init, weights=weights, name=name, W_regularizer=W_regularizer,
                        b_regularizer=b_regularizer, activity_regularizer=activity_regularizer,
                        W_constraint=W_constraint, b_constraint=b_constraint)
+        self.shared_noise = shared_noise
 
     def get_input(self, train=False):
         return dict((name, layer.get_output(train)) for name, layer in zip(self.input_layer_names, self.input_layers))
@@ -858,9 +967,10 @@ class PartialSoftmaxV1(Dense, MultiInputLayer):
         features = ins['features']
         weights_ = self.W.T.take(idxes, axis=0)
         bias_ = self.b.T.take(idxes, axis=0)
-        weights = weights_[poses]
-        bias = bias_[poses]
-        return T.exp(T.sum(weights * features, axis=-1) + bias)
+        if self.shared_noise:
+            noise = noise_idxes(poses)
+            return shared_noise_output(features, weights_[poses[0]], bias_[poses[0]], weights_[noise], bias_[noise])
+        return gather_dot_exp(weights_, bias_, poses, features)
 
 
 class TreeLogSoftmax(Embedding, MultiInputLayer):
@@ -970,8 +1080,8 @@ class SparseEmbedding(MultiInputLayer):
             tst_codes = test_in['codes']
             tst_shape = T.concatenate([test_in['shape'], np.array([-1], dtype=test_in['shape'].dtype)])
 
-            trn_features = tsp.structured_dot(trn_codes, self.W)
-            tst_features = tsp.structured_dot(tst_codes, self.W)
+            trn_features = csr_dot(trn_codes, self.W)
+            tst_features = csr_dot(tst_codes, self.W)
 
             self.__output_slots = {True: T.reshape(trn_features, trn_shape, ndim=trn_features.ndim+1),
                                    False: T.reshape(tst_features, tst_shape, ndim=tst_features.ndim+1)}
@@ -1074,18 +1184,9 @@ class SparseEmbeddingV6(MultiInputLayer):
             tst_codes = test_in['codes']
             tst_shape = T.concatenate([test_in['shape'], np.array([4, -1], dtype=test_in['shape'].dtype)])
 
-            trn_features0 = tsp.structured_dot(trn_codes, self.W[0])
-            trn_features1 = tsp.structured_dot(trn_codes, self.W[1])
-            trn_features2 = tsp.structured_dot(trn_codes, self.W[2])
-            trn_features3 = tsp.structured_dot(trn_codes, self.W[3])
-
-            tst_features0 = tsp.structured_dot(tst_codes, self.W[0])
-            tst_features1 = tsp.structured_dot(tst_codes, self.W[1])
-            tst_features2 = tsp.structured_dot(tst_codes, self.W[2])
-            tst_features3 = tsp.structured_dot(tst_codes, self.W[3])
-
-            trn_features = T.stack([trn_features0, trn_features1, trn_features2, trn_features3], axis=1)
-            tst_features = T.stack([tst_features0, tst_features1, tst_features2, tst_features3], axis=1)
+            # the four matrices in one pass over the codes, (M, 4, output_dim)
+            trn_features = csr_dot(trn_codes, self.W)
+            tst_features = csr_dot(tst_codes, self.W)
 
             self.__output_slots = {True: T.reshape(trn_features, trn_shape, ndim=trn_features.ndim+1),
                                    False: T.reshape(tst_features, tst_shape, ndim=tst_features.ndim+1)}
@@ -1165,11 +1266,12 @@ class LBLScoreV1(MultiInputLayer):
 class PartialSoftmaxLBL(MultiInputLayer):
     """ this layer is designed specifically for LBL language model
     """
-    def __init__(self, base_size, word_vecs, b_regularizer=None):
-        MultiInputLayer.__init__(self, slot_names=['idxes', 'sparse_codings', 'features'])
+    def __init__(self, base_size, word_vecs, b_regularizer=None, shared_noise=False):
+        MultiInputLayer.__init__(self, slot_names=['idxes', 'sparse_codings', 'poses', 'features'])
         self.b = shared_zeros((base_size, 1), dtype=float_t)
         self.params = [self.b]
         self.W = word_vecs[:base_size]
+        self.shared_noise = shared_noise
         self.regularizers = []
         if b_regularizer is not None:
             self.b_regularizer = regularizers.get(b_regularizer)
@@ -1188,14 +1290,16 @@ class PartialSoftmaxLBL(MultiInputLayer):
     def get_output(self, train=False):
         ins = self.get_input(train)
         idxes = ins['idxes']                                                    # (k+1, ns)
-        sparse_codings = ins['sparse_codings']                                  # (M, B+1), where M = ns*(k+1)
+        sparse_codings = ins['sparse_codings']                                  # (M, B+1), M unique rows
+        poses = ins['poses']                                                    # (ns*(k+1), )
         features = ins['features']                                              # (ns, dc)
-        detectors_flat = tsp.structured_dot(sparse_codings, self.W)             # (M, dc)
-        bias_flat = tsp.structured_dot(sparse_codings, self.b)                  # (M, 1)
-        bias = T.reshape(bias_flat, idxes.shape, ndim=idxes.ndim)               # (k+1, ns)
-        detec_shape = T.concatenate([idxes.shape, [-1]])                        # = (k+1, ns, -1)
-        detectors = T.reshape(detectors_flat, detec_shape, ndim=idxes.ndim+1)   # (k+1, ns, dc)
-        return T.exp(T.sum(detectors * features, axis=-1) + bias)               # (k+1, ns)
+        if self.shared_noise:
+            weights, noise_weights = shared_noise_rows(idxes, sparse_codings, poses, self.W)
+            bias, noise_bias = shared_noise_rows(idxes, sparse_codings, poses, self.b)
+            return shared_noise_output(features, weights, T.flatten(bias, 1), noise_weights, T.flatten(noise_bias, 1))
+        detectors_flat = csr_dot(sparse_codings, self.W)                        # (M, dc)
+        bias_flat = csr_dot(sparse_codings, self.b)                             # (M, 1)
+        return gather_dot_exp(detectors_flat, bias_flat, code_positions(idxes, poses), features)  # (k+1, ns)
 
 
 class PartialSoftmaxLBLV4(Dense, MultiInputLayer):
@@ -1249,9 +1353,7 @@ class PartialSoftmaxLBLV4(Dense, MultiInputLayer):
         ins = self.get_input(train)
         idxes = ins['idxes']                                     # (k+1, ns)
         features = ins['features']                               # (ns, dc)
-        weights = self.W.take(idxes, axis=0)                     # (k+1, ns, dc)
-        bias = self.b.take(idxes, axis=0)                        # (k+1, ns)
-        return T.exp(T.sum(weights * features, axis=-1) + bias)  # (k+1, ns)
+        return gather_dot_exp(self.W, self.b, idxes, features)   # (k+1, ns)
 
 
 class SharedWeightsDenseLBLV4(Layer):
@@ -1271,11 +1373,12 @@ class SharedWeightsDenseLBLV4(Layer):
 class PartialSoftmaxFFNN(Dense, MultiInputLayer):
     def __init__(self, input_dim, base_size, init='glorot_uniform', weights=None, name=None,
                  W_regularizer=None, b_regularizer=None, activity_regularizer=None,
-                 W_constraint=None, b_constraint=None):
-        MultiInputLayer.__init__(self, slot_names=['idxes', 'sparse_codings', 'features'])
+                 W_constraint=None, b_constraint=None, shared_noise=False):
+        MultiInputLayer.__init__(self, slot_names=['idxes', 'sparse_codings', 'poses', 'features'])
         self.init = initializations.get(init)
         self.input_dim = input_dim
         self.base_size = base_size
+        self.shared_noise = shared_noise
 
         self.input = T.matrix()
         self.W = self.init((base_size, input_dim))            # (B+1, dc)
@@ -1323,10 +1426,12 @@ class PartialSoftmaxFFNN(Dense, MultiInputLayer):
         ins = self.get_input(train)
         idxes = ins['idxes']                                                    # (k+1, ns)
         features = ins['features']                                              # (ns, dc)
-        sp_coding = ins['sparse_codings']                                       # (M, B+1)
-        detectors_flat = tsp.structured_dot(sp_coding, self.W)                  # (M, dc)
-        bias_flat = tsp.structured_dot(sp_coding, self.b)                       # (M, 1)
-        bias = T.reshape(bias_flat, idxes.shape, ndim=idxes.ndim)               # (k+1, ns)
-        detec_shape = T.concatenate([idxes.shape, [-1]])                        # = (k+1, ns, -1)
-        detectors = T.reshape(detectors_flat, detec_shape, ndim=idxes.ndim+1)   # (k+1, ns, dc)
-        return T.exp(T.sum(detectors * features, axis=-1) + bias)               # (k+1, ns)
\ No newline at end of file
+        sp_coding = ins['sparse_codings']                                       # (M, B+1), M unique rows
+        poses = ins['poses']                                                    # (ns*(k+1), )
+        if self.shared_noise:
+            weights, noise_weights = shared_noise_rows(idxes, sp_coding, poses, self.W)
+            bias, noise_bias = shared_noise_rows(idxes, sp_coding, poses, self.b)
+            return shared_noise_output(features, weights, T.flatten(bias, 1), noise_weights, T.flatten(noise_bias, 1))
+        detectors_flat = csr_dot(sp_coding, self.W)                             # (M, dc)
+        bias_flat = csr_dot(sp_coding, self.b)                                  # (M, 1)
+        return gather_dot_exp(detectors_flat, bias_flat, code_positions(idxes, poses), features)  # (k+1, ns)
\ No newline at end of file
@@ -5,7 +5,6 @@ import theano
 import re
 import os
 import math
-from time import time, sleep
 from theano import tensor as T
 from keras.models import Sequential, Graph, make_batches
 from keras import optimizers
@@ -21,19 +20,32 @@ from layers import LangLSTMLayer, PartialSoftmax, Split, LookupProb, PartialSoft
     TreeLogSoftmax, SparseEmbedding, Identity, PartialSoftmaxV4, SharedWeightsDense, \
     LangLSTMLayerV5, LangLSTMLayerV6, SparseEmbeddingV6, EmbeddingParam, LBLScoreV1, \
     PartialSoftmaxLBL, PartialSoftmaxLBLV4, SharedWeightsDenseLBLV4, PartialSoftmaxFFNN, \
-    PartialSoftmaxV7, SharedWeightsDenseV7, PartialSoftmaxV8, SharedWeightsDenseV8
+    PartialSoftmaxV7, SharedWeightsDenseV7, PartialSoftmaxV8, SharedWeightsDenseV8, DecodedOutputWeights
 from utils import LangHistory, LangModelLogger, categorical_crossentropy, objective_fnc, \
-    TableSampler, slice_X, chunk_sentences, epsilon
+    TableSampler, slice_X, chunk_sentences, SentenceBuckets, token_batch_size, epsilon
 # noinspection PyUnresolvedReferences
 from lm.utils.preprocess import import_wordmap, grouped_sentences
+# noinspection PyUnresolvedReferences
+from lm.utils.noise_pool import NoisePool
+# noinspection PyUnresolvedReferences
+from lm.utils.philox import parallel_sample_into
+# noinspection PyUnresolvedReferences
+from lm.utils.batch_ring import BatchRing
+# noinspection PyUnresolvedReferences
+from lm.utils.ngram import cntx_label_into
+# noinspection PyUnresolvedReferences
+from lm.utils.csr_gather import gather_rows, unique_rows
+from trainer import Trainer, WorkerPoolTrainer
 import theano.sparse as tsp
 import cPickle as pickle
 from scipy.sparse import hstack as sp_hstack, vstack as sp_vstack, csr_matrix
 # from profilehooks import profile
 import scipy.sparse as sparse
 from multiprocessing import Queue, Process, Array, Event as MEvent
+from Queue import Empty
+from multiprocessing.pool import ThreadPool
+from itertools import count
 from threading import Thread, Event
-from scipy import stats
 import ctypes
 import numba
 import os
@@ -43,30 +55,399 @@ logger = logging.getLogger('lm.real.models')
 MAX_SETN_LEN = 65  # actually 64
 
 
-class LogInfo(object):
-    def __init__(self, file_name=None):
-        super(LogInfo, self).__init__()
-        if file_name is not None:
-            self.logger = file(file_name, 'w')
+class LangModel(object):
+    # batches hold about this many words instead of batch_size sentences if not None, see token_batch_size
+    words_per_batch = None
+    # negative samples are taken from this NoisePool instead of being drawn on the fly if not None
+    noise_pool = None
+    # all the labels of a batch share the same negative samples if True
+    shared_negative = False
+    # the negative samples are drawn from the counter based RNG with this seed if not None, see seed_noise
+    noise_seed = None
+    nb_sample_threads = 1
+    sample_pool = None
+    _chunk_ids = None
+    _val_chunk_ids = None
+    # the data workers hand the batches over through this BatchRing if not None, see make_batch_ring
+    batch_ring = None
+    # the validation of the models trained with data workers, see start_validation_worker
+    val_jobs_pools = None
+    val_jobs_pools_post = None
+    _val_requests = None
+    _val_results = None
+    _val_pending = False
+    _snapshot_buffers = None
+    _param_snapshots = None
+    # decodes the output weights of the full softmax, see compile_decode
+    _decode = None
+    # whether the decoded weights are those of the current parameters, the training clears it
+    _decoded = False
+
+    def __init__(self):
+        super(LangModel, self).__init__()
+
+    def start_noise_pool(self, nb_slots=8, slot_size=2**20, max_reuse=0):
+        """
+        Take the negative samples from a NoisePool filled by a background process. Call it
+        before train. See lm.utils.noise_pool.NoisePool for the parameters.
+        """
+        # noinspection PyUnresolvedReferences
+        self.noise_pool = NoisePool(self.neg_prob_table, nb_slots, slot_size, max_reuse)
+        self.noise_pool.start()
+
+    def seed_noise(self, seed, nb_threads=1):
+        """
+        Draw the negative samples from the counter based RNG keyed by (seed, batch id, stream),
+        see lm.utils.philox. Runs are then reproducible whatever the number of data workers,
+        and the draws of a batch are split across nb_threads threads. Call it before train.
+        """
+        self.noise_seed = seed
+        self.nb_sample_threads = nb_threads
+        self.sample_pool = ThreadPool(nb_threads) if nb_threads > 1 else None
+        self._chunk_ids = None
+
+    def next_chunk_id(self, validation=False):
+        """
+        :return: id of the next chunk of sentences, taken when the chunk is read (Trainer.chunks)
+        and sent to the data workers or given to encode_chunk, which is used as batch id for
+        the counter based RNG. Validation chunks are counted apart from 2**31 on, so the
+        training chunks get the same ids whenever the validations happen.
+        """
+        if self._chunk_ids is None:
+            self._chunk_ids = count()
+            self._val_chunk_ids = count(2**31)
+        return next(self._val_chunk_ids if validation else self._chunk_ids)
+
+    def sample_noise(self, ret, batch=None):
+        """
+        Fill ret[1:] with negative samples, ret[0] holds the labels. With shared_negative,
+        ret[i] is filled with a single noise word for i > 0, i.e. all the labels share the
+        same k noise words.
+        :param batch: batch id for the counter based RNG, the chunk id of the training data.
+        The draws without one, i.e. those of the validation, take the next validation chunk
+        id, see next_chunk_id.
+        :return: ret
+        """
+        sampler = self.sampler if self.noise_pool is None else self.noise_pool
+        if batch is None:
+            batch = self.next_chunk_id(validation=True)
+        if self.shared_negative:
+            noise = draw_noise(sampler, np.empty((ret.shape[0]-1,), dtype=ret.dtype), self.noise_seed, batch)
+            ret[1:] = noise.reshape((-1,) + (1,) * (ret.ndim-1))
         else:
-            self.logger = None
+            draw_noise(sampler, ret[1:], self.noise_seed, batch, 0, self.sample_pool, self.nb_sample_threads)
+        return ret
+
+    def label_code_rows(self, labels):
+        """
+        :param labels: labels followed by their negative samples, (k+1, ...)
+        :return: words whose sparse codes the partial softmax layer needs: all of them, or with
+        shared_negative, the labels followed by the k shared noise words.
+        """
+        if not self.shared_negative:
+            return labels.ravel()
+        return np.concatenate([labels[0].ravel(), labels[1:].reshape((labels.shape[0]-1, -1))[:, 0]])
+
+    def encode_chunk(self, chunk, batch_size, words_per_batch=None, chunk_id=None):
+        """
+        :param chunk: sentences of the same length, (ns, nt)
+        :param chunk_id: id given to chunk when it was read, see Trainer.chunks and next_chunk_id
+        :return: the inputs of _loop_train for chunk, by default the labels followed by their
+        negative samples, drawn with chunk_id as batch id. See Trainer.
+        """
+        # noinspection PyUnresolvedReferences
+        return self.negative_sample(chunk, batch=chunk_id)
+
+    def prepare_batches(self, data, batch_size, words_per_batch=None):
+        """
+        Split data, the labels followed by their negative samples (k+1, ns, nt), into batches
+        of sentences and prepare_input each of them.
+        :return: a list of (inputs of _train, number of words)
+        """
+        batch_size = token_batch_size(batch_size, data.shape[-1], words_per_batch)
+        # noinspection PyUnresolvedReferences
+        return [(self.prepare_input(data[:, start:start+batch_size]), data[0, start:start+batch_size].size)
+                for start in xrange(0, data.shape[1], batch_size)]
 
-    def info(self, message):
-        if self.logger is not None:
-            self.logger.writelines(['INFO:', message, '\n'])
+    def train_batches(self, batches):
+        """
+        :param batches: see prepare_batches
+        :return: the mean loss per word
+        """
+        loss = 0.0
+        nb_words = 0
+        for ins, nb_words_ in batches:
+            # noinspection PyUnresolvedReferences
+            loss += self._train(*ins) * nb_words_
+            nb_words += nb_words_
+        self._decoded = False
+        return loss / nb_words
 
-    def debug(self, message):
-        if self.logger is not None:
-            self.logger.writelines(['DEBUG:', message, '\n'])
+    def make_batch_ring(self, batch_size, nb_slots):
+        """
+        Build the BatchRing through which the data workers hand over the batches
+        (X, y, sp_x, sp_y, probs, poses) of the models trained on sparse codes, so only slot ids go
+        through the queue. The slots are sized for the largest batch: batch_size samples, or
+        words_per_batch (at least one sentence) when it is set.
+        """
+        if self.words_per_batch is None:
+            nb_rows = batch_size
+        else:
+            nb_rows = max(int(self.words_per_batch), MAX_SETN_LEN)
+        nb_labels = (self.nb_negative + 1) * nb_rows
+        x_nnz = int(np.diff(self.sparse_coding_pad.indptr).max()) * self.context_size * nb_rows
+        y_nnz = int(np.diff(self.sparse_coding.indptr).max()) * nb_labels
+        self.batch_ring = BatchRing(nb_slots, [('array', 'int32', self.context_size * nb_rows),
+                                               ('array', 'int32', nb_labels),
+                                               ('csr', 'float32', x_nnz, self.context_size * nb_rows),
+                                               ('csr', 'float32', y_nnz, nb_labels),
+                                               ('array', 'float32', nb_labels),
+                                               ('array', 'int32', nb_labels)])
+        return self.batch_ring
+
+    def take_batch(self, queue):
+        """
+        :return: the next batch prepared by the data workers, see make_batch_ring.
+        """
+        if self.batch_ring is None:
+            return queue.get()
+        return self.batch_ring.take(queue)
 
-    def close(self):
-        if self.logger is not None:
-            self.logger.close()
+    def start_data_workers(self, batch_size, nb_data_workers, data_pool_size, nb_val_workers):
+        """
+        Start the processes encoding the chunks of sentences into the batches of the models
+        trained on sparse codes, see prepare_input. The training chunks go through jobs_pools
+        and their batches come back through jobs_pools_post and a BatchRing, the validation
+        ones through val_jobs_pools and val_jobs_pools_post.
+        :return: the worker processes
+        """
+        data_workers = []
+        pre_data = Queue(data_pool_size)
+        post_data = Queue(data_pool_size*30)
+        self.jobs_pools = pre_data
+        self.jobs_pools_post = post_data
+        val_pre_data = Queue(data_pool_size)
+        val_post_data = Queue(data_pool_size*30)
+        self.val_jobs_pools = val_pre_data
+        self.val_jobs_pools_post = val_post_data
+        # a few batches ahead per worker; more slots only cost shared memory
+        batch_ring = self.make_batch_ring(batch_size, 4 * nb_data_workers)
 
+        xk = Array(ctypes.c_int32, np.arange(self.vocab_size, dtype='int32'), lock=False)
+        # a_type = ctypes.c_double if str(self.neg_prob_table.dtype) == 'float64' else ctypes.c_float
+        assert str(self.neg_prob_table.dtype) == 'float32'
+        pk = Array(ctypes.c_float, self.neg_prob_table, lock=False)
 
-class LangModel(object):
-    def __init__(self):
-        super(LangModel, self).__init__()
+        # a_type = ctypes.c_double if str(self.sparse_coding.dtype) == 'float64' else ctypes.c_float
+        assert str(self.sparse_coding.dtype) == 'float32'
+        sp_data = Array(ctypes.c_float, self.sparse_coding.data, lock=False)
+        assert str(self.sparse_coding.indices.dtype) == 'int32'
+        assert str(self.sparse_coding.indptr.dtype) == 'int32'
+        sp_indices = Array(ctypes.c_int32, self.sparse_coding.indices, lock=False)
+        sp_indptr = Array(ctypes.c_int32, self.sparse_coding.indptr, lock=False)
+
+        # a_type = ctypes.c_double if str(self.sparse_coding_pad.dtype) == 'float64' else ctypes.c_float
+        assert str(self.sparse_coding_pad.dtype) == 'float32'
+        sp_pad_data = Array(ctypes.c_float, self.sparse_coding_pad.data, lock=False)
+        assert str(self.sparse_coding_pad.indices.dtype) == 'int32'
+        assert str(self.sparse_coding_pad.indptr.dtype) == 'int32'
+        sp_pad_indices = Array(ctypes.c_int32, self.sparse_coding_pad.indices, lock=False)
+        sp_pad_indptr = Array(ctypes.c_int32, self.sparse_coding_pad.indptr, lock=False)
+
+        # prepare_input(sents_queue, jobs_pool, all_finished,
+        #       vocab_size, context_size, batch_size, nb_negative, xk, pk,
+        #       sp_data, sp_indices, sp_indptr, sp_shape,
+        #       sp_pad_data, sp_pad_indices, sp_pad_inptr, sp_pad_shape, words_per_batch=None,
+        #       noise_pool=None, shared_negative=False, noise_seed=None, nb_sample_threads=1, batch_ring=None):
+        worker_args = (self.vocab_size, self.context_size, batch_size, self.nb_negative,
+                       xk, pk, sp_data, sp_indices, sp_indptr, self.sparse_coding.shape,
+                       sp_pad_data, sp_pad_indices, sp_pad_indptr, self.sparse_coding_pad.shape,
+                       self.words_per_batch, self.noise_pool, self.shared_negative,
+                       self.noise_seed, self.nb_sample_threads)
+        for _ in range(nb_data_workers):
+            p = Process(target=prepare_input,
+                        args=(pre_data, post_data, self.all_finished) + worker_args + (batch_ring,))
+            p.daemon = True
+            data_workers.append(p)
+            p.start()
+        # the validation has its own queues and workers, so the training ones go on during it
+        for _ in range(nb_val_workers):
+            p = Process(target=prepare_input, args=(val_pre_data, val_post_data, self.all_finished) + worker_args)
+            p.daemon = True
+            data_workers.append(p)
+            p.start()
+        data_workers.append(self.start_validation_worker())
+        return data_workers
+
+    def start_validation_worker(self):
+        """
+        Start the process running the validations during the training (start_validation), so
+        they do not compete with the training step for the GIL and the CPUs of this process. It
+        is forked with the compiled _test and gets the parameter snapshots through shared memory.
+        :return: the process
+        """
+        self._snapshot_buffers = []
+        for _, snapshot in self._param_snapshots:
+            value = snapshot.get_value(borrow=True)
+            buf = Array(ctypes.c_char, max(1, value.nbytes), lock=False)
+            self._snapshot_buffers.append(np.frombuffer(buf, dtype=value.dtype, count=value.size).reshape(value.shape))
+        self._val_requests = Queue()
+        self._val_results = Queue()
+        self._val_pending = False
+        p = Process(target=self._validation_worker)
+        p.daemon = True
+        p.start()
+        return p
+
+    def _validation_worker(self):
+        while not self.all_finished.is_set():
+            try:
+                val_sents, nb_words_trained = self._val_requests.get(timeout=1)
+            except Empty:
+                continue
+            for (_, snapshot), buf in zip(self._param_snapshots, self._snapshot_buffers):
+                snapshot.set_value(buf)
+            self.decode_output_weights()
+            # the log file belongs to the trainer process, which logs the results there
+            self._val_results.put(self.validate_snapshot(val_sents, None, nb_words_trained) + (nb_words_trained,))
+
+    def compile_snapshot_test(self, test_ins, test_outs):
+        """
+        Compile _test on a copy of the parameters taken by snapshot_params, so a validation can
+        run while the training updates the parameters. The weights of the full softmax layers
+        are decoded from the same copy, see compile_decode; the models compiled this way have
+        no _test on the live parameters.
+        """
+        shared_params = []
+        # noinspection PyUnresolvedReferences
+        for param in self.params:
+            param = self._get_shared_param(param)
+            if all(param is not p for p in shared_params):
+                shared_params.append(param)
+        self._param_snapshots = [(p, theano.shared(p.get_value(), name=p.name, broadcastable=p.broadcastable))
+                                 for p in shared_params]
+        self._test = theano.function(test_ins, test_outs, givens=self._param_snapshots)
+        self.compile_decode(givens=self._param_snapshots)
+
+    def snapshot_params(self):
+        for param, snapshot in self._param_snapshots:
+            snapshot.set_value(param.get_value())
+        self.decode_output_weights()
+
+    def compile_decode(self, givens=None):
+        """
+        Compile _decode, which decodes the weights of the full softmax layers (DecodedOutputWeights)
+        into the buffers their test output reads, so it is done once per validation instead of
+        for each batch. With givens, e.g. the parameter snapshots, they are decoded from those.
+        """
+        updates = []
+        # noinspection PyUnresolvedReferences
+        for node in self.nodes.values():
+            if isinstance(node, DecodedOutputWeights):
+                updates += node.decode_updates()
+        self._decode = theano.function([], [], updates=updates, givens=givens) if updates else None
+
+    def decode_output_weights(self):
+        """
+        Decode the weights of the full softmax from the current parameters; call it before
+        running the test function after they changed. See compile_decode.
+        """
+        if self._decode is not None:
+            self._decode()
+        self._decoded = True
+
+    def ensure_decoded(self):
+        """
+        Decode the weights of the full softmax unless they are already those of the current
+        parameters, so the test function never reads the zeros they start with.
+        """
+        if not self._decoded:
+            self.decode_output_weights()
+
+    def validate_snapshot(self, val_sents, log_file=None, nb_words_trained=None):
+        """
+        Validate the parameters of the last snapshot_params on val_sents, the batches being
+        prepared by the validation data workers (val_jobs_pools).
+        :param val_sents: validation sentences.
+        :type val_sents: a list, each element a ndarray
+        :param nb_words_trained: number of words trained when the snapshot was taken, logged
+        with the results if not None
+        :return: tuple
+        """
+        code_len = 0.
+        nb_words = 0.
+        loss = 0.0
+        nb_samples = 0
+        total_samples = sum(sents.size for sents in val_sents)
+
+        def chunk_val_generator():
+            for sents in val_sents:
+                self.val_jobs_pools.put((self.next_chunk_id(validation=True), sents))
+
+        gen_chunk_thread = Thread(target=chunk_val_generator)
+        gen_chunk_thread.setDaemon(True)
+        gen_chunk_thread.start()
+
+        logger.debug('begin val loop')
+        # each word of the sentences gives one sample
+        while nb_samples < total_samples:
+            ins = self.val_jobs_pools_post.get()
+            loss_, code_len_, nb_words_ = self._test(*ins)
+            nb_samples += ins[0].shape[0]
+            nb_words += nb_words_
+            code_len += code_len_
+            loss += loss_ * nb_words_
+        logger.debug('end val loop')
+
+        loss /= nb_words
+        ppl = math.exp(code_len/nb_words)
+
+        step = '' if nb_words_trained is None else ' - words trained: %d' % nb_words_trained
+        logger.info('%s:Val val_loss: %.2f - val_ppl: %.2f%s' % (self.__class__.__name__, loss, ppl, step))
+        self.log_validation(loss, ppl, nb_words_trained, log_file)
+
+        return loss, ppl
+
+    def log_validation(self, loss, ppl, nb_words_trained=None, log_file=None):
+        if log_file is not None:
+            step = '' if nb_words_trained is None else ' - words trained: %d' % nb_words_trained
+            log_file.info('%s:Val val_loss: %.6f - val_ppl: %.6f%s' % (self.__class__.__name__, loss, ppl, step))
+
+    def start_validation(self, val_sents, nb_words_trained, log_file=None):
+        """
+        Snapshot the parameters and validate them in the validation worker process, see
+        start_validation_worker. Nothing is done while the previous validation is still running.
+        :return: True if the validation is started
+        """
+        self.wait_validation(log_file, block=False)
+        if self._val_pending:
+            return False
+        for (param, _), buf in zip(self._param_snapshots, self._snapshot_buffers):
+            buf[...] = param.get_value(borrow=True)
+        self._val_requests.put((val_sents, nb_words_trained))
+        self._val_pending = True
+        return True
+
+    def wait_validation(self, log_file=None, block=True):
+        """
+        Wait for the validation started by start_validation, if any, and write its results
+        to log_file. With block=False, only if it is done.
+        """
+        if not self._val_pending:
+            return
+        try:
+            loss, ppl, nb_words_trained = self._val_results.get(block)
+        except Empty:
+            return
+        self._val_pending = False
+        self.log_validation(loss, ppl, nb_words_trained, log_file)
+
+    def log_noise_pool(self, log_file=None):
+        if self.noise_pool is None:
+            return
+        logger.info('%s:Train - %s' % (self.__class__.__name__, self.noise_pool.summary()))
+        if log_file is not None:
+            log_file.info('%s:Train - %s' % (self.__class__.__name__, self.noise_pool.summary()))
 
     @staticmethod
     def encode_length(y_label, y_pred, mask=None):
@@ -91,6 +472,20 @@ class LangModel(object):
 
         return -T.sum(T.log(probs)), nb_words
 
+    @staticmethod
+    def encode_length_blocked(y_label, pred_layer, mask=None):
+        """
+        Same as encode_length, the log probabilities of the labels being computed over blocks
+        of the vocabulary by pred_layer, without the (..., V) tensor of all the probabilities.
+        :param y_label: true index labels
+        :param pred_layer: the softmax output layer, see DecodedOutputWeights.label_log_prob
+        :param mask: mask
+        """
+        log_probs = pred_layer.label_log_prob(y_label)
+        if mask is None:
+            return -T.sum(log_probs), y_label.size
+        return -T.sum(T.reshape(log_probs, mask.shape)[mask.nonzero()]), mask.sum()
+
     @staticmethod
     def _get_shared_param(param):
         if isinstance(param, T.TensorVariable):
@@ -112,6 +507,11 @@ class LangModel(object):
         for idx, param_ in enumerate(self.params):
             param = self._get_shared_param(param_)
             param.set_value(params[idx])
+        # the test function reads the decoded weights, and the snapshot if the model has one
+        if self._param_snapshots is not None:
+            self.snapshot_params()
+        else:
+            self.decode_output_weights()
 
     def get_val_data(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', val_nb_words=100000):
         # noinspection PyUnresolvedReferences
@@ -121,19 +521,15 @@ class LangModel(object):
         else:
             sent_gen = data_file
 
-        val_sents = [None for _ in range(MAX_SETN_LEN)]
+        val_sents = SentenceBuckets(MAX_SETN_LEN, mem_budget=None)
         val_nb = 0
         for sents in sent_gen:
             val_nb += sents.size
             chunk_sentences(val_sents, sents, 1000000, no_return=True)
             if val_nb >= val_nb_words:
                 break
-        val_sents_ = [None for _ in range(MAX_SETN_LEN)]
-        for idx in range(MAX_SETN_LEN):
-            if val_sents[idx]:
-                val_sents_[idx] = np.vstack(val_sents[idx]['sents'])
 
-        val_sents = [sents for sents in val_sents_ if sents is not None]
+        val_sents = val_sents.groups()
         for sents in val_sents:
             mask = (sents > max_vocab)
             sents[mask] = max_vocab
@@ -192,70 +588,10 @@ class SimpleLangModel(Sequential, LangModel):
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None):
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(file_name=log_file)
-        log_file.info('training with file: %s\n' % data_file)
-        log_file.info('training with batch size %d\n' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training\n' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds\n' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            # loss, ce, nb_wrd = self._train(chunk, chunk)
-            loss, ppl = self._loop_train(chunk, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('SimpleModel:Train - ETA: %02d:%02d - loss: %5.1f - ppl: %7.2f - speed: %.1f sent/s %.1f words/s' %
-                        (eta_h, eta_m, loss, ppl, speed1, speed2))
-            log_file.info('SimpleModel:Train - time: %f - loss: %.6f - ppl: %.6f' % (end_, loss, ppl))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                log_file.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size, log_file)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
+              validation_interval=1800, log_file=None, words_per_batch=None, prefetch_size=4):
+        self.words_per_batch = words_per_batch
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file, words_per_batch, prefetch_size, initial_validation=False).run()
 
     def validation(self, val_sents, batch_size, log_file=None):
         """
@@ -348,7 +684,11 @@ class SimpleLangModel(Sequential, LangModel):
         # noinspection PyUnresolvedReferences
         self.fit = self._Sequential__fit_unweighted
 
-    def _loop_train(self, data, batch_size):
+    def encode_chunk(self, chunk, batch_size, words_per_batch=None, chunk_id=None):
+        return chunk
+
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, data.shape[-1], words_per_batch)
         nb = data.shape[0]
         nb_words = 0.
         code_len = 0.
@@ -372,12 +712,13 @@ class SimpleLangModel(Sequential, LangModel):
 
 class NCELangModel(Graph, LangModel):
     def __init__(self, vocab_size, nb_negative, embed_dims=128, context_dims=128,
-                 negprob_table=None, optimizer='adam'):
+                 negprob_table=None, optimizer='adam', shared_negative=False):
         super(NCELangModel, self).__init__(weighted_inputs=False)
         self.vocab_size = vocab_size
         self.embed_dim = embed_dims
         self.optimizer = optimizers.get(optimizer)
         self.nb_negative = nb_negative
+        self.shared_negative = shared_negative
         self.loss = categorical_crossentropy
         self.loss_fnc = objective_fnc(self.loss)
 
@@ -401,7 +742,7 @@ class NCELangModel(Graph, LangModel):
         # seq.add(Dropout(0.5))
 
         self.add_node(seq, name='seq')
-        self.add_node(PartialSoftmax(input_dim=context_dims, output_dim=vocab_size),
+        self.add_node(PartialSoftmax(input_dim=context_dims, output_dim=vocab_size, shared_noise=shared_negative),
                       name='part_prob', inputs=('idxes', 'seq'))
         self.add_node(LookupProb(negprob_table), name='lookup_prob', inputs='idxes')
 
@@ -479,16 +820,17 @@ class NCELangModel(Graph, LangModel):
 
         self._test.summarize_outputs = __summarize_outputs
 
-    def negative_sample(self, X, order=0):
+    def negative_sample(self, X, order=0, batch=None):
         if order == 0:
             ret = np.empty(shape=(self.nb_negative+1,) + X.shape, dtype=X.dtype)
             ret[0] = X
-            ret[1:] = self.sampler.sample(shape=ret[1:].shape)
+            self.sample_noise(ret, batch)
         else:
             raise NotImplementedError('Only support order=0 now')
         return ret
 
-    def _loop_train(self, data, batch_size):
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, data.shape[-1], words_per_batch)
         nb = data.shape[1]
         nb_words = data[0].size
         loss = 0.0
@@ -503,73 +845,10 @@ class NCELangModel(Graph, LangModel):
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size, log_file)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            # loss, ce, nb_wrd = self._train(chunk, chunk)
-            x = self.negative_sample(chunk)
-            loss = self._loop_train(x, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.1f - speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, speed1, speed2))
-            log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                log_file.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size, log_file)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
-        log_file.close()
+              validation_interval=1800, log_file=None, words_per_batch=None, prefetch_size=4):
+        self.words_per_batch = words_per_batch
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file, words_per_batch, prefetch_size).run()
 
     def validation(self, val_sents, batch_size, log_file=None):
         """
@@ -583,7 +862,8 @@ class NCELangModel(Graph, LangModel):
 
         for sents in val_sents:
             x = [self.negative_sample(sents)]
-            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size)
+            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size,
+                                                          words_per_batch=self.words_per_batch)
             nb_words += nb_words_
             code_len += code_len_
             loss += loss_ * nb_words_
@@ -596,7 +876,8 @@ class NCELangModel(Graph, LangModel):
         return loss, ppl
 
     @staticmethod
-    def _test_loop(f, ins, batch_size=128, verbose=0):
+    def _test_loop(f, ins, batch_size=128, verbose=0, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, ins[0].shape[-1], words_per_batch)
         nb_sample = ins[0].shape[1]
         outs = [[] for _ in range(f.n_returned_outputs)]
         batch_info = []
@@ -614,12 +895,13 @@ class NCELangModel(Graph, LangModel):
 
 class NCELangModelV1(Graph, LangModel):
     def __init__(self, vocab_size, nb_negative, embed_dims=128, context_dims=128,
-                 negprob_table=None, optimizer='adam'):
+                 negprob_table=None, optimizer='adam', shared_negative=False):
         super(NCELangModelV1, self).__init__(weighted_inputs=False)
         self.vocab_size = vocab_size
         self.embed_dim = embed_dims
         self.optimizer = optimizers.get(optimizer)
         self.nb_negative = nb_negative
+        self.shared_negative = shared_negative
 
         if negprob_table is None:
             self.neg_prob_table = np.ones(shape=(vocab_size,), dtype=theano.config.floatX)/vocab_size
@@ -640,7 +922,7 @@ class NCELangModelV1(Graph, LangModel):
 
         self.add_node(seq, name='seq')
 
-        self.add_node(PartialSoftmaxV1(input_dim=context_dims, output_dim=vocab_size),
+        self.add_node(PartialSoftmaxV1(input_dim=context_dims, output_dim=vocab_size, shared_noise=shared_negative),
                       name='part_prob', inputs=('unique_idxes', 'poses', 'seq'))
 
         test_node = Dense(input_dim=context_dims, output_dim=vocab_size, activation='softmax')
@@ -724,18 +1006,19 @@ class NCELangModelV1(Graph, LangModel):
 
         self._test.summarize_outputs = __summarize_outputs
 
-    def negative_sample(self, X, order=0):
+    def negative_sample(self, X, order=0, batch=None):
         if order == 0:
             ret = np.empty(shape=(self.nb_negative+1,) + X.shape, dtype=X.dtype)
             ret[0] = X
-            ret[1:] = self.sampler.sample(shape=ret[1:].shape)
+            self.sample_noise(ret, batch)
         else:
             raise NotImplementedError('Only support order=0 now')
         return ret
 
-    def prepare_input(self, X):
+    def prepare_input(self, X, neg_idxes=None):
         ins = X
-        neg_idxes = self.negative_sample(ins)
+        if neg_idxes is None:
+            neg_idxes = self.negative_sample(ins)
         neg_probs = self.neg_prob_table[neg_idxes]
         unique_idxes, indeces = np.unique(neg_idxes, return_inverse=True)
         indeces = np.reshape(indeces, neg_probs.shape)
@@ -743,75 +1026,32 @@ class NCELangModelV1(Graph, LangModel):
         indeces = indeces.astype(X.dtype)
         return [ins, neg_probs, unique_idxes, indeces]
 
-    def _loop_train(self, data, batch_size):
-        nb = data.shape[0]
-        nb_words = data.size
+    def encode_chunk(self, chunk, batch_size, words_per_batch=None, chunk_id=None):
+        return self.negative_sample(chunk, batch=chunk_id)
+
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, data.shape[-1], words_per_batch)
+        nb = data.shape[1]
+        nb_words = data[0].size
         loss = 0.0
         for start in xrange(0, nb, batch_size):
             end = start + batch_size
-            x = data[start:end]
-            ins = self.prepare_input(x)
+            x = data[:, start:end]
+            ins = self.prepare_input(x[0], x)
             loss_ = self._train(*ins)
-            loss += loss_ * x.size
+            loss += loss_ * x[0].size
 
         loss /= nb_words
         return loss
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800):
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %.0f seconds' % float(validation_interval))
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            # loss, ce, nb_wrd = self._train(chunk, chunk)
-            loss = self._loop_train(chunk, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.1f - speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, speed1, speed2))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
+              validation_interval=1800, log_file=None, words_per_batch=None, prefetch_size=4):
+        self.words_per_batch = words_per_batch
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file, words_per_batch, prefetch_size).run()
 
-    def validation(self, val_sents, batch_size):
+    def validation(self, val_sents, batch_size, log_file=None):
         """
         :param val_sents: validation sentences.
         :type val_sents: a list, each element a ndarray
@@ -822,7 +1062,8 @@ class NCELangModelV1(Graph, LangModel):
         loss = 0.0
 
         for sents in val_sents:
-            loss_, code_len_, nb_words_ = self._test_loop(self._test, [sents], batch_size)
+            loss_, code_len_, nb_words_ = self._test_loop(self._test, [sents], batch_size,
+                                                          words_per_batch=self.words_per_batch)
             nb_words += nb_words_
             code_len += code_len_
             loss += loss_ * nb_words_
@@ -830,10 +1071,13 @@ class NCELangModelV1(Graph, LangModel):
         loss /= nb_words
         ppl = math.exp(code_len/nb_words)
         logger.info('%s:Val val_loss: %.2f - val_ppl: %.2f' % (self.__class__.__name__, loss, ppl))
+        if log_file is not None:
+            log_file.info('%s:Val val_loss: %.6f - val_ppl: %.6f' % (self.__class__.__name__, loss, ppl))
 
         return loss, ppl
 
-    def _test_loop(self, f, ins, batch_size=128):
+    def _test_loop(self, f, ins, batch_size=128, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, ins[0].shape[-1], words_per_batch)
         nb_sample = ins[0].shape[0]
         outs = [[] for _ in range(f.n_returned_outputs)]
         batch_info = []
@@ -852,12 +1096,13 @@ class NCELangModelV1(Graph, LangModel):
 
 class NCELangModelV2(Graph, LangModel):
     def __init__(self, vocab_size, nb_negative, embed_dims=128, context_dims=128,
-                 negprob_table=None, optimizer='adam'):
+                 negprob_table=None, optimizer='adam', shared_negative=False):
         super(NCELangModelV2, self).__init__(weighted_inputs=False)
         self.vocab_size = vocab_size
         self.embed_dim = embed_dims
         self.optimizer = optimizers.get(optimizer)
         self.nb_negative = nb_negative
+        self.shared_negative = shared_negative
         self.loss = categorical_crossentropy
         self.loss_fnc = objective_fnc(self.loss)
 
@@ -881,7 +1126,7 @@ class NCELangModelV2(Graph, LangModel):
         # seq.add(Dropout(0.5))
 
         self.add_node(seq, name='seq')
-        self.add_node(PartialSoftmax(input_dim=context_dims, output_dim=vocab_size),
+        self.add_node(PartialSoftmax(input_dim=context_dims, output_dim=vocab_size, shared_noise=shared_negative),
                       name='part_prob', inputs=('idxes', 'seq'))
         self.add_node(Dense(input_dim=context_dims, output_dim=1, activation='exponential'),
                       name='normalizer', inputs='seq')
@@ -973,16 +1218,17 @@ class NCELangModelV2(Graph, LangModel):
 
         self._test.summarize_outputs = __summarize_outputs
 
-    def negative_sample(self, X, order=0):
+    def negative_sample(self, X, order=0, batch=None):
         if order == 0:
             ret = np.empty(shape=(self.nb_negative+1,) + X.shape, dtype=X.dtype)
             ret[0] = X
-            ret[1:] = self.sampler.sample(shape=ret[1:].shape)
+            self.sample_noise(ret, batch)
         else:
             raise NotImplementedError('Only support order=0 now')
         return ret
 
-    def _loop_train(self, data, batch_size):
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, data.shape[-1], words_per_batch)
         nb = data.shape[1]
         nb_words = data[0].size
         loss = 0.0
@@ -997,73 +1243,10 @@ class NCELangModelV2(Graph, LangModel):
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size, log_file)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            # loss, ce, nb_wrd = self._train(chunk, chunk)
-            x = self.negative_sample(chunk)
-            loss = self._loop_train(x, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.1f - speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, speed1, speed2))
-            log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                log_file.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size, log_file)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
-        log_file.close()
+              validation_interval=1800, log_file=None, words_per_batch=None, prefetch_size=4):
+        self.words_per_batch = words_per_batch
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file, words_per_batch, prefetch_size).run()
 
     def validation(self, val_sents, batch_size, log_file=None):
         """
@@ -1077,7 +1260,8 @@ class NCELangModelV2(Graph, LangModel):
 
         for sents in val_sents:
             x = [self.negative_sample(sents)]
-            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size)
+            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size,
+                                                          words_per_batch=self.words_per_batch)
             nb_words += nb_words_
             code_len += code_len_
             loss += loss_ * nb_words_
@@ -1090,7 +1274,8 @@ class NCELangModelV2(Graph, LangModel):
         return loss, ppl
 
     @staticmethod
-    def _test_loop(f, ins, batch_size=128, verbose=0):
+    def _test_loop(f, ins, batch_size=128, verbose=0, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, ins[0].shape[-1], words_per_batch)
         nb_sample = ins[0].shape[1]
         outs = [[] for _ in range(f.n_returned_outputs)]
         batch_info = []
@@ -1108,7 +1293,7 @@ class NCELangModelV2(Graph, LangModel):
 
 class NCELangModelV3(Graph, LangModel):
     def __init__(self, sparse_coding, nb_negative, embed_dims=128, context_dims=128,
-                 init_embeddings=None, negprob_table=None, optimizer='adam'):
+                 init_embeddings=None, negprob_table=None, optimizer='adam', shared_negative=False):
         super(NCELangModelV3, self).__init__(weighted_inputs=False)
         vocab_size = sparse_coding.shape[0]  # the extra word is for OOV
         self.nb_base = sparse_coding.shape[1] - 1
@@ -1116,6 +1301,7 @@ class NCELangModelV3(Graph, LangModel):
         self.embed_dim = embed_dims
         self.optimizer = optimizers.get(optimizer)
         self.nb_negative = nb_negative
+        self.shared_negative = shared_negative
         self.loss = categorical_crossentropy
         self.loss_fnc = objective_fnc(self.loss)
         self.sparse_coding = sparse_coding
@@ -1141,7 +1327,7 @@ class NCELangModelV3(Graph, LangModel):
                       name='embedding', inputs=('codes_flat', 'sents_shape'))
         self.add_node(LangLSTMLayer(embed_dims, output_dim=context_dims), name='encoder', inputs='embedding')
         # seq.add(Dropout(0.5))
-        self.add_node(PartialSoftmax(input_dim=context_dims, output_dim=vocab_size),
+        self.add_node(PartialSoftmax(input_dim=context_dims, output_dim=vocab_size, shared_noise=shared_negative),
                       name='part_prob', inputs=('idxes', 'encoder'))
         self.add_node(Dense(input_dim=context_dims, output_dim=1, activation='exponential'),
                       name='normalizer', inputs='encoder')
@@ -1237,28 +1423,21 @@ class NCELangModelV3(Graph, LangModel):
 
         self._test.summarize_outputs = __summarize_outputs
 
-    def negative_sample(self, X, order=0):
+    def negative_sample(self, X, order=0, batch=None):
         if order == 0:
             ret = np.empty(shape=(self.nb_negative+1,) + X.shape, dtype=X.dtype)
             ret[0] = X
-            ret[1:] = self.sampler.sample(shape=ret[1:].shape)
+            self.sample_noise(ret, batch)
         else:
             raise NotImplementedError('Only support order=0 now')
         return ret
 
-    def _loop_train(self, data, batch_size):
-        nb = data.shape[1]
-        nb_words = data[0].size
-        loss = 0.0
-        for start in xrange(0, nb, batch_size):
-            end = start + batch_size
-            ins0 = data[:, start:end]
-            ins = self.prepare_input(ins0)
-            loss_ = self._train(*ins)
-            loss += loss_ * ins0[0].size
+    def encode_chunk(self, chunk, batch_size, words_per_batch=None, chunk_id=None):
+        return self.prepare_batches(self.negative_sample(chunk, batch=chunk_id), batch_size,
+                                    words_per_batch)
 
-        loss /= nb_words
-        return loss
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        return self.train_batches(data)
 
     def prepare_input(self, data):
         """
@@ -1270,78 +1449,15 @@ class NCELangModelV3(Graph, LangModel):
         x[0] = data
         x[1] = data[0].shape
         idx = data[0].ravel()
-        x[2] = self.sparse_coding[idx]
+        x[2] = gather_rows(self.sparse_coding, idx)
         return x
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size, log_file)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            # loss, ce, nb_wrd = self._train(chunk, chunk)
-            x = self.negative_sample(chunk)
-            loss = self._loop_train(x, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.1f - speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, speed1, speed2))
-            log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                log_file.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size, log_file)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
-        log_file.close()
+              validation_interval=1800, log_file=None, words_per_batch=None, prefetch_size=4):
+        self.words_per_batch = words_per_batch
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file, words_per_batch, prefetch_size).run()
 
     def validation(self, val_sents, batch_size, log_file=None):
         """
@@ -1355,7 +1471,8 @@ class NCELangModelV3(Graph, LangModel):
 
         for sents in val_sents:
             x = [self.negative_sample(sents)]
-            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size)
+            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size,
+                                                          words_per_batch=self.words_per_batch)
             nb_words += nb_words_
             code_len += code_len_
             loss += loss_ * nb_words_
@@ -1367,7 +1484,8 @@ class NCELangModelV3(Graph, LangModel):
 
         return loss, ppl
 
-    def _test_loop(self, f, ins, batch_size=128, verbose=0):
+    def _test_loop(self, f, ins, batch_size=128, verbose=0, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, ins[0].shape[-1], words_per_batch)
         nb_sample = ins[0].shape[1]
         outs = [[] for _ in range(f.n_returned_outputs)]
         batch_info = []
@@ -1386,7 +1504,7 @@ class NCELangModelV3(Graph, LangModel):
 
 class NCELangModelV4(Graph, LangModel):
     def __init__(self, sparse_coding, nb_negative, embed_dims=128, context_dims=128,
-                 init_embeddings=None, negprob_table=None, optimizer='adam'):
+                 init_embeddings=None, negprob_table=None, optimizer='adam', shared_negative=False):
         super(NCELangModelV4, self).__init__(weighted_inputs=False)
         vocab_size = sparse_coding.shape[0]  # the extra word is for OOV
         self.nb_base = sparse_coding.shape[1] - 1
@@ -1394,6 +1512,7 @@ class NCELangModelV4(Graph, LangModel):
         self.embed_dim = embed_dims
         self.optimizer = optimizers.get(optimizer)
         self.nb_negative = nb_negative
+        self.shared_negative = shared_negative
         self.loss = categorical_crossentropy
         self.loss_fnc = objective_fnc(self.loss)
         self.sparse_coding = sparse_coding
@@ -1418,13 +1537,14 @@ class NCELangModelV4(Graph, LangModel):
         self.add_node(Identity(inputs={True: pos_codes, False: pos_codes}), name='codes_flat')
         self.add_node(Identity(inputs={True: shape, False: shape}), name='sents_shape')
         self.add_node(Identity(inputs={True: codes, False: codes}), name='sparse_codes')
+        self.add_input(name='code_poses', ndim=1, dtype='int32')
 
         self.add_node(SparseEmbedding(self.nb_base+1, embed_dims, weights=init_embeddings),
                       name='embedding', inputs=('codes_flat', 'sents_shape'))
         self.add_node(LangLSTMLayer(embed_dims, output_dim=context_dims), name='encoder', inputs='embedding')
         # seq.add(Dropout(0.5))
-        self.add_node(PartialSoftmaxV4(input_dim=context_dims, base_size=self.nb_base+1),
-                      name='part_prob', inputs=('idxes', 'sparse_codes', 'encoder'))
+        self.add_node(PartialSoftmaxV4(input_dim=context_dims, base_size=self.nb_base+1, shared_noise=shared_negative),
+                      name='part_prob', inputs=('idxes', 'sparse_codes', 'code_poses', 'encoder'))
         self.add_node(Dense(input_dim=context_dims, output_dim=1, activation='exponential'),
                       name='normalizer', inputs='encoder')
         self.add_node(LookupProb(negprob_table), name='lookup_prob', inputs='idxes')
@@ -1454,7 +1574,6 @@ class NCELangModelV4(Graph, LangModel):
         neg_prob_trn = neg_prob_layer.get_output(train=True) * self.nb_negative
         pos_prob_tst = pos_prob_layer.get_output(train=False)
         neg_prob_tst = neg_prob_layer.get_output(train=False) * self.nb_negative
-        pre_prob_tst = pre_prob_layer.get_output(train=False)
 
         nrm_const = normlzer_layer.get_output(train=True)
         nrm_const = T.reshape(nrm_const, (nrm_const.shape[0], nrm_const.shape[1]))
@@ -1478,9 +1597,10 @@ class NCELangModelV4(Graph, LangModel):
 
         input0 = self.inputs['idxes'].get_output(True)
         input1 = self.nodes['sparse_codes'].get_output(True)
+        input2 = self.inputs['code_poses'].get_output(True)
 
         true_labels = input0[0]
-        encode_len, nb_words = self.encode_length(true_labels, pre_prob_tst)
+        encode_len, nb_words = self.encode_length_blocked(true_labels, pre_prob_layer)
 
         train_loss = -y_train
         test_loss = -y_test
@@ -1489,10 +1609,11 @@ class NCELangModelV4(Graph, LangModel):
         updates = self.optimizer.get_updates(self.params, self.constraints, train_loss)
         updates += self.updates
 
-        self._train = theano.function([input0, input1], outputs=train_loss,
+        self._train = theano.function([input0, input1, input2], outputs=train_loss,
                                       updates=updates)
-        self._test = theano.function([input0, input1],
+        self._test = theano.function([input0, input1, input2],
                                      outputs=[test_loss, encode_len, nb_words])
+        self.compile_decode()
 
         self._train.out_labels = ('loss', )
         self._test.out_labels = ('loss', 'encode_len', 'nb_words')
@@ -1521,28 +1642,21 @@ class NCELangModelV4(Graph, LangModel):
 
         self._test.summarize_outputs = __summarize_outputs
 
-    def negative_sample(self, X, order=0):
+    def negative_sample(self, X, order=0, batch=None):
         if order == 0:
             ret = np.empty(shape=(self.nb_negative+1,) + X.shape, dtype=X.dtype)
             ret[0] = X
-            ret[1:] = self.sampler.sample(shape=ret[1:].shape)
+            self.sample_noise(ret, batch)
         else:
             raise NotImplementedError('Only support order=0 now')
         return ret
 
-    def _loop_train(self, data, batch_size):
-        nb = data.shape[1]
-        nb_words = data[0].size
-        loss = 0.0
-        for start in xrange(0, nb, batch_size):
-            end = start + batch_size
-            ins0 = data[:, start:end]
-            ins = self.prepare_input(ins0)
-            loss_ = self._train(*ins)
-            loss += loss_ * ins0[0].size
+    def encode_chunk(self, chunk, batch_size, words_per_batch=None, chunk_id=None):
+        return self.prepare_batches(self.negative_sample(chunk, batch=chunk_id), batch_size,
+                                    words_per_batch)
 
-        loss /= nb_words
-        return loss
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        return self.train_batches(data)
 
     def prepare_input(self, data):
         """
@@ -1550,82 +1664,19 @@ class NCELangModelV4(Graph, LangModel):
         :type data: numpy.ndarray
         :return:
         """
-        x = [None] * 2
+        x = [None] * 3
         x[0] = data
-        idx = x[0].ravel()
-        x[1] = self.sparse_coding[idx]
+        # the codes of the labels come first and as they are, the embedding reads them
+        rows, x[2] = unique_rows(self.label_code_rows(x[0]), x[0][0].size)
+        x[1] = gather_rows(self.sparse_coding, rows)
         return x
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size, log_file)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            # loss, ce, nb_wrd = self._train(chunk, chunk)
-            x = self.negative_sample(chunk)
-            loss = self._loop_train(x, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.1f - speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, speed1, speed2))
-            log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                log_file.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size, log_file)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
-
-        log_file.close()
+              validation_interval=1800, log_file=None, words_per_batch=None, prefetch_size=4):
+        self.words_per_batch = words_per_batch
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file, words_per_batch, prefetch_size).run()
 
     def validation(self, val_sents, batch_size, log_file=None):
         """
@@ -1637,9 +1688,11 @@ class NCELangModelV4(Graph, LangModel):
         nb_words = 0.
         loss = 0.0
 
+        self.decode_output_weights()
         for sents in val_sents:
             x = [self.negative_sample(sents)]
-            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size)
+            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size,
+                                                          words_per_batch=self.words_per_batch)
             nb_words += nb_words_
             code_len += code_len_
             loss += loss_ * nb_words_
@@ -1651,7 +1704,9 @@ class NCELangModelV4(Graph, LangModel):
 
         return loss, ppl
 
-    def _test_loop(self, f, ins, batch_size=128, verbose=0):
+    def _test_loop(self, f, ins, batch_size=128, verbose=0, words_per_batch=None):
+        self.ensure_decoded()
+        batch_size = token_batch_size(batch_size, ins[0].shape[-1], words_per_batch)
         nb_sample = ins[0].shape[1]
         outs = [[] for _ in range(f.n_returned_outputs)]
         batch_info = []
@@ -1670,7 +1725,7 @@ class NCELangModelV4(Graph, LangModel):
 
 class NCELangModelV5(Graph, LangModel):
     def __init__(self, sparse_coding, nb_negative, embed_dims=128,
-                 init_embeddings=None, negprob_table=None, optimizer='adam'):
+                 init_embeddings=None, negprob_table=None, optimizer='adam', shared_negative=False):
         super(NCELangModelV5, self).__init__(weighted_inputs=False)
         vocab_size = sparse_coding.shape[0]  # the extra word is for OOV
         self.nb_base = sparse_coding.shape[1] - 1
@@ -1678,6 +1733,7 @@ class NCELangModelV5(Graph, LangModel):
         self.embed_dim = embed_dims
         self.optimizer = optimizers.get(optimizer)
         self.nb_negative = nb_negative
+        self.shared_negative = shared_negative
         self.loss = categorical_crossentropy
         self.loss_fnc = objective_fnc(self.loss)
         self.sparse_coding = sparse_coding
@@ -1702,13 +1758,14 @@ class NCELangModelV5(Graph, LangModel):
         self.add_node(Identity(inputs={True: pos_codes, False: pos_codes}), name='codes_flat')
         self.add_node(Identity(inputs={True: shape, False: shape}), name='sents_shape')
         self.add_node(Identity(inputs={True: codes, False: codes}), name='sparse_codes')
+        self.add_input(name='code_poses', ndim=1, dtype='int32')
 
         self.add_node(SparseEmbedding(self.nb_base+1, embed_dims, weights=init_embeddings),
                       name='embedding', inputs=('codes_flat', 'sents_shape'))
         self.add_node(LangLSTMLayerV5(embed_dims), name='encoder', inputs='embedding')
         # seq.add(Dropout(0.5))
-        self.add_node(PartialSoftmaxV4(input_dim=embed_dims, base_size=self.nb_base+1),
-                      name='part_prob', inputs=('idxes', 'sparse_codes', 'encoder'))
+        self.add_node(PartialSoftmaxV4(input_dim=embed_dims, base_size=self.nb_base+1, shared_noise=shared_negative),
+                      name='part_prob', inputs=('idxes', 'sparse_codes', 'code_poses', 'encoder'))
         self.add_node(Dense(input_dim=embed_dims, output_dim=1, activation='exponential'),
                       name='normalizer', inputs='encoder')
         self.add_node(LookupProb(negprob_table), name='lookup_prob', inputs='idxes')
@@ -1738,7 +1795,6 @@ class NCELangModelV5(Graph, LangModel):
         neg_prob_trn = neg_prob_layer.get_output(train=True) * self.nb_negative
         pos_prob_tst = pos_prob_layer.get_output(train=False)
         neg_prob_tst = neg_prob_layer.get_output(train=False) * self.nb_negative
-        pre_prob_tst = pre_prob_layer.get_output(train=False)
 
         nrm_const = normlzer_layer.get_output(train=True)
         nrm_const = T.reshape(nrm_const, (nrm_const.shape[0], nrm_const.shape[1]))
@@ -1762,9 +1818,10 @@ class NCELangModelV5(Graph, LangModel):
 
         input0 = self.inputs['idxes'].get_output(True)
         input1 = self.nodes['sparse_codes'].get_output(True)
+        input2 = self.inputs['code_poses'].get_output(True)
 
         true_labels = input0[0]
-        encode_len, nb_words = self.encode_length(true_labels, pre_prob_tst)
+        encode_len, nb_words = self.encode_length_blocked(true_labels, pre_prob_layer)
 
         train_loss = -y_train
         test_loss = -y_test
@@ -1773,10 +1830,11 @@ class NCELangModelV5(Graph, LangModel):
         updates = self.optimizer.get_updates(self.params, self.constraints, train_loss)
         updates += self.updates
 
-        self._train = theano.function([input0, input1], outputs=train_loss,
+        self._train = theano.function([input0, input1, input2], outputs=train_loss,
                                       updates=updates)
-        self._test = theano.function([input0, input1],
+        self._test = theano.function([input0, input1, input2],
                                      outputs=[test_loss, encode_len, nb_words])
+        self.compile_decode()
 
         self._train.out_labels = ('loss', )
         self._test.out_labels = ('loss', 'encode_len', 'nb_words')
@@ -1805,28 +1863,21 @@ class NCELangModelV5(Graph, LangModel):
 
         self._test.summarize_outputs = __summarize_outputs
 
-    def negative_sample(self, X, order=0):
+    def negative_sample(self, X, order=0, batch=None):
         if order == 0:
             ret = np.empty(shape=(self.nb_negative+1,) + X.shape, dtype=X.dtype)
             ret[0] = X
-            ret[1:] = self.sampler.sample(shape=ret[1:].shape)
+            self.sample_noise(ret, batch)
         else:
             raise NotImplementedError('Only support order=0 now')
         return ret
 
-    def _loop_train(self, data, batch_size):
-        nb = data.shape[1]
-        nb_words = data[0].size
-        loss = 0.0
-        for start in xrange(0, nb, batch_size):
-            end = start + batch_size
-            ins0 = data[:, start:end]
-            ins = self.prepare_input(ins0)
-            loss_ = self._train(*ins)
-            loss += loss_ * ins0[0].size
+    def encode_chunk(self, chunk, batch_size, words_per_batch=None, chunk_id=None):
+        return self.prepare_batches(self.negative_sample(chunk, batch=chunk_id), batch_size,
+                                    words_per_batch)
 
-        loss /= nb_words
-        return loss
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        return self.train_batches(data)
 
     def prepare_input(self, data):
         """
@@ -1834,82 +1885,19 @@ class NCELangModelV5(Graph, LangModel):
         :type data: numpy.ndarray
         :return:
         """
-        x = [None] * 2
+        x = [None] * 3
         x[0] = data
-        idx = x[0].ravel()
-        x[1] = self.sparse_coding[idx]
+        # the codes of the labels come first and as they are, the embedding reads them
+        rows, x[2] = unique_rows(self.label_code_rows(x[0]), x[0][0].size)
+        x[1] = gather_rows(self.sparse_coding, rows)
         return x
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size, log_file)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            # loss, ce, nb_wrd = self._train(chunk, chunk)
-            x = self.negative_sample(chunk)
-            loss = self._loop_train(x, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.1f - speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, speed1, speed2))
-            log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                log_file.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size, log_file)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
-
-        log_file.close()
+              validation_interval=1800, log_file=None, words_per_batch=None, prefetch_size=4):
+        self.words_per_batch = words_per_batch
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file, words_per_batch, prefetch_size).run()
 
     def validation(self, val_sents, batch_size, log_file=None):
         """
@@ -1921,9 +1909,11 @@ class NCELangModelV5(Graph, LangModel):
         nb_words = 0.
         loss = 0.0
 
+        self.decode_output_weights()
         for sents in val_sents:
             x = [self.negative_sample(sents)]
-            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size)
+            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size,
+                                                          words_per_batch=self.words_per_batch)
             nb_words += nb_words_
             code_len += code_len_
             loss += loss_ * nb_words_
@@ -1935,7 +1925,9 @@ class NCELangModelV5(Graph, LangModel):
 
         return loss, ppl
 
-    def _test_loop(self, f, ins, batch_size=128, verbose=0):
+    def _test_loop(self, f, ins, batch_size=128, verbose=0, words_per_batch=None):
+        self.ensure_decoded()
+        batch_size = token_batch_size(batch_size, ins[0].shape[-1], words_per_batch)
         nb_sample = ins[0].shape[1]
         outs = [[] for _ in range(f.n_returned_outputs)]
         batch_info = []
@@ -1954,7 +1946,7 @@ class NCELangModelV5(Graph, LangModel):
 
 class NCELangModelV6(Graph, LangModel):
     def __init__(self, sparse_coding, nb_negative, embed_dims=128,
-                 init_embeddings=None, negprob_table=None, optimizer='adam'):
+                 init_embeddings=None, negprob_table=None, optimizer='adam', shared_negative=False):
         super(NCELangModelV6, self).__init__(weighted_inputs=False)
         vocab_size = sparse_coding.shape[0]  # the extra word is for OOV
         self.nb_base = sparse_coding.shape[1] - 1
@@ -1962,6 +1954,7 @@ class NCELangModelV6(Graph, LangModel):
         self.embed_dim = embed_dims
         self.optimizer = optimizers.get(optimizer)
         self.nb_negative = nb_negative
+        self.shared_negative = shared_negative
         self.loss = categorical_crossentropy
         self.loss_fnc = objective_fnc(self.loss)
         self.sparse_coding = sparse_coding
@@ -1986,13 +1979,14 @@ class NCELangModelV6(Graph, LangModel):
         self.add_node(Identity(inputs={True: pos_codes, False: pos_codes}), name='codes_flat')
         self.add_node(Identity(inputs={True: shape, False: shape}), name='sents_shape')
         self.add_node(Identity(inputs={True: codes, False: codes}), name='sparse_codes')
+        self.add_input(name='code_poses', ndim=1, dtype='int32')
 
         self.add_node(SparseEmbeddingV6(self.nb_base+1, embed_dims, weights=init_embeddings),
                       name='embedding', inputs=('codes_flat', 'sents_shape'))
         self.add_node(LangLSTMLayerV6(embed_dims), name='encoder', inputs='embedding')
         # seq.add(Dropout(0.5))
-        self.add_node(PartialSoftmaxV4(input_dim=embed_dims, base_size=self.nb_base+1),
-                      name='part_prob', inputs=('idxes', 'sparse_codes', 'encoder'))
+        self.add_node(PartialSoftmaxV4(input_dim=embed_dims, base_size=self.nb_base+1, shared_noise=shared_negative),
+                      name='part_prob', inputs=('idxes', 'sparse_codes', 'code_poses', 'encoder'))
         self.add_node(Dense(input_dim=embed_dims, output_dim=1, activation='exponential'),
                       name='normalizer', inputs='encoder')
         self.add_node(LookupProb(negprob_table), name='lookup_prob', inputs='idxes')
@@ -2022,7 +2016,6 @@ class NCELangModelV6(Graph, LangModel):
         neg_prob_trn = neg_prob_layer.get_output(train=True) * self.nb_negative
         pos_prob_tst = pos_prob_layer.get_output(train=False)
         neg_prob_tst = neg_prob_layer.get_output(train=False) * self.nb_negative
-        pre_prob_tst = pre_prob_layer.get_output(train=False)
 
         nrm_const = normlzer_layer.get_output(train=True)
         nrm_const = T.reshape(nrm_const, (nrm_const.shape[0], nrm_const.shape[1]))
@@ -2046,9 +2039,10 @@ class NCELangModelV6(Graph, LangModel):
 
         input0 = self.inputs['idxes'].get_output(True)
         input1 = self.nodes['sparse_codes'].get_output(True)
+        input2 = self.inputs['code_poses'].get_output(True)
 
         true_labels = input0[0]
-        encode_len, nb_words = self.encode_length(true_labels, pre_prob_tst)
+        encode_len, nb_words = self.encode_length_blocked(true_labels, pre_prob_layer)
 
         train_loss = -y_train
         test_loss = -y_test
@@ -2057,10 +2051,11 @@ class NCELangModelV6(Graph, LangModel):
         updates = self.optimizer.get_updates(self.params, self.constraints, train_loss)
         updates += self.updates
 
-        self._train = theano.function([input0, input1], outputs=train_loss,
+        self._train = theano.function([input0, input1, input2], outputs=train_loss,
                                       updates=updates)
-        self._test = theano.function([input0, input1],
+        self._test = theano.function([input0, input1, input2],
                                      outputs=[test_loss, encode_len, nb_words])
+        self.compile_decode()
 
         self._train.out_labels = ('loss', )
         self._test.out_labels = ('loss', 'encode_len', 'nb_words')
@@ -2089,28 +2084,21 @@ class NCELangModelV6(Graph, LangModel):
 
         self._test.summarize_outputs = __summarize_outputs
 
-    def negative_sample(self, X, order=0):
+    def negative_sample(self, X, order=0, batch=None):
         if order == 0:
             ret = np.empty(shape=(self.nb_negative+1,) + X.shape, dtype=X.dtype)
             ret[0] = X
-            ret[1:] = self.sampler.sample(shape=ret[1:].shape)
+            self.sample_noise(ret, batch)
         else:
             raise NotImplementedError('Only support order=0 now')
         return ret
 
-    def _loop_train(self, data, batch_size):
-        nb = data.shape[1]
-        nb_words = data[0].size
-        loss = 0.0
-        for start in xrange(0, nb, batch_size):
-            end = start + batch_size
-            ins0 = data[:, start:end]
-            ins = self.prepare_input(ins0)
-            loss_ = self._train(*ins)
-            loss += loss_ * ins0[0].size
+    def encode_chunk(self, chunk, batch_size, words_per_batch=None, chunk_id=None):
+        return self.prepare_batches(self.negative_sample(chunk, batch=chunk_id), batch_size,
+                                    words_per_batch)
 
-        loss /= nb_words
-        return loss
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        return self.train_batches(data)
 
     def prepare_input(self, data):
         """
@@ -2118,81 +2106,19 @@ class NCELangModelV6(Graph, LangModel):
         :type data: numpy.ndarray
         :return:
         """
-        x = [None] * 2
+        x = [None] * 3
         x[0] = data
-        idx = x[0].ravel()
-        x[1] = self.sparse_coding[idx]
+        # the codes of the labels come first and as they are, the embedding reads them
+        rows, x[2] = unique_rows(self.label_code_rows(x[0]), x[0][0].size)
+        x[1] = gather_rows(self.sparse_coding, rows)
         return x
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size, log_file)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            # loss, ce, nb_wrd = self._train(chunk, chunk)
-            x = self.negative_sample(chunk)
-            loss = self._loop_train(x, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.1f - speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, speed1, speed2))
-            log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                log_file.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size, log_file)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
-        log_file.close()
+              validation_interval=1800, log_file=None, words_per_batch=None, prefetch_size=4):
+        self.words_per_batch = words_per_batch
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file, words_per_batch, prefetch_size).run()
 
     def validation(self, val_sents, batch_size, log_file=None):
         """
@@ -2204,9 +2130,11 @@ class NCELangModelV6(Graph, LangModel):
         nb_words = 0.
         loss = 0.0
 
+        self.decode_output_weights()
         for sents in val_sents:
             x = [self.negative_sample(sents)]
-            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size)
+            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size,
+                                                          words_per_batch=self.words_per_batch)
             nb_words += nb_words_
             code_len += code_len_
             loss += loss_ * nb_words_
@@ -2218,7 +2146,9 @@ class NCELangModelV6(Graph, LangModel):
 
         return loss, ppl
 
-    def _test_loop(self, f, ins, batch_size=128, verbose=0):
+    def _test_loop(self, f, ins, batch_size=128, verbose=0, words_per_batch=None):
+        self.ensure_decoded()
+        batch_size = token_batch_size(batch_size, ins[0].shape[-1], words_per_batch)
         nb_sample = ins[0].shape[1]
         outs = [[] for _ in range(f.n_returned_outputs)]
         batch_info = []
@@ -2239,7 +2169,7 @@ class NCELangModelV7(Graph, LangModel):
     """ extend V4, bias for softmax not compressed.
     """
     def __init__(self, sparse_coding, nb_negative, embed_dims=128, context_dims=128,
-                 init_embeddings=None, negprob_table=None, optimizer='adam'):
+                 init_embeddings=None, negprob_table=None, optimizer='adam', shared_negative=False):
         super(NCELangModelV7, self).__init__(weighted_inputs=False)
         vocab_size = sparse_coding.shape[0]  # the extra word is for OOV
         self.nb_base = sparse_coding.shape[1] - 1
@@ -2247,6 +2177,7 @@ class NCELangModelV7(Graph, LangModel):
         self.embed_dim = embed_dims
         self.optimizer = optimizers.get(optimizer)
         self.nb_negative = nb_negative
+        self.shared_negative = shared_negative
         self.loss = categorical_crossentropy
         self.loss_fnc = objective_fnc(self.loss)
         self.sparse_coding = sparse_coding
@@ -2271,13 +2202,15 @@ class NCELangModelV7(Graph, LangModel):
         self.add_node(Identity(inputs={True: pos_codes, False: pos_codes}), name='codes_flat')
         self.add_node(Identity(inputs={True: shape, False: shape}), name='sents_shape')
         self.add_node(Identity(inputs={True: codes, False: codes}), name='sparse_codes')
+        self.add_input(name='code_poses', ndim=1, dtype='int32')
 
         self.add_node(SparseEmbedding(self.nb_base+1, embed_dims, weights=init_embeddings),
                       name='embedding', inputs=('codes_flat', 'sents_shape'))
         self.add_node(LangLSTMLayer(embed_dims, output_dim=context_dims), name='encoder', inputs='embedding')
         # seq.add(Dropout(0.5))
-        self.add_node(PartialSoftmaxV7(input_dim=context_dims, base_size=self.nb_base+1, vocab_size=self.vocab_size),
-                      name='part_prob', inputs=('idxes', 'sparse_codes', 'encoder'))
+        self.add_node(PartialSoftmaxV7(input_dim=context_dims, base_size=self.nb_base+1, vocab_size=self.vocab_size,
+                                       shared_noise=shared_negative),
+                      name='part_prob', inputs=('idxes', 'sparse_codes', 'code_poses', 'encoder'))
         self.add_node(Dense(input_dim=context_dims, output_dim=1, activation='exponential'),
                       name='normalizer', inputs='encoder')
         self.add_node(LookupProb(negprob_table), name='lookup_prob', inputs='idxes')
@@ -2307,7 +2240,6 @@ class NCELangModelV7(Graph, LangModel):
         neg_prob_trn = neg_prob_layer.get_output(train=True) * self.nb_negative
         pos_prob_tst = pos_prob_layer.get_output(train=False)
         neg_prob_tst = neg_prob_layer.get_output(train=False) * self.nb_negative
-        pre_prob_tst = pre_prob_layer.get_output(train=False)
 
         nrm_const = normlzer_layer.get_output(train=True)
         nrm_const = T.reshape(nrm_const, (nrm_const.shape[0], nrm_const.shape[1]))
@@ -2331,9 +2263,10 @@ class NCELangModelV7(Graph, LangModel):
 
         input0 = self.inputs['idxes'].get_output(True)
         input1 = self.nodes['sparse_codes'].get_output(True)
+        input2 = self.inputs['code_poses'].get_output(True)
 
         true_labels = input0[0]
-        encode_len, nb_words = self.encode_length(true_labels, pre_prob_tst)
+        encode_len, nb_words = self.encode_length_blocked(true_labels, pre_prob_layer)
 
         train_loss = -y_train
         test_loss = -y_test
@@ -2342,10 +2275,11 @@ class NCELangModelV7(Graph, LangModel):
         updates = self.optimizer.get_updates(self.params, self.constraints, train_loss)
         updates += self.updates
 
-        self._train = theano.function([input0, input1], outputs=train_loss,
+        self._train = theano.function([input0, input1, input2], outputs=train_loss,
                                       updates=updates)
-        self._test = theano.function([input0, input1],
+        self._test = theano.function([input0, input1, input2],
                                      outputs=[test_loss, encode_len, nb_words])
+        self.compile_decode()
 
         self._train.out_labels = ('loss', )
         self._test.out_labels = ('loss', 'encode_len', 'nb_words')
@@ -2374,28 +2308,21 @@ class NCELangModelV7(Graph, LangModel):
 
         self._test.summarize_outputs = __summarize_outputs
 
-    def negative_sample(self, X, order=0):
+    def negative_sample(self, X, order=0, batch=None):
         if order == 0:
             ret = np.empty(shape=(self.nb_negative+1,) + X.shape, dtype=X.dtype)
             ret[0] = X
-            ret[1:] = self.sampler.sample(shape=ret[1:].shape)
+            self.sample_noise(ret, batch)
         else:
             raise NotImplementedError('Only support order=0 now')
         return ret
 
-    def _loop_train(self, data, batch_size):
-        nb = data.shape[1]
-        nb_words = data[0].size
-        loss = 0.0
-        for start in xrange(0, nb, batch_size):
-            end = start + batch_size
-            ins0 = data[:, start:end]
-            ins = self.prepare_input(ins0)
-            loss_ = self._train(*ins)
-            loss += loss_ * ins0[0].size
+    def encode_chunk(self, chunk, batch_size, words_per_batch=None, chunk_id=None):
+        return self.prepare_batches(self.negative_sample(chunk, batch=chunk_id), batch_size,
+                                    words_per_batch)
 
-        loss /= nb_words
-        return loss
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        return self.train_batches(data)
 
     def prepare_input(self, data):
         """
@@ -2403,82 +2330,19 @@ class NCELangModelV7(Graph, LangModel):
         :type data: numpy.ndarray
         :return:
         """
-        x = [None] * 2
+        x = [None] * 3
         x[0] = data
-        idx = x[0].ravel()
-        x[1] = self.sparse_coding[idx]
+        # the codes of the labels come first and as they are, the embedding reads them
+        rows, x[2] = unique_rows(self.label_code_rows(x[0]), x[0][0].size)
+        x[1] = gather_rows(self.sparse_coding, rows)
         return x
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size, log_file)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            # loss, ce, nb_wrd = self._train(chunk, chunk)
-            x = self.negative_sample(chunk)
-            loss = self._loop_train(x, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.1f - speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, speed1, speed2))
-            log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                log_file.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size, log_file)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
-
-        log_file.close()
+              validation_interval=1800, log_file=None, words_per_batch=None, prefetch_size=4):
+        self.words_per_batch = words_per_batch
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file, words_per_batch, prefetch_size).run()
 
     def validation(self, val_sents, batch_size, log_file=None):
         """
@@ -2490,9 +2354,11 @@ class NCELangModelV7(Graph, LangModel):
         nb_words = 0.
         loss = 0.0
 
+        self.decode_output_weights()
         for sents in val_sents:
             x = [self.negative_sample(sents)]
-            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size)
+            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size,
+                                                          words_per_batch=self.words_per_batch)
             nb_words += nb_words_
             code_len += code_len_
             loss += loss_ * nb_words_
@@ -2504,7 +2370,9 @@ class NCELangModelV7(Graph, LangModel):
 
         return loss, ppl
 
-    def _test_loop(self, f, ins, batch_size=128, verbose=0):
+    def _test_loop(self, f, ins, batch_size=128, verbose=0, words_per_batch=None):
+        self.ensure_decoded()
+        batch_size = token_batch_size(batch_size, ins[0].shape[-1], words_per_batch)
         nb_sample = ins[0].shape[1]
         outs = [[] for _ in range(f.n_returned_outputs)]
         batch_info = []
@@ -2525,7 +2393,7 @@ class NCELangModelV8(Graph, LangModel):
     """ extend V4, bias for softmax not compressed.
     """
     def __init__(self, sparse_coding, nb_negative, embed_dims=128, context_dims=128,
-                 init_embeddings=None, negprob_table=None, optimizer='adam'):
+                 init_embeddings=None, negprob_table=None, optimizer='adam', shared_negative=False):
         super(NCELangModelV8, self).__init__(weighted_inputs=False)
         vocab_size = sparse_coding.shape[0]  # the extra word is for OOV
         self.nb_base = sparse_coding.shape[1] - 1
@@ -2533,6 +2401,7 @@ class NCELangModelV8(Graph, LangModel):
         self.embed_dim = embed_dims
         self.optimizer = optimizers.get(optimizer)
         self.nb_negative = nb_negative
+        self.shared_negative = shared_negative
         self.loss = categorical_crossentropy
         self.loss_fnc = objective_fnc(self.loss)
         self.sparse_coding = sparse_coding
@@ -2557,13 +2426,14 @@ class NCELangModelV8(Graph, LangModel):
         self.add_node(Identity(inputs={True: pos_codes, False: pos_codes}), name='codes_flat')
         self.add_node(Identity(inputs={True: shape, False: shape}), name='sents_shape')
         self.add_node(Identity(inputs={True: codes, False: codes}), name='sparse_codes')
+        self.add_input(name='code_poses', ndim=1, dtype='int32')
 
         self.add_node(SparseEmbedding(self.nb_base+1, embed_dims, weights=init_embeddings),
                       name='embedding', inputs=('codes_flat', 'sents_shape'))
         self.add_node(LangLSTMLayer(embed_dims, output_dim=context_dims), name='encoder', inputs='embedding')
         # seq.add(Dropout(0.5))
-        self.add_node(PartialSoftmaxV8(input_dim=context_dims, base_size=self.nb_base+1),
-                      name='part_prob', inputs=('idxes', 'sparse_codes', 'encoder'))
+        self.add_node(PartialSoftmaxV8(input_dim=context_dims, base_size=self.nb_base+1, shared_noise=shared_negative),
+                      name='part_prob', inputs=('idxes', 'sparse_codes', 'code_poses', 'encoder'))
         self.add_node(Dense(input_dim=context_dims, output_dim=1, activation='exponential'),
                       name='normalizer', inputs='encoder')
         self.add_node(LookupProb(negprob_table), name='lookup_prob', inputs='idxes')
@@ -2593,7 +2463,6 @@ class NCELangModelV8(Graph, LangModel):
         neg_prob_trn = neg_prob_layer.get_output(train=True) * self.nb_negative
         pos_prob_tst = pos_prob_layer.get_output(train=False)
         neg_prob_tst = neg_prob_layer.get_output(train=False) * self.nb_negative
-        pre_prob_tst = pre_prob_layer.get_output(train=False)
 
         nrm_const = normlzer_layer.get_output(train=True)
         nrm_const = T.reshape(nrm_const, (nrm_const.shape[0], nrm_const.shape[1]))
@@ -2617,9 +2486,10 @@ class NCELangModelV8(Graph, LangModel):
 
         input0 = self.inputs['idxes'].get_output(True)
         input1 = self.nodes['sparse_codes'].get_output(True)
+        input2 = self.inputs['code_poses'].get_output(True)
 
         true_labels = input0[0]
-        encode_len, nb_words = self.encode_length(true_labels, pre_prob_tst)
+        encode_len, nb_words = self.encode_length_blocked(true_labels, pre_prob_layer)
 
         train_loss = -y_train
         test_loss = -y_test
@@ -2628,10 +2498,11 @@ class NCELangModelV8(Graph, LangModel):
         updates = self.optimizer.get_updates(self.params, self.constraints, train_loss)
         updates += self.updates
 
-        self._train = theano.function([input0, input1], outputs=train_loss,
+        self._train = theano.function([input0, input1, input2], outputs=train_loss,
                                       updates=updates)
-        self._test = theano.function([input0, input1],
+        self._test = theano.function([input0, input1, input2],
                                      outputs=[test_loss, encode_len, nb_words])
+        self.compile_decode()
 
         self._train.out_labels = ('loss', )
         self._test.out_labels = ('loss', 'encode_len', 'nb_words')
@@ -2660,28 +2531,21 @@ class NCELangModelV8(Graph, LangModel):
 
         self._test.summarize_outputs = __summarize_outputs
 
-    def negative_sample(self, X, order=0):
+    def negative_sample(self, X, order=0, batch=None):
         if order == 0:
             ret = np.empty(shape=(self.nb_negative+1,) + X.shape, dtype=X.dtype)
             ret[0] = X
-            ret[1:] = self.sampler.sample(shape=ret[1:].shape)
+            self.sample_noise(ret, batch)
         else:
             raise NotImplementedError('Only support order=0 now')
         return ret
 
-    def _loop_train(self, data, batch_size):
-        nb = data.shape[1]
-        nb_words = data[0].size
-        loss = 0.0
-        for start in xrange(0, nb, batch_size):
-            end = start + batch_size
-            ins0 = data[:, start:end]
-            ins = self.prepare_input(ins0)
-            loss_ = self._train(*ins)
-            loss += loss_ * ins0[0].size
+    def encode_chunk(self, chunk, batch_size, words_per_batch=None, chunk_id=None):
+        return self.prepare_batches(self.negative_sample(chunk, batch=chunk_id), batch_size,
+                                    words_per_batch)
 
-        loss /= nb_words
-        return loss
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        return self.train_batches(data)
 
     def prepare_input(self, data):
         """
@@ -2689,82 +2553,19 @@ class NCELangModelV8(Graph, LangModel):
         :type data: numpy.ndarray
         :return:
         """
-        x = [None] * 2
+        x = [None] * 3
         x[0] = data
-        idx = x[0].ravel()
-        x[1] = self.sparse_coding[idx]
+        # the codes of the labels come first and as they are, the embedding reads them
+        rows, x[2] = unique_rows(self.label_code_rows(x[0]), x[0][0].size)
+        x[1] = gather_rows(self.sparse_coding, rows)
         return x
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size, log_file)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            # loss, ce, nb_wrd = self._train(chunk, chunk)
-            x = self.negative_sample(chunk)
-            loss = self._loop_train(x, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.1f - speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, speed1, speed2))
-            log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                log_file.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size, log_file)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
-
-        log_file.close()
+              validation_interval=1800, log_file=None, words_per_batch=None, prefetch_size=4):
+        self.words_per_batch = words_per_batch
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file, words_per_batch, prefetch_size).run()
 
     def validation(self, val_sents, batch_size, log_file=None):
         """
@@ -2776,9 +2577,11 @@ class NCELangModelV8(Graph, LangModel):
         nb_words = 0.
         loss = 0.0
 
+        self.decode_output_weights()
         for sents in val_sents:
             x = [self.negative_sample(sents)]
-            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size)
+            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size,
+                                                          words_per_batch=self.words_per_batch)
             nb_words += nb_words_
             code_len += code_len_
             loss += loss_ * nb_words_
@@ -2790,7 +2593,9 @@ class NCELangModelV8(Graph, LangModel):
 
         return loss, ppl
 
-    def _test_loop(self, f, ins, batch_size=128, verbose=0):
+    def _test_loop(self, f, ins, batch_size=128, verbose=0, words_per_batch=None):
+        self.ensure_decoded()
+        batch_size = token_batch_size(batch_size, ins[0].shape[-1], words_per_batch)
         nb_sample = ins[0].shape[1]
         outs = [[] for _ in range(f.n_returned_outputs)]
         batch_info = []
@@ -2913,7 +2718,11 @@ class TreeLangModel(Graph, LangModel):
         ins[2] = self.word2bitstr[ins[0]]
         return ins
 
-    def _loop_train(self, data, batch_size):
+    def encode_chunk(self, chunk, batch_size, words_per_batch=None, chunk_id=None):
+        return chunk
+
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, data.shape[-1], words_per_batch)
         nb = data.shape[0]
         loss = 0.0
         X = self.prepare_input(data)
@@ -2927,10 +2736,11 @@ class TreeLangModel(Graph, LangModel):
         return loss
 
     @staticmethod
-    def _test_loop(f, ins, batch_size=128, verbose=0):
+    def _test_loop(f, ins, batch_size=128, verbose=0, words_per_batch=None):
         """
             Abstract method to loop over some data in batches.
         """
+        batch_size = token_batch_size(batch_size, ins[0].shape[-1], words_per_batch)
         nb_sample = len(ins[0])
         outs = [[] for _ in range(f.n_returned_outputs)]
         batch_info = []
@@ -2959,7 +2769,8 @@ class TreeLangModel(Graph, LangModel):
         for sents in val_sents:
             nb_sents += sents.shape[0]
             x = self.prepare_input(sents)
-            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size)
+            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size,
+                                                          words_per_batch=self.words_per_batch)
             nb_words += nb_words_
             code_len += code_len_
             loss += loss_ * sents.shape[0]
@@ -2973,72 +2784,10 @@ class TreeLangModel(Graph, LangModel):
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size, log_file)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            # loss, ce, nb_wrd = self._train(chunk, chunk)
-            loss = self._loop_train(chunk, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.1f - speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, speed1, speed2))
-            log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-
-            if end_ > next_val_time:
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                log_file.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size, log_file)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
-
-        log_file.close()
+              validation_interval=1800, log_file=None, words_per_batch=None, prefetch_size=4):
+        self.words_per_batch = words_per_batch
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file, words_per_batch, prefetch_size).run()
 
 
 class LBLangModelV1(Graph, LangModel):
@@ -3208,7 +2957,11 @@ class LBLangModelV1(Graph, LangModel):
 
         self.fit = self._fit_unweighted
 
-    def _loop_train(self, data, batch_size):
+    def encode_chunk(self, chunk, batch_size, words_per_batch=None, chunk_id=None):
+        return self.prepare_input(chunk)
+
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, 1, words_per_batch)
         nb_words = data[0].shape[0]
         # loss, nrm, cnrm = 0.0, 0.0, 0.0
         loss = 0.0
@@ -3249,73 +3002,10 @@ class LBLangModelV1(Graph, LangModel):
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin-sample.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size, log_file)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            x = self.prepare_input(chunk)
-            # loss, nrm, cnrm = self._loop_train(x, batch_size)
-            loss, ppl = self._loop_train(x, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.3f - ppl: %6.2f speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, ppl, speed1, speed2))
-            log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                logger.info('Training finished. Evaluating ...')
-                log_file.info('Training finished. Evaluating ...')
-                self.validation(val_sents, batch_size, log_file)
-                if save_path is not None:
-                    self.save_params(save_path)
-                break
-        log_file.close()
+              validation_interval=1800, log_file=None, words_per_batch=None, prefetch_size=4):
+        self.words_per_batch = words_per_batch
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file, words_per_batch, prefetch_size).run()
 
     def validation(self, val_sents, batch_size, log_file=None):
         """
@@ -3329,7 +3019,8 @@ class LBLangModelV1(Graph, LangModel):
 
         for sents in val_sents:
             x = self.prepare_input(sents)
-            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size)
+            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size,
+                                                          words_per_batch=self.words_per_batch)
             nb_words += nb_words_
             code_len += code_len_
             loss += loss_ * nb_words_
@@ -3346,7 +3037,8 @@ class LBLangModelV1(Graph, LangModel):
         return loss, ppl
 
     @staticmethod
-    def _test_loop(f, ins, batch_size=128, verbose=0):
+    def _test_loop(f, ins, batch_size=128, verbose=0, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, 1, words_per_batch)
         nb_sample = ins[0].shape[0]
         outs = [[] for _ in range(f.n_returned_outputs)]
         batch_info = []
@@ -3365,9 +3057,10 @@ class LBLangModelV1(Graph, LangModel):
 class LBLangModelV2(Graph, LangModel):
     # the standard LBL language model with sparse coding extension
     def __init__(self, sparse_coding, context_size, nb_negative, embed_dims=200, init_embeddings=None,
-                 negprob_table=None, optimizer='adam'):
+                 negprob_table=None, optimizer='adam', shared_negative=False):
         super(LBLangModelV2, self).__init__()
         self.nb_negative = nb_negative
+        self.shared_negative = shared_negative
         self.sparse_coding = sparse_coding
         vocab_size = sparse_coding.shape[0]  # the extra word is for OOV
         self.nb_base = sparse_coding.shape[1] - 1
@@ -3398,6 +3091,7 @@ class LBLangModelV2(Graph, LangModel):
         self.add_input(name='ngrams', ndim=2, dtype='int32')          # (ns, c), where c is the context size
         self.add_input(name='label_with_neg', ndim=2, dtype='int32')  # (k+1, ns)
         self.add_input(name='lookup_prob', ndim=2, dtype=floatX)      # (k+1, ns)
+        self.add_input(name='label_poses', ndim=1, dtype='int32')     # (ns*(k+1), ), see unique_rows
 
         cntx_codes = tsp.csr_matrix('cntx-codes', dtype=floatX)
         label_codes = tsp.csr_matrix('label_codes', dtype=floatX)
@@ -3419,8 +3113,8 @@ class LBLangModelV2(Graph, LangModel):
         composer_node.get_output = lambda train: node_get_output(composer_node, train)
         self.add_node(composer_node, name='context_vec', inputs='reshape')
         self.add_node(PartialSoftmaxLBL(base_size=self.nb_base+1,
-                                        word_vecs=self.nodes['embedding'].W),
-                      name='part_prob', inputs=('label_with_neg', 'label_codes_flat', 'context_vec'))
+                                        word_vecs=self.nodes['embedding'].W, shared_noise=shared_negative),
+                      name='part_prob', inputs=('label_with_neg', 'label_codes_flat', 'label_poses', 'context_vec'))
 
         # self.add_node(LookupProb(negprob_table), name='lookup_prob', inputs='label_with_neg')
         self.add_node(SharedWeightsDense(self.nodes['part_prob'].W,
@@ -3517,6 +3211,7 @@ class LBLangModelV2(Graph, LangModel):
         input2 = self.nodes['cntx_codes_flat'].get_output(True)
         input3 = self.nodes['label_codes_flat'].get_output(True)
         input4 = self.inputs['lookup_prob'].get_output(True)
+        input5 = self.inputs['label_poses'].get_output(True)
 
         true_labels = input1[0]
         encode_len, nb_words = self.encode_length(true_labels, pre_prob_tst)
@@ -3531,12 +3226,12 @@ class LBLangModelV2(Graph, LangModel):
         updates = self.optimizer.get_updates(self.params, self.constraints, train_loss)
         updates += self.updates
 
-        train_ins = [input0, input1, input2, input3, input4]
-        test_ins = [input0, input1, input2, input3, input4]
+        train_ins = [input0, input1, input2, input3, input4, input5]
+        test_ins = [input0, input1, input2, input3, input4, input5]
 
         self._train = theano.function(train_ins, train_loss, updates=updates)
         self._train.out_labels = ['loss', 'encode_len', 'nb_words']
-        self._test = theano.function(test_ins, [test_loss, encode_len, nb_words])
+        self.compile_snapshot_test(test_ins, [test_loss, encode_len, nb_words])
         self._test.out_labels = ['loss', 'encode_len', 'nb_words']
 
         self.all_metrics = ['loss', 'ppl', 'val_loss', 'val_ppl']
@@ -3641,171 +3336,13 @@ class LBLangModelV2(Graph, LangModel):
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin-sample.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None, nb_data_workers=6, data_pool_size=10):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        data_workers = []
-        pre_data = Queue(data_pool_size)
-        post_data = Queue(data_pool_size*30)
-        self.jobs_pools = pre_data
-        self.jobs_pools_post = post_data
-
-        xk = Array(ctypes.c_int32, np.arange(self.vocab_size, dtype='int32'), lock=False)
-        # a_type = ctypes.c_double if str(self.neg_prob_table.dtype) == 'float64' else ctypes.c_float
-        assert str(self.neg_prob_table.dtype) == 'float32'
-        pk = Array(ctypes.c_float, self.neg_prob_table, lock=False)
-
-        # a_type = ctypes.c_double if str(self.sparse_coding.dtype) == 'float64' else ctypes.c_float
-        assert str(self.sparse_coding.dtype) == 'float32'
-        sp_data = Array(ctypes.c_float, self.sparse_coding.data, lock=False)
-        assert str(self.sparse_coding.indices.dtype) == 'int32'
-        assert str(self.sparse_coding.indptr.dtype) == 'int32'
-        sp_indices = Array(ctypes.c_int32, self.sparse_coding.indices, lock=False)
-        sp_indptr = Array(ctypes.c_int32, self.sparse_coding.indptr, lock=False)
-
-        # a_type = ctypes.c_double if str(self.sparse_coding_pad.dtype) == 'float64' else ctypes.c_float
-        assert str(self.sparse_coding_pad.dtype) == 'float32'
-        sp_pad_data = Array(ctypes.c_float, self.sparse_coding_pad.data, lock=False)
-        assert str(self.sparse_coding_pad.indices.dtype) == 'int32'
-        assert str(self.sparse_coding_pad.indptr.dtype) == 'int32'
-        sp_pad_indices = Array(ctypes.c_int32, self.sparse_coding_pad.indices, lock=False)
-        sp_pad_indptr = Array(ctypes.c_int32, self.sparse_coding_pad.indptr, lock=False)
-
-        for _ in range(nb_data_workers):
-            # prepare_input(sents_queue, jobs_pool, all_finished,
-            #       vocab_size, context_size, batch_size, nb_negative, xk, pk,
-            #       sp_data, sp_indices, sp_indptr, sp_shape,
-            #       sp_pad_data, sp_pad_indices, sp_pad_inptr, sp_pad_shape):
-            p = Process(target=prepare_input, args=(pre_data, post_data, self.all_finished,
-                                                    self.vocab_size, self.context_size, batch_size, self.nb_negative,
-                                                    xk, pk, sp_data, sp_indices, sp_indptr, self.sparse_coding.shape,
-                                                    sp_pad_data, sp_pad_indices, sp_pad_indptr, self.sparse_coding_pad.shape))
-            p.daemon = True
-            data_workers.append(p)
-            p.start()
-
-        self.validation(train_val_sents, log_file)
-
-        def chunk_trn_generator():
-            for sents in sent_gen:
-                if self.trn_finished.is_set():
-                    break
-
-                mask = (sents > max_vocab)
-                sents[mask] = max_vocab
-                chunk = chunk_sentences(sentences, sents, batch_size)
-                if chunk is None:
-                    continue
-                self.in_training_phase.wait()
-                pre_data.put(chunk)
-
-            self.trn_finished.set()
-            logger.debug('trn data finished')
-
-        gen_chunk_thread = Thread(target=chunk_trn_generator)
-        gen_chunk_thread.setDaemon(True)
-        gen_chunk_thread.start()
-
-        loss = 0.0
-        nb_chunk = 0.0
-        nb_cyc = 0
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        self.in_training_phase.set()
-
-        while not self.trn_finished.is_set() or not post_data.empty():
-            ins = post_data.get()
-            # if ins is None:
-            #     if nb_none == nb_data_workers:
-            #         break
-            #     else:
-            #         nb_none += 1
-            #         continue
-            loss_ = self._train(*ins)
-            nb_cyc += 1
-            nb_cyc %= 20
-            nb_words_trained += ins[0].shape[0]
-            nb_chunk += ins[0].shape[0]
-            loss += loss_ * ins[0].shape[0]
-            if nb_cyc == 0:
-                end_ = time()
-                elapsed = float(end_ - start_)
-                speed2 = nb_words_trained/elapsed
-                eta = (train_nb_words - nb_words_trained) / speed2
-                eta_h = int(math.floor(eta/3600))
-                eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-                loss /= nb_chunk
-                logger.info('%s:Train - ETA: %02d:%02d - loss: %5.3f - speed: %.1f words/s' %
-                            (self.__class__.__name__, eta_h, eta_m, loss, speed2))
-                log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-                nb_chunk = 0.0
-                loss = 0.0
-
-                if end_ > next_val_time:
-                    logger.debug('pausing training data generation and consuming all generated data')
-                    self.in_training_phase.clear()
-                    while not self.jobs_pools_post.empty() or not self.jobs_pools.empty():
-                        ins = self.jobs_pools_post.get()
-                        self._train(*ins)
-                    logger.debug('Before validation')
-                    # noinspection PyUnresolvedReferences
-                    self.validation(train_val_sents, log_file)
-                    logger.debug('END validation. resume training data generation')
-                    self.in_training_phase.set()
-                    next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                self.trn_finished.set()
-                break
-
-        # consume all the produced tasks. The data generation thread will automatically shutdown, for the trn_finished
-        # event is set.
-        self.in_training_phase.set()  # make sure it is not blocking
-        while not self.jobs_pools_post.empty() or not self.jobs_pools.empty():
-            ins = self.jobs_pools_post.get()
-            self._train(*ins)
-
-        # Now the training data is consumed out. Let's evaluate...
-        logger.info('Training finished. Evaluating ...')
-        log_file.info('Training finished. Evaluating ...')
-        self.validation(val_sents, log_file)
-        self.all_finished.set()  # signal the all_finished event to shutdown all worker processes.
-        if save_path is not None:
-            self.save_params(save_path)
-        log_file.close()
-
-        for _ in range(10):
-            flags = map(Process.is_alive, data_workers)
-            if not any(flags):
-                break
-            for flag, p in zip(flags, data_workers):
-                if flag is True:
-                    logger.info("%s is alive" % p.name)
-            sleep(5)
+              validation_interval=1800, log_file=None, nb_data_workers=6, data_pool_size=10, words_per_batch=None,
+              nb_val_workers=1):
+        self.words_per_batch = words_per_batch
+        WorkerPoolTrainer(self, data_file, nb_data_workers, data_pool_size, nb_val_workers, save_path=save_path,
+                          batch_size=batch_size, train_nb_words=train_nb_words, val_nb_words=val_nb_words,
+                          train_val_nb=train_val_nb, validation_interval=validation_interval, log_file=log_file,
+                          words_per_batch=words_per_batch).run()
 
     def validation(self, val_sents, log_file=None):
         """
@@ -3813,36 +3350,8 @@ class LBLangModelV2(Graph, LangModel):
         :type val_sents: a list, each element a ndarray
         :return: tuple
         """
-        code_len = 0.
-        nb_words = 0.
-        loss = 0.0
-
-        def chunk_val_generator():
-            for sents in val_sents:
-                self.jobs_pools.put(sents)
-
-        gen_chunk_thread = Thread(target=chunk_val_generator)
-        gen_chunk_thread.setDaemon(True)
-        gen_chunk_thread.start()
-
-        logger.debug('begin val loop')
-        while True:
-            ins = self.jobs_pools_post.get()
-            loss_, code_len_, nb_words_ = self._test(*ins)
-            nb_words += nb_words_
-            code_len += code_len_
-            loss += loss_ * nb_words_
-            if self.jobs_pools_post.empty() and self.jobs_pools.empty():
-                break
-        logger.debug('end val loop')
-
-        loss /= nb_words
-        ppl = math.exp(code_len/nb_words)
-
-        logger.info('%s:Val val_loss: %.2f - val_ppl: %.2f' % (self.__class__.__name__, loss, ppl))
-        log_file.info('%s:Val val_loss: %.6f - val_ppl: %.6f' % (self.__class__.__name__, loss, ppl))
-
-        return loss, ppl
+        self.snapshot_params()
+        return self.validate_snapshot(val_sents, log_file)
 
     # def _test_loop(self, f, ins, batch_size=128, verbose=0):
     #     nb_sample = ins[0].shape[0]
@@ -3906,12 +3415,13 @@ class LBLangModelV2(Graph, LangModel):
 class LBLangModelV3(Graph, LangModel):
     # the standard LBL language model with sparse coding extension, ZRegression
     def __init__(self, sparse_coding, context_size, nb_negative, embed_dims=200, max_part_sum=0.7, alpha=1.0, beta=1.,
-                 init_embeddings=None, negprob_table=None, optimizer='adam'):
+                 init_embeddings=None, negprob_table=None, optimizer='adam', shared_negative=False):
         super(LBLangModelV3, self).__init__()
         self.alpha = alpha
         self.beta = beta
         self.max_part_sum = max_part_sum
         self.nb_negative = nb_negative
+        self.shared_negative = shared_negative
         self.sparse_coding = sparse_coding
         vocab_size = sparse_coding.shape[0]  # the extra word is for OOV
         self.nb_base = sparse_coding.shape[1] - 1
@@ -3944,6 +3454,7 @@ class LBLangModelV3(Graph, LangModel):
         self.add_input(name='ngrams', ndim=2, dtype='int32')          # (ns, c), where c is the context size
         self.add_input(name='label_with_neg', ndim=2, dtype='int32')  # (k+1, ns)
         self.add_input(name='lookup_prob', ndim=2, dtype=floatX)      # (k+1, ns)
+        self.add_input(name='label_poses', ndim=1, dtype='int32')     # (ns*(k+1), ), see unique_rows
 
         cntx_codes = tsp.csr_matrix('cntx-codes', dtype=floatX)
         label_codes = tsp.csr_matrix('label_codes', dtype=floatX)
@@ -3964,8 +3475,8 @@ class LBLangModelV3(Graph, LangModel):
         composer_node.get_output = lambda train: node_get_output(composer_node, train)
         self.add_node(composer_node, name='context_vec', inputs='reshape')
         self.add_node(PartialSoftmaxLBL(base_size=self.nb_base+1,
-                                        word_vecs=self.nodes['embedding'].W),
-                      name='part_prob', inputs=('label_with_neg', 'label_codes_flat', 'context_vec'))
+                                        word_vecs=self.nodes['embedding'].W, shared_noise=shared_negative),
+                      name='part_prob', inputs=('label_with_neg', 'label_codes_flat', 'label_poses', 'context_vec'))
         self.add_node(Dense(input_dim=embed_dims, output_dim=embed_dims, activation='sigmoid'),
                       name='normalizer0', inputs='context_vec')
         self.add_node(Dense(input_dim=embed_dims, output_dim=1, activation='exponential'),
@@ -4090,6 +3601,7 @@ class LBLangModelV3(Graph, LangModel):
         input2 = self.nodes['cntx_codes_flat'].get_output(True)
         input3 = self.nodes['label_codes_flat'].get_output(True)
         input4 = self.inputs['lookup_prob'].get_output(True)
+        input5 = self.inputs['label_poses'].get_output(True)
 
         true_labels = input1[0]
         encode_len, nb_words = self.encode_length(true_labels, pre_prob_tst)
@@ -4104,12 +3616,12 @@ class LBLangModelV3(Graph, LangModel):
         updates = self.optimizer.get_updates(self.params, self.constraints, train_loss)
         updates += self.updates
 
-        train_ins = [input0, input1, input2, input3, input4]
-        test_ins = [input0, input1, input2, input3, input4]
+        train_ins = [input0, input1, input2, input3, input4, input5]
+        test_ins = [input0, input1, input2, input3, input4, input5]
 
         self._train = theano.function(train_ins, [train_loss, T.max(part_sum)], updates=updates)
-        self._train.out_labels = ['loss']
-        self._test = theano.function(test_ins, [test_loss, encode_len, nb_words])
+        self._train.out_labels = ['loss', 'part_sum']
+        self.compile_snapshot_test(test_ins, [test_loss, encode_len, nb_words])
         self._test.out_labels = ['loss', 'encode_len', 'nb_words']
 
         self.all_metrics = ['loss', 'ppl', 'val_loss', 'val_ppl']
@@ -4129,179 +3641,13 @@ class LBLangModelV3(Graph, LangModel):
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin-sample.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None, nb_data_workers=6, data_pool_size=10):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        data_workers = []
-        pre_data = Queue(data_pool_size)
-        post_data = Queue(data_pool_size*30)
-        self.jobs_pools = pre_data
-        self.jobs_pools_post = post_data
-
-        xk = Array(ctypes.c_int32, np.arange(self.vocab_size, dtype='int32'), lock=False)
-        # a_type = ctypes.c_double if str(self.neg_prob_table.dtype) == 'float64' else ctypes.c_float
-        assert str(self.neg_prob_table.dtype) == 'float32'
-        pk = Array(ctypes.c_float, self.neg_prob_table, lock=False)
-
-        # a_type = ctypes.c_double if str(self.sparse_coding.dtype) == 'float64' else ctypes.c_float
-        assert str(self.sparse_coding.dtype) == 'float32'
-        sp_data = Array(ctypes.c_float, self.sparse_coding.data, lock=False)
-        assert str(self.sparse_coding.indices.dtype) == 'int32'
-        assert str(self.sparse_coding.indptr.dtype) == 'int32'
-        sp_indices = Array(ctypes.c_int32, self.sparse_coding.indices, lock=False)
-        sp_indptr = Array(ctypes.c_int32, self.sparse_coding.indptr, lock=False)
-
-        # a_type = ctypes.c_double if str(self.sparse_coding_pad.dtype) == 'float64' else ctypes.c_float
-        assert str(self.sparse_coding_pad.dtype) == 'float32'
-        sp_pad_data = Array(ctypes.c_float, self.sparse_coding_pad.data, lock=False)
-        assert str(self.sparse_coding_pad.indices.dtype) == 'int32'
-        assert str(self.sparse_coding_pad.indptr.dtype) == 'int32'
-        sp_pad_indices = Array(ctypes.c_int32, self.sparse_coding_pad.indices, lock=False)
-        sp_pad_indptr = Array(ctypes.c_int32, self.sparse_coding_pad.indptr, lock=False)
-
-        for _ in range(nb_data_workers):
-            # prepare_input(sents_queue, jobs_pool, all_finished,
-            #       vocab_size, context_size, batch_size, nb_negative, xk, pk,
-            #       sp_data, sp_indices, sp_indptr, sp_shape,
-            #       sp_pad_data, sp_pad_indices, sp_pad_inptr, sp_pad_shape):
-            p = Process(target=prepare_input, args=(pre_data, post_data, self.all_finished,
-                                                    self.vocab_size, self.context_size, batch_size, self.nb_negative,
-                                                    xk, pk, sp_data, sp_indices, sp_indptr, self.sparse_coding.shape,
-                                                    sp_pad_data, sp_pad_indices, sp_pad_indptr, self.sparse_coding_pad.shape))
-            p.daemon = True
-            data_workers.append(p)
-            p.start()
-
-        self.in_training_phase.clear()
-        self.validation(train_val_sents, log_file)
-
-        def chunk_trn_generator():
-            for sents in sent_gen:
-                if self.trn_finished.is_set():
-                    break
-
-                mask = (sents > max_vocab)
-                sents[mask] = max_vocab
-                chunk = chunk_sentences(sentences, sents, batch_size)
-                if chunk is None:
-                    continue
-                self.in_training_phase.wait()
-                pre_data.put(chunk)
-
-            self.trn_finished.set()
-            logger.debug('trn data finished')
-
-        gen_chunk_thread = Thread(target=chunk_trn_generator)
-        gen_chunk_thread.setDaemon(True)
-        gen_chunk_thread.start()
-
-        loss = 0.0
-        nb_chunk = 0.0
-        nb_cyc = 0
-        part_sum = 0.0
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        next_report = start_ + 1.0
-        self.in_training_phase.set()
-
-        while not self.trn_finished.is_set() or not post_data.empty():
-            ins = post_data.get()
-            # if ins is None:
-            #     if nb_none == nb_data_workers:
-            #         break
-            #     else:
-            #         nb_none += 1
-            #         continue
-            loss_, part_sum_ = self._train(*ins)
-            nb_cyc += 1
-            nb_cyc %= 20
-            nb_words_trained += ins[0].shape[0]
-            nb_chunk += ins[0].shape[0]
-            loss += loss_ * ins[0].shape[0]
-            part_sum = max(part_sum_, part_sum)
-            if nb_cyc == 0:
-                end_ = time()
-                if end_ >= next_report:
-                    elapsed = float(end_ - start_)
-                    speed2 = nb_words_trained/elapsed
-                    eta = (train_nb_words - nb_words_trained) / speed2
-                    eta_h = int(math.floor(eta/3600))
-                    eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-                    loss /= nb_chunk
-                    logger.info('%s:Train - ETA: %02d:%02d - loss: %5.3f - part_sum: %.2f - speed: %.1f words/s' %
-                                (self.__class__.__name__, eta_h, eta_m, loss, part_sum, speed2))
-                    log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-                    nb_chunk = 0.0
-                    loss = 0.0
-                    part_sum = 0.0
-                    next_report = end_ + 1.0
-
-                if end_ > next_val_time:
-                    logger.debug('pausing training data generation and consuming all generated data')
-                    self.in_training_phase.clear()
-                    while not self.jobs_pools_post.empty() or not self.jobs_pools.empty():
-                        ins = self.jobs_pools_post.get()
-                        nb_words_trained += ins[0].shape[0]
-                        self._train(*ins)
-                    logger.debug('Before validation')
-                    # noinspection PyUnresolvedReferences
-                    self.validation(train_val_sents, log_file)
-                    logger.debug('END validation. resume training data generation')
-                    self.in_training_phase.set()
-                    next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                self.trn_finished.set()
-                break
-
-        # consume all the produced tasks. The data generation thread will automatically shutdown, for the trn_finished
-        # event is set.
-        self.in_training_phase.set()  # make sure it is not blocking
-        while not self.jobs_pools_post.empty() or not self.jobs_pools.empty():
-            ins = self.jobs_pools_post.get()
-            self._train(*ins)
-
-        # Now the training data is consumed out. Let's evaluate...
-        logger.info('Training finished. Evaluating ...')
-        log_file.info('Training finished. Evaluating ...')
-        self.validation(val_sents, log_file)
-        self.all_finished.set()  # signal the all_finished event to shutdown all worker processes.
-        if save_path is not None:
-            self.save_params(save_path)
-        log_file.close()
-
-        for _ in range(10):
-            flags = map(Process.is_alive, data_workers)
-            if not any(flags):
-                break
-            for flag, p in zip(flags, data_workers):
-                if flag is True:
-                    logger.info("%s is alive" % p.name)
-            sleep(5)
+              validation_interval=1800, log_file=None, nb_data_workers=6, data_pool_size=10, words_per_batch=None,
+              nb_val_workers=1):
+        self.words_per_batch = words_per_batch
+        WorkerPoolTrainer(self, data_file, nb_data_workers, data_pool_size, nb_val_workers, save_path=save_path,
+                          batch_size=batch_size, train_nb_words=train_nb_words, val_nb_words=val_nb_words,
+                          train_val_nb=train_val_nb, validation_interval=validation_interval, log_file=log_file,
+                          words_per_batch=words_per_batch).run()
 
     def validation(self, val_sents, log_file=None):
         """
@@ -4309,36 +3655,8 @@ class LBLangModelV3(Graph, LangModel):
         :type val_sents: a list, each element a ndarray
         :return: tuple
         """
-        code_len = 0.
-        nb_words = 0.
-        loss = 0.0
-
-        def chunk_val_generator():
-            for sents in val_sents:
-                self.jobs_pools.put(sents)
-
-        gen_chunk_thread = Thread(target=chunk_val_generator)
-        gen_chunk_thread.setDaemon(True)
-        gen_chunk_thread.start()
-
-        logger.debug('begin val loop')
-        while True:
-            ins = self.jobs_pools_post.get()
-            loss_, code_len_, nb_words_ = self._test(*ins)
-            nb_words += nb_words_
-            code_len += code_len_
-            loss += loss_ * nb_words_
-            if self.jobs_pools_post.empty() and self.jobs_pools.empty():
-                break
-        logger.debug('end val loop')
-
-        loss /= nb_words
-        ppl = math.exp(code_len/nb_words)
-
-        logger.info('%s:Val val_loss: %.2f - val_ppl: %.2f' % (self.__class__.__name__, loss, ppl))
-        log_file.info('%s:Val val_loss: %.6f - val_ppl: %.6f' % (self.__class__.__name__, loss, ppl))
-
-        return loss, ppl
+        self.snapshot_params()
+        return self.validate_snapshot(val_sents, log_file)
 
 
 class LBLangModelV4(Graph, LangModel):
@@ -4508,7 +3826,8 @@ class LBLangModelV4(Graph, LangModel):
         if order == 0:
             ret = np.empty(shape=(self.nb_negative+1,) + X.shape, dtype=X.dtype)
             ret[0] = X
-            ret[1:] = self.sampler.sample(shape=ret[1:].shape)
+            sampler = self.sampler if self.noise_pool is None else self.noise_pool
+            sampler.sample_into(ret[1:])
         else:
             raise NotImplementedError('Only support order=0 now')
         return ret
@@ -4541,73 +3860,10 @@ class LBLangModelV4(Graph, LangModel):
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin-sample.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_trained = 0.
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        self.validation(train_val_sents, batch_size, log_file)
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        for sents in sent_gen:
-            mask = (sents > max_vocab)
-            sents[mask] = max_vocab
-            chunk = chunk_sentences(sentences, sents, batch_size)
-            if chunk is None:
-                continue
-
-            x = self.prepare_input(chunk)
-            loss = self._loop_train(x, batch_size)
-            nb_trained += chunk.shape[0]
-            nb_words_trained += chunk.size
-            end_ = time()
-            elapsed = float(end_ - start_)
-            speed1 = nb_trained/elapsed
-            speed2 = nb_words_trained/elapsed
-            eta = (train_nb_words - nb_words_trained) / speed2
-            eta_h = int(math.floor(eta/3600))
-            eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-            logger.info('%s:Train - ETA: %02d:%02d - loss: %5.3f - speed: %.1f sent/s %.1f words/s' %
-                        (self.__class__.__name__, eta_h, eta_m, loss, speed1, speed2))
-            log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-
-            if end_ > next_val_time:
-                # noinspection PyUnresolvedReferences
-                self.validation(train_val_sents, batch_size, log_file)
-                next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                break
-
-        logger.info('Training finished. Evaluating ...')
-        log_file.info('Training finished. Evaluating ...')
-        self.validation(val_sents, batch_size, log_file)
-        if save_path is not None:
-            self.save_params(save_path)
-        log_file.close()
+              validation_interval=1800, log_file=None, words_per_batch=None, prefetch_size=4):
+        self.words_per_batch = words_per_batch
+        Trainer(self, data_file, save_path, batch_size, train_nb_words, val_nb_words, train_val_nb,
+                validation_interval, log_file, words_per_batch, prefetch_size).run()
 
     def validation(self, val_sents, batch_size, log_file=None):
         """
@@ -4621,7 +3877,8 @@ class LBLangModelV4(Graph, LangModel):
 
         for sents in val_sents:
             x = self.prepare_input(sents)
-            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size)
+            loss_, code_len_, nb_words_ = self._test_loop(self._test, x, batch_size,
+                                                          words_per_batch=self.words_per_batch)
             nb_words += nb_words_
             code_len += code_len_
             loss += loss_ * nb_words_
@@ -4637,7 +3894,11 @@ class LBLangModelV4(Graph, LangModel):
 
         return loss, ppl
 
-    def _loop_train(self, data, batch_size):
+    def encode_chunk(self, chunk, batch_size, words_per_batch=None, chunk_id=None):
+        return self.prepare_input(chunk)
+
+    def _loop_train(self, data, batch_size, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, 1, words_per_batch)
         nb_words = data[0].shape[0]
         loss = 0.0
         batches = make_batches(nb_words, batch_size)
@@ -4652,7 +3913,8 @@ class LBLangModelV4(Graph, LangModel):
         return loss
 
     @staticmethod
-    def _test_loop(f, ins, batch_size=128, verbose=0):
+    def _test_loop(f, ins, batch_size=128, verbose=0, words_per_batch=None):
+        batch_size = token_batch_size(batch_size, 1, words_per_batch)
         nb_sample = ins[0].shape[0]
         outs = [[] for _ in range(f.n_returned_outputs)]
         batch_info = []
@@ -4674,9 +3936,10 @@ class FFNNLangModel(Graph, LangModel):
     # the standard LBL language model with sparse coding extension, ZRegression
     def __init__(self, sparse_coding, context_size, nb_negative, embed_dims=200, context_dims=200,
                  max_part_sum=0.7, alpha=1.0,
-                 init_embeddings=None, negprob_table=None, optimizer='adam'):
+                 init_embeddings=None, negprob_table=None, optimizer='adam', shared_negative=False):
         super(FFNNLangModel, self).__init__()
         self.nb_negative = nb_negative
+        self.shared_negative = shared_negative
         self.alpha = alpha
         self.max_part_sum = max_part_sum
         self.sparse_coding = sparse_coding
@@ -4707,6 +3970,7 @@ class FFNNLangModel(Graph, LangModel):
         self.add_input(name='ngrams', ndim=2, dtype='int32')          # (ns, c), where c is the context size
         self.add_input(name='label_with_neg', ndim=2, dtype='int32')  # (k+1, ns)
         self.add_input(name='lookup_prob', ndim=2, dtype=floatX)      # (k+1, ns)
+        self.add_input(name='label_poses', ndim=1, dtype='int32')     # (ns*(k+1), ), see unique_rows
 
         cntx_codes = tsp.csr_matrix('cntx-codes', dtype=floatX)
         label_codes = tsp.csr_matrix('label_codes', dtype=floatX)
@@ -4724,8 +3988,8 @@ class FFNNLangModel(Graph, LangModel):
         self.add_node(EmbeddingParam(), name='embedding_param', inputs='embedding')
         self.add_node(Reshape(-1), name='reshape', inputs='embedding')
         self.add_node(Dense(context_size*embed_dims, context_dims), name='context_vec', inputs='reshape')
-        self.add_node(PartialSoftmaxFFNN(context_dims, base_size=self.nb_base+1),
-                      name='part_prob', inputs=('label_with_neg', 'label_codes_flat', 'context_vec'))
+        self.add_node(PartialSoftmaxFFNN(context_dims, base_size=self.nb_base+1, shared_noise=shared_negative),
+                      name='part_prob', inputs=('label_with_neg', 'label_codes_flat', 'label_poses', 'context_vec'))
         self.add_node(Dense(input_dim=context_dims, output_dim=context_dims, activation='sigmoid'),
                       name='normalizer1', inputs='context_vec')
         self.add_node(Dense(input_dim=context_dims, output_dim=1, activation='exponential'),
@@ -4834,6 +4098,7 @@ class FFNNLangModel(Graph, LangModel):
         input2 = self.nodes['cntx_codes_flat'].get_output(True)
         input3 = self.nodes['label_codes_flat'].get_output(True)
         input4 = self.inputs['lookup_prob'].get_output(True)
+        input5 = self.inputs['label_poses'].get_output(True)
 
         true_labels = input1[0]
         encode_len, nb_words = self.encode_length(true_labels, pre_prob_tst)
@@ -4848,12 +4113,12 @@ class FFNNLangModel(Graph, LangModel):
         updates = self.optimizer.get_updates(self.params, self.constraints, train_loss)
         updates += self.updates
 
-        train_ins = [input0, input1, input2, input3, input4]
-        test_ins = [input0, input1, input2, input3, input4]
+        train_ins = [input0, input1, input2, input3, input4, input5]
+        test_ins = [input0, input1, input2, input3, input4, input5]
 
         self._train = theano.function(train_ins, [train_loss, not_prob_loss], updates=updates)
-        self._train.out_labels = ['loss']
-        self._test = theano.function(test_ins, [test_loss, encode_len, nb_words])
+        self._train.out_labels = ['loss', 'mean_prob']
+        self.compile_snapshot_test(test_ins, [test_loss, encode_len, nb_words])
         self._test.out_labels = ['loss', 'encode_len', 'nb_words']
 
         self.all_metrics = ['loss', 'ppl', 'val_loss', 'val_ppl']
@@ -4873,179 +4138,13 @@ class FFNNLangModel(Graph, LangModel):
 
     def train(self, data_file='../data/corpus/wiki-sg-norm-lc-drop-bin-sample.bz2', save_path=None,
               batch_size=256, train_nb_words=100000000, val_nb_words=100000, train_val_nb=100000,
-              validation_interval=1800, log_file=None, nb_data_workers=6, data_pool_size=10):
-        opt_info = self.optimizer.get_config()
-        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
-
-        logger.info('training with file: %s' % data_file)
-        logger.info('training with batch size %d' % batch_size)
-        logger.info('training with %d words; validate with %d words during training; '
-                    'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        logger.info('validate every %f seconds' % float(validation_interval))
-        logger.info('optimizer: %s' % opt_info)
-
-        log_file = LogInfo(log_file)
-        log_file.info('training with file: %s' % data_file)
-        log_file.info('training with batch size %d' % batch_size)
-        log_file.info('training with %d words; validate with %d words during training; '
-                      'evaluate with %d words after training' % (train_nb_words, train_val_nb, val_nb_words))
-        log_file.info('validate every %f seconds' % float(validation_interval))
-        log_file.info('optimizer: %s' % opt_info)
-
-        sentences = [None for _ in range(MAX_SETN_LEN)]  # TODO: sentences longer than 64 are ignored.
-
-        max_vocab = self.vocab_size - 1
-        nb_words_trained = 0.0
-        sent_gen = grouped_sentences(data_file)
-        val_sents = self.get_val_data(sent_gen, val_nb_words)
-        train_val_sents = self.get_val_data(sent_gen, train_val_nb)
-
-        data_workers = []
-        pre_data = Queue(data_pool_size)
-        post_data = Queue(data_pool_size*30)
-        self.jobs_pools = pre_data
-        self.jobs_pools_post = post_data
-
-        xk = Array(ctypes.c_int32, np.arange(self.vocab_size, dtype='int32'), lock=False)
-        # a_type = ctypes.c_double if str(self.neg_prob_table.dtype) == 'float64' else ctypes.c_float
-        assert str(self.neg_prob_table.dtype) == 'float32'
-        pk = Array(ctypes.c_float, self.neg_prob_table, lock=False)
-
-        # a_type = ctypes.c_double if str(self.sparse_coding.dtype) == 'float64' else ctypes.c_float
-        assert str(self.sparse_coding.dtype) == 'float32'
-        sp_data = Array(ctypes.c_float, self.sparse_coding.data, lock=False)
-        assert str(self.sparse_coding.indices.dtype) == 'int32'
-        assert str(self.sparse_coding.indptr.dtype) == 'int32'
-        sp_indices = Array(ctypes.c_int32, self.sparse_coding.indices, lock=False)
-        sp_indptr = Array(ctypes.c_int32, self.sparse_coding.indptr, lock=False)
-
-        # a_type = ctypes.c_double if str(self.sparse_coding_pad.dtype) == 'float64' else ctypes.c_float
-        assert str(self.sparse_coding_pad.dtype) == 'float32'
-        sp_pad_data = Array(ctypes.c_float, self.sparse_coding_pad.data, lock=False)
-        assert str(self.sparse_coding_pad.indices.dtype) == 'int32'
-        assert str(self.sparse_coding_pad.indptr.dtype) == 'int32'
-        sp_pad_indices = Array(ctypes.c_int32, self.sparse_coding_pad.indices, lock=False)
-        sp_pad_indptr = Array(ctypes.c_int32, self.sparse_coding_pad.indptr, lock=False)
-
-        for _ in range(nb_data_workers):
-            # prepare_input(sents_queue, jobs_pool, all_finished,
-            #       vocab_size, context_size, batch_size, nb_negative, xk, pk,
-            #       sp_data, sp_indices, sp_indptr, sp_shape,
-            #       sp_pad_data, sp_pad_indices, sp_pad_inptr, sp_pad_shape):
-            p = Process(target=prepare_input, args=(pre_data, post_data, self.all_finished,
-                                                    self.vocab_size, self.context_size, batch_size, self.nb_negative,
-                                                    xk, pk, sp_data, sp_indices, sp_indptr, self.sparse_coding.shape,
-                                                    sp_pad_data, sp_pad_indices, sp_pad_indptr, self.sparse_coding_pad.shape))
-            p.daemon = True
-            data_workers.append(p)
-            p.start()
-
-        self.in_training_phase.clear()
-        self.validation(train_val_sents, log_file)
-
-        def chunk_trn_generator():
-            for sents in sent_gen:
-                if self.trn_finished.is_set():
-                    break
-
-                mask = (sents > max_vocab)
-                sents[mask] = max_vocab
-                chunk = chunk_sentences(sentences, sents, int(batch_size//10))
-                if chunk is None:
-                    continue
-                self.in_training_phase.wait()
-                pre_data.put(chunk)
-
-            self.trn_finished.set()
-            logger.debug('trn data finished')
-
-        gen_chunk_thread = Thread(target=chunk_trn_generator)
-        gen_chunk_thread.setDaemon(True)
-        gen_chunk_thread.start()
-
-        loss = 0.0
-        nb_chunk = 0.0
-        nb_cyc = 0
-        part_sum = 0.0
-        start_ = time()
-        next_val_time = start_ + validation_interval
-        next_report = start_ + 1.0
-        self.in_training_phase.set()
-
-        while not self.trn_finished.is_set() or not post_data.empty():
-            ins = post_data.get()
-            # if ins is None:
-            #     if nb_none == nb_data_workers:
-            #         break
-            #     else:
-            #         nb_none += 1
-            #         continue
-            loss_, part_sum_ = self._train(*ins)
-            nb_cyc += 1
-            nb_cyc %= 20
-            nb_words_trained += ins[0].shape[0]
-            nb_chunk += ins[0].shape[0]
-            loss += loss_ * ins[0].shape[0]
-            part_sum = max(part_sum, part_sum_)
-            if nb_cyc == 0:
-                end_ = time()
-                if end_ > next_report:
-                    elapsed = float(end_ - start_)
-                    speed2 = nb_words_trained/elapsed
-                    eta = (train_nb_words - nb_words_trained) / speed2
-                    eta_h = int(math.floor(eta/3600))
-                    eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
-                    loss /= nb_chunk
-                    logger.info('%s:Train - ETA: %02d:%02d - loss: %5.3f - mean_prob: %.2e - speed: %.1f words/s' %
-                                (self.__class__.__name__, eta_h, eta_m, loss, part_sum, speed2))
-                    log_file.info('%s:Train - time: %f - loss: %.6f' % (self.__class__.__name__, end_, loss))
-                    nb_chunk = 0.0
-                    loss = 0.0
-                    next_report = end_ + 1.0
-                    part_sum = 0.0
-
-                if end_ > next_val_time:
-                    logger.debug('pausing training data generation and consuming all generated data')
-                    self.in_training_phase.clear()
-                    while not self.jobs_pools_post.empty() or not self.jobs_pools.empty():
-                        ins = self.jobs_pools_post.get()
-                        self._train(*ins)
-                        nb_words_trained += ins[0].shape[0]
-                    logger.debug('Before validation')
-                    # noinspection PyUnresolvedReferences
-                    self.validation(train_val_sents, log_file)
-                    logger.debug('END validation. resume training data generation')
-                    self.in_training_phase.set()
-                    next_val_time = time() + validation_interval
-
-            if nb_words_trained >= train_nb_words:
-                self.trn_finished.set()
-                break
-
-        # consume all the produced tasks. The data generation thread will automatically shutdown, for the trn_finished
-        # event is set.
-        self.in_training_phase.set()  # make sure it is not blocking
-        while not self.jobs_pools_post.empty() or not self.jobs_pools.empty():
-            ins = self.jobs_pools_post.get()
-            self._train(*ins)
-
-        # Now the training data is consumed out. Let's evaluate...
-        logger.info('Training finished. Evaluating ...')
-        log_file.info('Training finished. Evaluating ...')
-        self.validation(val_sents, log_file)
-        self.all_finished.set()  # signal the all_finished event to shutdown all worker processes.
-        if save_path is not None:
-            self.save_params(save_path)
-        log_file.close()
-
-        for _ in range(10):
-            flags = map(Process.is_alive, data_workers)
-            if not any(flags):
-                break
-            for flag, p in zip(flags, data_workers):
-                if flag is True:
-                    logger.info("%s is alive" % p.name)
-            sleep(5)
+              validation_interval=1800, log_file=None, nb_data_workers=6, data_pool_size=10, words_per_batch=None,
+              nb_val_workers=1):
+        self.words_per_batch = words_per_batch
+        WorkerPoolTrainer(self, data_file, nb_data_workers, data_pool_size, nb_val_workers, save_path=save_path,
+                          batch_size=batch_size, train_nb_words=train_nb_words, val_nb_words=val_nb_words,
+                          train_val_nb=train_val_nb, validation_interval=validation_interval, log_file=log_file,
+                          words_per_batch=words_per_batch, chunk_size=int(batch_size//10)).run()
 
     def validation(self, val_sents, log_file=None):
         """
@@ -5053,77 +4152,73 @@ class FFNNLangModel(Graph, LangModel):
         :type val_sents: a list, each element a ndarray
         :return: tuple
         """
-        code_len = 0.
-        nb_words = 0.
-        loss = 0.0
+        self.snapshot_params()
+        return self.validate_snapshot(val_sents, log_file)
 
-        def chunk_val_generator():
-            for sents in val_sents:
-                self.jobs_pools.put(sents)
 
-        gen_chunk_thread = Thread(target=chunk_val_generator)
-        gen_chunk_thread.setDaemon(True)
-        gen_chunk_thread.start()
+def draw_noise(sampler, out, seed=None, batch=0, stream=0, pool=None, nb_parts=1):
+    """
+    Fill out with draws of sampler, from the counter based RNG keyed by (seed, batch, stream)
+    if seed is not None, in nb_parts parts drawn by the threads of pool. A NoisePool ignores
+    the seed.
+    :return: out
+    """
+    if seed is None or isinstance(sampler, NoisePool):
+        return sampler.sample_into(out)
+    return parallel_sample_into(sampler, out, seed, batch, stream, pool, nb_parts)
 
-        logger.debug('begin val loop')
-        while True:
-            ins = self.jobs_pools_post.get()
-            loss_, code_len_, nb_words_ = self._test(*ins)
-            nb_words += nb_words_
-            code_len += code_len_
-            loss += loss_ * nb_words_
-            if self.jobs_pools_post.empty() and self.jobs_pools.empty():
-                break
-        logger.debug('end val loop')
 
-        loss /= nb_words
-        ppl = math.exp(code_len/nb_words)
+def negative_sampleLBLV2(y, sampler, nb_negative, seed=None, batch=0, pool=None, nb_parts=1):
+        ret = np.empty(shape=(nb_negative+1,) + y.shape, dtype=y.dtype)
+        ret[0] = y
+        draw_noise(sampler, ret[1:], seed, batch, 0, pool, nb_parts)
+        return ret
 
-        logger.info('%s:Val val_loss: %.2f - val_ppl: %.2f' % (self.__class__.__name__, loss, ppl))
-        log_file.info('%s:Val val_loss: %.6f - val_ppl: %.6f' % (self.__class__.__name__, loss, ppl))
 
-        return loss, ppl
+def negative_sample_pool(y, noise_pool, nb_negative, pk):
+    """
+    Like negative_sampleLBLV2, with the negative samples and their probabilities taken from a NoisePool.
+    :return: the labels and their probabilities in pk
+    """
+    ret = np.empty(shape=(nb_negative+1,) + y.shape, dtype=y.dtype)
+    probs = np.empty(shape=ret.shape, dtype=pk.dtype)
+    ret[0] = y
+    probs[0] = pk[y]
+    noise_pool.take_into(ret[1:], probs[1:])
+    return ret, probs
 
 
-def negative_sampleLBLV2(y, sampler, nb_negative):
-        ret = np.empty(shape=(nb_negative+1,) + y.shape, dtype=y.dtype)
-        ret[0] = y
-        ret[1:] = sampler.rvs(size=ret[1:].shape).astype(y.dtype)
-        return ret
+def shared_negative_sample(y, sampler, nb_negative, pk, seed=None, batch=0, stream=0):
+    """
+    Negative samples shared by all the labels of y, see LangModel.sample_noise.
+    :return: the labels followed by the noise words, (k+1, ns), their probabilities in pk and
+    the words whose sparse codes are needed: the labels followed by the k noise words.
+    """
+    noise = draw_noise(sampler, np.empty((nb_negative,), dtype=y.dtype), seed, batch, stream)
+    ret = np.empty(shape=(nb_negative+1,) + y.shape, dtype=y.dtype)
+    ret[0] = y
+    ret[1:] = noise[:, np.newaxis]
+    return ret, pk[ret], np.concatenate([y, noise])
 
 
-# @numba.jit([(numba.int32[:, :], numba.int32, numba.int32),
-#             (numba.int32[:, :], numba.int64, numba.int32),
-#             (numba.int32[:, :], numba.int32, numba.int64),
-#             (numba.int32[:, :], numba.int64, numba.int64)], nogil=True)
-@numba.jit
-def get_cntx_label(sents, vocab_size, context_size):
-    ns = sents.shape[0]
-    nt = sents.shape[1]
-    nb_ele = sents.size  # NO. of words in the sentences.
-
-    pad_idx = np.arange(vocab_size, vocab_size+context_size).reshape((1, -1))
-    pad_idx = pad_idx.repeat(ns, axis=0)  # (ns, c), where c is context size
-    idxes = np.hstack((pad_idx, sents))   # (ns, c+s), where s is sentence length
-
-    X = np.empty(shape=(nb_ele, context_size), dtype='int32')
-    y_label = np.empty(shape=(nb_ele, ), dtype='int32')
-    start_end = np.array([0, 0], dtype='int32')
-    k = 0
-    for i in range(ns):  # loop on sentences
-        start_end[0], start_end[1] = 0, context_size
-        for _ in range(nt):  # loop on time (each time step corresponds to a word)
-            X[k] = idxes[i, start_end[0]:start_end[1]]
-            y_label[k] = idxes[i, start_end[1]]
-            k += 1
-            start_end += 1
-    return X, y_label
+def gather_slot_rows(matrix, rows, batch_ring, slot, index):
+    """
+    gather_rows into the buffers of the CSR item index of a reserved slot of batch_ring, or
+    into new arrays when there is no ring or the rows do not fit in the slot.
+    """
+    if batch_ring is not None:
+        try:
+            return gather_rows(matrix, rows, out=batch_ring.csr_buffers(slot, index))
+        except ValueError:
+            pass
+    return gather_rows(matrix, rows)
 
 
 def prepare_input(sents_queue, jobs_pool, all_finished,
                   vocab_size, context_size, batch_size, nb_negative, xk, pk,
                   sp_data, sp_indices, sp_indptr, sp_shape,
-                  sp_pad_data, sp_pad_indices, sp_pad_inptr, sp_pad_shape):
+                  sp_pad_data, sp_pad_indices, sp_pad_inptr, sp_pad_shape, words_per_batch=None, noise_pool=None,
+                  shared_negative=False, noise_seed=None, nb_sample_threads=1, batch_ring=None):
     xk = np.frombuffer(xk, dtype='int32')
     pk = np.frombuffer(pk, dtype='float32')
     sp_data = np.frombuffer(sp_data, dtype='float32')
@@ -5137,30 +4232,65 @@ def prepare_input(sents_queue, jobs_pool, all_finished,
     logger.debug('sp:shape: %s, %s, len(pk): %d - sum(pk): %.2f - min(pk): %.2f' %
                  (str(sparse_coding.shape), str(sparse_coding_pad.shape), len(pk), pk.sum(), pk.min()))
     assert xk[0] == 0
-    sd = abs(int(np.frombuffer(os.urandom(4), dtype='int32')))
-    np.random.seed(sd)
-    logger.debug('seed: %d' % sd)
-    custm = stats.rv_discrete(name='custm', values=(xk, pk))
+    if noise_seed is None:
+        sd = abs(int(np.frombuffer(os.urandom(4), dtype='int32')))
+        np.random.seed(sd)
+        logger.debug('seed: %d' % sd)
+    sampler = TableSampler(pk) if noise_pool is None else noise_pool
+    sample_pool = ThreadPool(nb_sample_threads) if nb_sample_threads > 1 else None
+
+    # contexts and labels of the current chunk, grown when needed
+    X_buf = np.empty((0, context_size), dtype='int32')
+    y_buf = np.empty((0,), dtype='int32')
 
     while not all_finished.is_set() or not sents_queue.empty():
-        sents = sents_queue.get()
-        X, y_label = get_cntx_label(sents, vocab_size, context_size)
-        y_label = negative_sampleLBLV2(y_label, custm, nb_negative)
-        probs = pk[y_label]
+        chunk_id, sents = sents_queue.get()
+        if X_buf.shape[0] < sents.size:
+            X_buf = np.empty((sents.size, context_size), dtype='int32')
+            y_buf = np.empty((sents.size,), dtype='int32')
+        X, y_label = cntx_label_into(sents, vocab_size, X_buf[:sents.size], y_buf[:sents.size], sample_pool,
+                                     nb_sample_threads)
+        if shared_negative:
+            pass  # drawn for each batch below
+        elif noise_pool is None:
+            y_label = negative_sampleLBLV2(y_label, sampler, nb_negative, noise_seed, chunk_id, sample_pool,
+                                           nb_sample_threads)
+            probs = pk[y_label]
+        else:
+            y_label, probs = negative_sample_pool(y_label, noise_pool, nb_negative, pk)
 
         nb_sample = X.shape[0]
-        batches = make_batches(nb_sample, batch_size)
+        if words_per_batch is None:
+            batches = make_batches(nb_sample, batch_size)
+        else:
+            # keep whole sentences in a batch, each of them gives nb_sample/nb_sents samples
+            sent_samples = nb_sample // max(1, sents.shape[0])
+            batch_sents = token_batch_size(batch_size, sents.shape[1], words_per_batch)
+            batches = make_batches(nb_sample, batch_sents * sent_samples)
         for batch_index, (batch_start, batch_end) in enumerate(batches):
             if batch_end <= batch_start:
                 break
 
+            # the sparse codes are gathered straight into the ring slot the batch is sent in
+            slot = None if batch_ring is None else batch_ring.reserve()
             X_ = X[batch_start:batch_end].copy()
-            y_ = y_label[:, batch_start:batch_end].copy()
-            sp_x_ = sparse_coding_pad[X_.ravel()]
-            sp_y_ = sparse_coding[y_.ravel()]
-            probs_ = probs[:, batch_start:batch_end].copy()
-
-            jobs_pool.put((X_, y_, sp_x_, sp_y_, probs_))
+            sp_x_ = gather_slot_rows(sparse_coding_pad, X_, batch_ring, slot, 2)
+            if shared_negative:
+                # stream 0 is for the negative samples of the whole chunk, see negative_sampleLBLV2
+                y_, probs_, code_rows = shared_negative_sample(y_label[batch_start:batch_end], sampler,
+                                                               nb_negative, pk, noise_seed, chunk_id, batch_index+1)
+            else:
+                y_ = y_label[:, batch_start:batch_end].copy()
+                code_rows = y_
+                probs_ = probs[:, batch_start:batch_end].copy()
+            # the noise words repeat a lot, only the distinct rows are gathered and decoded
+            rows, poses_ = unique_rows(code_rows)
+            sp_y_ = gather_slot_rows(sparse_coding, rows, batch_ring, slot, 3)
+
+            if batch_ring is None:
+                jobs_pool.put((X_, y_, sp_x_, sp_y_, probs_, poses_))
+            else:
+                batch_ring.put(jobs_pool, (X_, y_, sp_x_, sp_y_, probs_, poses_), slot)
 
 if __name__ == '__main__':
     from keras.optimizers import rmsprop, AdamAnneal, adam, adadelta, sgd
@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+import numpy as np
+import scipy.sparse as sparse
+import theano
+import theano.tensor as T
+import theano.sparse as tsp
+from theano.gof import OpenMPOp
+from theano.gradient import DisconnectedType, grad_not_implemented
+
+
+class GatherDotExp(theano.Op):
+    """
+    out[k, n] = exp(W[idx[k, n]] . h[n] + b[idx[k, n]]), computed row by row from the indexes
+    instead of gathering the (K, N, d) tensor W[idx] first. The gradient is GatherDotExpGrad,
+    which scatter-adds into the rows of W.
+
+    Inputs: W (V, d), b (V, ), idx (K, N) integers, h (N, d); W, b and h of the same dtype.
+    """
+    __props__ = ()
+
+    def make_node(self, W, b, idx, h):
+        W = T.as_tensor_variable(W)
+        b = T.as_tensor_variable(b)
+        idx = T.as_tensor_variable(idx)
+        h = T.as_tensor_variable(h)
+        if W.ndim != 2 or b.ndim != 1 or idx.ndim != 2 or h.ndim != 2:
+            raise TypeError('GatherDotExp expects W, b, idx, h of 2, 1, 2, 2 dims')
+        if idx.dtype not in T.integer_dtypes:
+            raise TypeError('GatherDotExp: idx must be integers, got %s' % idx.dtype)
+        if not (W.dtype == b.dtype == h.dtype):
+            raise TypeError('GatherDotExp: W, b and h must have the same dtype, got %s, %s, %s' %
+                            (W.dtype, b.dtype, h.dtype))
+        return theano.Apply(self, [W, b, idx, h], [T.matrix(dtype=W.dtype)])
+
+    def perform(self, node, inputs, output_storage):
+        W, b, idx, h = inputs
+        out = np.empty(idx.shape, dtype=W.dtype)
+        for k in range(idx.shape[0]):
+            out[k] = np.exp(np.sum(W[idx[k]] * h, axis=-1) + b[idx[k]])
+        output_storage[0][0] = out
+
+    def infer_shape(self, node, shapes):
+        return [shapes[2]]
+
+    def grad(self, inputs, output_grads):
+        W, b, idx, h = inputs
+        gz, = output_grads
+        gz_out = gz * self(W, b, idx, h)
+        gW, gb, gh = GatherDotExpGrad()(W, idx, h, gz_out)
+        return [gW, gb, DisconnectedType()(), gh]
+
+    def connection_pattern(self, node):
+        return [[True], [True], [False], [True]]
+
+    def c_code_cache_version(self):
+        return (2,)
+
+    def c_code(self, node, name, inputs, outputs, sub):
+        W, b, idx, h = inputs
+        out, = outputs
+        fail = sub['fail']
+        return """
+        {
+            npy_intp K = PyArray_DIMS(%(idx)s)[0];
+            npy_intp N = PyArray_DIMS(%(idx)s)[1];
+            npy_intp V = PyArray_DIMS(%(W)s)[0];
+            npy_intp D = PyArray_DIMS(%(W)s)[1];
+            npy_intp sW0 = PyArray_STRIDES(%(W)s)[0], sW1 = PyArray_STRIDES(%(W)s)[1];
+            npy_intp sh0 = PyArray_STRIDES(%(h)s)[0], sh1 = PyArray_STRIDES(%(h)s)[1];
+            npy_intp sb = PyArray_STRIDES(%(b)s)[0];
+            npy_intp si0 = PyArray_STRIDES(%(idx)s)[0], si1 = PyArray_STRIDES(%(idx)s)[1];
+            npy_intp k, n, j;
+            if (PyArray_DIMS(%(b)s)[0] != V || PyArray_DIMS(%(h)s)[0] != N || PyArray_DIMS(%(h)s)[1] != D) {
+                PyErr_SetString(PyExc_ValueError, "GatherDotExp: shapes of W, b, idx and h do not match");
+                %(fail)s;
+            }
+            if (NULL == %(out)s || PyArray_DIMS(%(out)s)[0] != K || PyArray_DIMS(%(out)s)[1] != N ||
+                !PyArray_IS_C_CONTIGUOUS(%(out)s)) {
+                npy_intp dims[2] = {K, N};
+                Py_XDECREF(%(out)s);
+                %(out)s = (PyArrayObject*)PyArray_EMPTY(2, dims, PyArray_TYPE(%(W)s), 0);
+                if (NULL == %(out)s) {
+                    %(fail)s;
+                }
+            }
+            for (k = 0; k < K; ++k) {
+                dtype_%(out)s* out_k = (dtype_%(out)s*)PyArray_GETPTR1(%(out)s, k);
+                for (n = 0; n < N; ++n) {
+                    npy_intp i = (npy_intp)*(dtype_%(idx)s*)(PyArray_BYTES(%(idx)s) + k*si0 + n*si1);
+                    const char* w_row;
+                    const char* h_row = PyArray_BYTES(%(h)s) + n*sh0;
+                    dtype_%(out)s acc;
+                    if (i < 0 || i >= V) {
+                        PyErr_Format(PyExc_IndexError, "GatherDotExp: index %%ld out of bounds for %%ld rows",
+                                     (long)i, (long)V);
+                        %(fail)s;
+                    }
+                    w_row = PyArray_BYTES(%(W)s) + i*sW0;
+                    acc = *(dtype_%(b)s*)(PyArray_BYTES(%(b)s) + i*sb);
+                    for (j = 0; j < D; ++j)
+                        acc += *(dtype_%(W)s*)(w_row + j*sW1) * *(dtype_%(h)s*)(h_row + j*sh1);
+                    out_k[n] = exp(acc);
+                }
+            }
+        }
+        """ % locals()
+
+
+class GatherDotExpGrad(theano.Op):
+    """
+    Gradient of GatherDotExp. With g[k, n] the gradient of out[k, n] times out[k, n]:
+    gW[idx[k, n]] += g[k, n] * h[n], gb[idx[k, n]] += g[k, n] and gh[n] += g[k, n] * W[idx[k, n]].
+
+    Inputs: W (V, d), idx (K, N), h (N, d), g (K, N). Outputs: gW (V, d), gb (V, ), gh (N, d).
+    """
+    __props__ = ()
+
+    def make_node(self, W, idx, h, g):
+        W = T.as_tensor_variable(W)
+        idx = T.as_tensor_variable(idx)
+        h = T.as_tensor_variable(h)
+        g = T.as_tensor_variable(g)
+        if not (W.dtype == h.dtype == g.dtype):
+            raise TypeError('GatherDotExpGrad: W, h and g must have the same dtype, got %s, %s, %s' %
+                            (W.dtype, h.dtype, g.dtype))
+        return theano.Apply(self, [W, idx, h, g], [T.matrix(dtype=W.dtype), T.vector(dtype=W.dtype),
+                                                    T.matrix(dtype=W.dtype)])
+
+    def perform(self, node, inputs, output_storage):
+        W, idx, h, g = inputs
+        gW = np.zeros_like(W)
+        gb = np.zeros((W.shape[0],), dtype=W.dtype)
+        gh = np.zeros_like(h)
+        for k in range(idx.shape[0]):
+            np.add.at(gW, idx[k], g[k][:, None] * h)
+            np.add.at(gb, idx[k], g[k])
+            gh += g[k][:, None] * W[idx[k]]
+        output_storage[0][0] = gW
+        output_storage[1][0] = gb
+        output_storage[2][0] = gh
+
+    def infer_shape(self, node, shapes):
+        W_shape, _, h_shape, _ = shapes
+        return [W_shape, W_shape[:1], h_shape]
+
+    def c_code_cache_version(self):
+        return (1,)
+
+    def c_code(self, node, name, inputs, outputs, sub):
+        W, idx, h, g = inputs
+        gW, gb, gh = outputs
+        fail = sub['fail']
+        return """
+        {
+            npy_intp K = PyArray_DIMS(%(idx)s)[0];
+            npy_intp N = PyArray_DIMS(%(idx)s)[1];
+            npy_intp V = PyArray_DIMS(%(W)s)[0];
+            npy_intp D = PyArray_DIMS(%(W)s)[1];
+            npy_intp sW0 = PyArray_STRIDES(%(W)s)[0], sW1 = PyArray_STRIDES(%(W)s)[1];
+            npy_intp sh0 = PyArray_STRIDES(%(h)s)[0], sh1 = PyArray_STRIDES(%(h)s)[1];
+            npy_intp sg0 = PyArray_STRIDES(%(g)s)[0], sg1 = PyArray_STRIDES(%(g)s)[1];
+            npy_intp si0 = PyArray_STRIDES(%(idx)s)[0], si1 = PyArray_STRIDES(%(idx)s)[1];
+            npy_intp dims[2];
+            npy_intp k, n, j;
+            if (PyArray_DIMS(%(h)s)[0] != N || PyArray_DIMS(%(h)s)[1] != D ||
+                PyArray_DIMS(%(g)s)[0] != K || PyArray_DIMS(%(g)s)[1] != N) {
+                PyErr_SetString(PyExc_ValueError, "GatherDotExpGrad: shapes of W, idx, h and g do not match");
+                %(fail)s;
+            }
+            /* the outputs are C contiguous and zeroed, the rows are accumulated into them */
+            Py_XDECREF(%(gW)s);
+            Py_XDECREF(%(gb)s);
+            Py_XDECREF(%(gh)s);
+            dims[0] = V; dims[1] = D;
+            %(gW)s = (PyArrayObject*)PyArray_ZEROS(2, dims, PyArray_TYPE(%(W)s), 0);
+            %(gb)s = (PyArrayObject*)PyArray_ZEROS(1, dims, PyArray_TYPE(%(W)s), 0);
+            dims[0] = N;
+            %(gh)s = (PyArrayObject*)PyArray_ZEROS(2, dims, PyArray_TYPE(%(W)s), 0);
+            if (NULL == %(gW)s || NULL == %(gb)s || NULL == %(gh)s) {
+                %(fail)s;
+            }
+            {
+                dtype_%(gW)s* gW_data = (dtype_%(gW)s*)PyArray_DATA(%(gW)s);
+                dtype_%(gb)s* gb_data = (dtype_%(gb)s*)PyArray_DATA(%(gb)s);
+                dtype_%(gh)s* gh_data = (dtype_%(gh)s*)PyArray_DATA(%(gh)s);
+                for (k = 0; k < K; ++k) {
+                    for (n = 0; n < N; ++n) {
+                        npy_intp i = (npy_intp)*(dtype_%(idx)s*)(PyArray_BYTES(%(idx)s) + k*si0 + n*si1);
+                        dtype_%(g)s gkn = *(dtype_%(g)s*)(PyArray_BYTES(%(g)s) + k*sg0 + n*sg1);
+                        const char* w_row;
+                        const char* h_row = PyArray_BYTES(%(h)s) + n*sh0;
+                        dtype_%(gW)s* gW_row;
+                        dtype_%(gh)s* gh_row = gh_data + n*D;
+                        if (i < 0 || i >= V) {
+                            PyErr_Format(PyExc_IndexError, "GatherDotExpGrad: index %%ld out of bounds for %%ld rows",
+                                         (long)i, (long)V);
+                            %(fail)s;
+                        }
+                        w_row = PyArray_BYTES(%(W)s) + i*sW0;
+                        gW_row = gW_data + i*D;
+                        gb_data[i] += gkn;
+                        for (j = 0; j < D; ++j) {
+                            gW_row[j] += gkn * *(dtype_%(h)s*)(h_row + j*sh1);
+                            gh_row[j] += gkn * *(dtype_%(W)s*)(w_row + j*sW1);
+                        }
+                    }
+                }
+            }
+        }
+        """ % locals()
+
+
+def gather_dot_exp(W, b, idxes, features):
+    """
+    exp(T.sum(W[idxes] * features, axis=-1) + b[idxes]) with GatherDotExp, i.e. without the
+    (k+1, ..., d) tensor of the gathered rows in the forward and the backward pass.
+    :param W: (V, d)
+    :param b: (V, ) or (V, 1)
+    :param idxes: (k+1, ...)
+    :param features: (..., d)
+    :return: (k+1, ...)
+    """
+    idx_flat = T.flatten(idxes, 2)                                                 # (k+1, N)
+    dims = features.shape[-1]
+    h = T.reshape(features, (features.size // dims, dims), ndim=2)               # (N, d)
+    out = GatherDotExp()(W, T.flatten(b, 1).astype(W.dtype), idx_flat, h.astype(W.dtype))
+    return T.reshape(out, idxes.shape, ndim=idxes.ndim)
+
+
+class CSRDot(OpenMPOp):
+    """
+    Product of a CSR matrix, given by its data, indices and indptr, with a dense W:
+    out[m] = sum(data[k] * W[..., indices[k], :] for k in range(indptr[m], indptr[m+1])). W is
+    (B, d), or (G, B, d) for G matrices multiplied by the same sparse rows, out is then (M, G, d).
+    The rows are split across the OpenMP threads (theano flag openmp=True, OMP_NUM_THREADS).
+    The gradient of W is CSRDotTransGrad; the one of data is not implemented.
+    """
+    __props__ = ('openmp',)
+
+    def make_node(self, data, indices, indptr, W):
+        data = T.as_tensor_variable(data)
+        indices = T.as_tensor_variable(indices)
+        indptr = T.as_tensor_variable(indptr)
+        W = T.as_tensor_variable(W)
+        if data.ndim != 1 or indices.ndim != 1 or indptr.ndim != 1 or W.ndim not in (2, 3):
+            raise TypeError('CSRDot expects data, indices and indptr vectors and W of 2 or 3 dims')
+        if data.dtype != W.dtype:
+            raise TypeError('CSRDot: data and W must have the same dtype, got %s, %s' % (data.dtype, W.dtype))
+        return theano.Apply(self, [data, indices, indptr, W],
+                            [T.tensor(dtype=W.dtype, broadcastable=(False,) * W.ndim)])
+
+    def perform(self, node, inputs, output_storage):
+        data, indices, indptr, W = inputs
+        nb_rows = indptr.shape[0] - 1
+        if W.ndim == 2:
+            x = sparse.csr_matrix((data, indices, indptr), shape=(nb_rows, W.shape[0]))
+            output_storage[0][0] = np.asarray(x.dot(W), dtype=W.dtype)
+        else:
+            x = sparse.csr_matrix((data, indices, indptr), shape=(nb_rows, W.shape[1]))
+            output_storage[0][0] = np.asarray(np.stack([x.dot(W_) for W_ in W], axis=1), dtype=W.dtype)
+
+    def infer_shape(self, node, shapes):
+        W_shape = shapes[3]
+        return [(shapes[2][0] - 1,) + tuple(W_shape[:-2]) + tuple(W_shape[-1:])]
+
+    def grad(self, inputs, output_grads):
+        data, indices, indptr, W = inputs
+        gz, = output_grads
+        return [grad_not_implemented(self, 0, data), DisconnectedType()(), DisconnectedType()(),
+                CSRDotTransGrad(self.openmp)(data, indices, indptr, W, gz)]
+
+    def connection_pattern(self, node):
+        return [[True], [False], [False], [True]]
+
+    def c_code_cache_version(self):
+        return (1,)
+
+    def c_code(self, node, name, inputs, outputs, sub):
+        data, indices, indptr, W = inputs
+        out, = outputs
+        fail = sub['fail']
+        return _CSR_CHECKS % locals() + """
+            npy_intp dims[3] = {M, G, D};
+            npy_intp m;
+            if (NULL == %(out)s || PyArray_NDIM(%(out)s) != PyArray_NDIM(%(W)s) ||
+                PyArray_DIMS(%(out)s)[0] != M || PyArray_DIMS(%(out)s)[PyArray_NDIM(%(W)s)-1] != D ||
+                (w3 && PyArray_DIMS(%(out)s)[1] != G) || !PyArray_IS_C_CONTIGUOUS(%(out)s)) {
+                Py_XDECREF(%(out)s);
+                if (!w3)
+                    dims[1] = D;
+                %(out)s = (PyArrayObject*)PyArray_EMPTY(PyArray_NDIM(%(W)s), dims, PyArray_TYPE(%(W)s), 0);
+                if (NULL == %(out)s) {
+                    %(fail)s;
+                }
+            }
+            {
+                dtype_%(out)s* out_data = (dtype_%(out)s*)PyArray_DATA(%(out)s);
+                int W_contiguous = sWd == sizeof(dtype_%(W)s);
+                #pragma omp parallel for schedule(static)
+                for (m = 0; m < M; ++m) {
+                    dtype_%(out)s* row = out_data + m*G*D;
+                    npy_intp k, g, j;
+                    npy_intp start = (npy_intp)*(dtype_%(indptr)s*)(PyArray_BYTES(%(indptr)s) + m*sp);
+                    npy_intp end = (npy_intp)*(dtype_%(indptr)s*)(PyArray_BYTES(%(indptr)s) + (m+1)*sp);
+                    for (j = 0; j < G*D; ++j)
+                        row[j] = 0;
+                    for (k = start; k < end; ++k) {
+                        dtype_%(data)s v = *(dtype_%(data)s*)(PyArray_BYTES(%(data)s) + k*sd);
+                        npy_intp b = (npy_intp)*(dtype_%(indices)s*)(PyArray_BYTES(%(indices)s) + k*si);
+                        for (g = 0; g < G; ++g) {
+                            const char* w_row = PyArray_BYTES(%(W)s) + g*sWg + b*sWb;
+                            dtype_%(out)s* o = row + g*D;
+                            if (W_contiguous) {
+                                const dtype_%(W)s* w = (const dtype_%(W)s*)w_row;
+                                for (j = 0; j < D; ++j)
+                                    o[j] += v * w[j];
+                            } else {
+                                for (j = 0; j < D; ++j)
+                                    o[j] += v * *(dtype_%(W)s*)(w_row + j*sWd);
+                            }
+                        }
+                    }
+                }
+            }
+        }
+        """ % locals()
+
+
+class CSRDotTransGrad(OpenMPOp):
+    """
+    Gradient of W of CSRDot, the transposed sparse matrix times the gradient gz of the output:
+    gW[..., indices[k], :] += data[k] * gz[m] for k in range(indptr[m], indptr[m+1]). The sparse
+    matrix is first transposed with a counting sort, then the rows of gW are split across the
+    OpenMP threads, so they never write to the same place.
+    """
+    __props__ = ('openmp',)
+
+    def make_node(self, data, indices, indptr, W, gz):
+        data = T.as_tensor_variable(data)
+        indices = T.as_tensor_variable(indices)
+        indptr = T.as_tensor_variable(indptr)
+        W = T.as_tensor_variable(W)
+        gz = T.as_tensor_variable(gz)
+        if gz.ndim != W.ndim or not (data.dtype == W.dtype == gz.dtype):
+            raise TypeError('CSRDotTransGrad: gz must be like the output of CSRDot')
+        return theano.Apply(self, [data, indices, indptr, W, gz], [W.type()])
+
+    def perform(self, node, inputs, output_storage):
+        data, indices, indptr, W, gz = inputs
+        nb_rows = indptr.shape[0] - 1
+        x = sparse.csr_matrix((data, indices, indptr), shape=(nb_rows, W.shape[-2]))
+        if W.ndim == 2:
+            output_storage[0][0] = np.asarray(x.T.dot(gz), dtype=W.dtype)
+        else:
+            output_storage[0][0] = np.asarray(np.stack([x.T.dot(gz[:, g]) for g in range(W.shape[0])]),
+                                              dtype=W.dtype)
+
+    def infer_shape(self, node, shapes):
+        return [shapes[3]]
+
+    def c_code_cache_version(self):
+        return (1,)
+
+    def c_code(self, node, name, inputs, outputs, sub):
+        data, indices, indptr, W, gz = inputs
+        gW, = outputs
+        fail = sub['fail']
+        return _CSR_CHECKS % locals() + """
+            npy_intp sz0 = PyArray_STRIDES(%(gz)s)[0];
+            npy_intp szg = w3 ? PyArray_STRIDES(%(gz)s)[1] : 0;
+            npy_intp szd = PyArray_STRIDES(%(gz)s)[PyArray_NDIM(%(gz)s)-1];
+            npy_intp* col_ptr = NULL;
+            npy_intp* col_rows = NULL;
+            dtype_%(data)s* col_data = NULL;
+            npy_intp m, k, b;
+            if (PyArray_DIMS(%(gz)s)[0] != M || PyArray_DIMS(%(gz)s)[PyArray_NDIM(%(gz)s)-1] != D ||
+                (w3 && PyArray_DIMS(%(gz)s)[1] != G)) {
+                PyErr_SetString(PyExc_ValueError, "CSRDotTransGrad: gz does not match the output of CSRDot");
+                %(fail)s;
+            }
+            Py_XDECREF(%(gW)s);
+            %(gW)s = (PyArrayObject*)PyArray_EMPTY(PyArray_NDIM(%(W)s), PyArray_DIMS(%(W)s), PyArray_TYPE(%(W)s), 0);
+            col_ptr = (npy_intp*)calloc(B + 1, sizeof(npy_intp));
+            col_rows = (npy_intp*)malloc((nnz ? nnz : 1) * sizeof(npy_intp));
+            col_data = (dtype_%(data)s*)malloc((nnz ? nnz : 1) * sizeof(dtype_%(data)s));
+            if (NULL == %(gW)s || NULL == col_ptr || NULL == col_rows || NULL == col_data) {
+                free(col_ptr);
+                free(col_rows);
+                free(col_data);
+                if (!PyErr_Occurred())
+                    PyErr_NoMemory();
+                %(fail)s;
+            }
+            /* transpose: the rows m and the values of the entries of column b are in
+               col_rows and col_data from col_ptr[b] to col_ptr[b+1] */
+            for (m = 0; m < M; ++m) {
+                npy_intp start = (npy_intp)*(dtype_%(indptr)s*)(PyArray_BYTES(%(indptr)s) + m*sp);
+                npy_intp end = (npy_intp)*(dtype_%(indptr)s*)(PyArray_BYTES(%(indptr)s) + (m+1)*sp);
+                for (k = start; k < end; ++k)
+                    col_ptr[(npy_intp)*(dtype_%(indices)s*)(PyArray_BYTES(%(indices)s) + k*si) + 1] += 1;
+            }
+            for (b = 0; b < B; ++b)
+                col_ptr[b+1] += col_ptr[b];
+            for (m = 0; m < M; ++m) {
+                npy_intp start = (npy_intp)*(dtype_%(indptr)s*)(PyArray_BYTES(%(indptr)s) + m*sp);
+                npy_intp end = (npy_intp)*(dtype_%(indptr)s*)(PyArray_BYTES(%(indptr)s) + (m+1)*sp);
+                for (k = start; k < end; ++k) {
+                    npy_intp c = (npy_intp)*(dtype_%(indices)s*)(PyArray_BYTES(%(indices)s) + k*si);
+                    col_rows[col_ptr[c]] = m;
+                    col_data[col_ptr[c]] = *(dtype_%(data)s*)(PyArray_BYTES(%(data)s) + k*sd);
+                    col_ptr[c] += 1;
+                }
+            }
+            /* col_ptr[b] is now the end of column b, i.e. the start of column b+1 */
+            for (b = B; b > 0; --b)
+                col_ptr[b] = col_ptr[b-1];
+            col_ptr[0] = 0;
+            {
+                dtype_%(gW)s* gW_data = (dtype_%(gW)s*)PyArray_DATA(%(gW)s);
+                int gz_contiguous = szd == sizeof(dtype_%(gz)s);
+                #pragma omp parallel for schedule(static)
+                for (b = 0; b < B; ++b) {
+                    npy_intp q, g, j;
+                    for (g = 0; g < G; ++g) {
+                        dtype_%(gW)s* gW_row = gW_data + (g*B + b)*D;
+                        for (j = 0; j < D; ++j)
+                            gW_row[j] = 0;
+                        for (q = col_ptr[b]; q < col_ptr[b+1]; ++q) {
+                            dtype_%(data)s v = col_data[q];
+                            const char* gz_row = PyArray_BYTES(%(gz)s) + col_rows[q]*sz0 + g*szg;
+                            if (gz_contiguous) {
+                                const dtype_%(gz)s* z = (const dtype_%(gz)s*)gz_row;
+                                for (j = 0; j < D; ++j)
+                                    gW_row[j] += v * z[j];
+                            } else {
+                                for (j = 0; j < D; ++j)
+                                    gW_row[j] += v * *(dtype_%(gz)s*)(gz_row + j*szd);
+                            }
+                        }
+                    }
+                }
+            }
+            free(col_ptr);
+            free(col_rows);
+            free(col_data);
+        }
+        """ % locals()
+
+
+# shapes and strides of the inputs of CSRDot and CSRDotTransGrad, and the check of the indexes
+# before the parallel loops, which cannot fail.
+_CSR_CHECKS = """
+        {
+            int w3 = PyArray_NDIM(%(W)s) == 3;
+            npy_intp M = PyArray_DIMS(%(indptr)s)[0] - 1;
+            npy_intp nnz = PyArray_DIMS(%(data)s)[0];
+            npy_intp G = w3 ? PyArray_DIMS(%(W)s)[0] : 1;
+            npy_intp B = PyArray_DIMS(%(W)s)[w3];
+            npy_intp D = PyArray_DIMS(%(W)s)[w3+1];
+            npy_intp sWg = w3 ? PyArray_STRIDES(%(W)s)[0] : 0;
+            npy_intp sWb = PyArray_STRIDES(%(W)s)[w3];
+            npy_intp sWd = PyArray_STRIDES(%(W)s)[w3+1];
+            npy_intp sd = PyArray_STRIDES(%(data)s)[0];
+            npy_intp si = PyArray_STRIDES(%(indices)s)[0];
+            npy_intp sp = PyArray_STRIDES(%(indptr)s)[0];
+            npy_intp c;
+            if (M < 0 || PyArray_DIMS(%(indices)s)[0] != nnz) {
+                PyErr_SetString(PyExc_ValueError, "CSR: bad data, indices or indptr");
+                %(fail)s;
+            }
+            for (c = 0; c <= M; ++c) {
+                npy_intp p = (npy_intp)*(dtype_%(indptr)s*)(PyArray_BYTES(%(indptr)s) + c*sp);
+                npy_intp p0 = c ? (npy_intp)*(dtype_%(indptr)s*)(PyArray_BYTES(%(indptr)s) + (c-1)*sp) : 0;
+                if (p < p0 || p > nnz) {
+                    PyErr_SetString(PyExc_ValueError, "CSR: indptr is not increasing or exceeds the data");
+                    %(fail)s;
+                }
+            }
+            for (c = 0; c < nnz; ++c) {
+                npy_intp b = (npy_intp)*(dtype_%(indices)s*)(PyArray_BYTES(%(indices)s) + c*si);
+                if (b < 0 || b >= B) {
+                    PyErr_Format(PyExc_IndexError, "CSR: column %%ld out of bounds for %%ld rows of W",
+                                 (long)b, (long)B);
+                    %(fail)s;
+                }
+            }
+"""
+
+
+def csr_dot(x, W):
+    """
+    Same as tsp.structured_dot(x, W) for a CSR sparse variable x, with CSRDot. W can also be
+    (G, B, d), the G products being returned as (M, G, d). Other sparse formats fall back to
+    tsp.structured_dot.
+    """
+    if x.format != 'csr':
+        return tsp.structured_dot(x, W)
+    data, indices, indptr, _ = tsp.csm_properties(x)
+    return CSRDot()(data.astype(W.dtype), indices, indptr, W)
+
+
+def blocked_label_log_softmax(features, W, b, labels, block_size=8192):
+    """
+    log(softmax(T.dot(features, W) + b))[labels] without the (..., V) scores: the log partition
+    is accumulated over blocks of block_size words of the vocabulary by a running log-sum-exp
+    in a scan, so only the (N, block_size) scores of a block are held at a time.
+    :param features: (..., d)
+    :param W: (d, V)
+    :param b: (V, )
+    :param labels: word indexes, the shape of features without its last axis
+    :return: log probabilities, the shape of labels
+    """
+    dims = features.shape[-1]
+    h = T.reshape(features, (features.size // dims, dims), ndim=2)               # (N, d)
+    y = T.flatten(labels, 1)
+    label_scores = T.sum(h * W.T[y], axis=1) + b[y]                              # (N, )
+
+    def step(start, max_, sum_, h_, W_, b_):
+        scores = T.dot(h_, W_[:, start:start+block_size]) + b_[start:start+block_size]
+        new_max = T.maximum(max_, T.max(scores, axis=1))
+        new_sum = sum_ * T.exp(max_ - new_max) + T.sum(T.exp(scores - new_max.dimshuffle(0, 'x')), axis=1)
+        return new_max, new_sum
+
+    init_max = T.alloc(np.asarray(-np.inf, dtype=W.dtype), h.shape[0])
+    init_sum = T.zeros_like(init_max)
+    [max_, sum_], _ = theano.scan(step, sequences=T.arange(0, W.shape[1], block_size),
+                                  outputs_info=[init_max, init_sum], non_sequences=[h, W, b])
+    log_probs = label_scores - max_[-1] - T.log(sum_[-1])
+    return T.reshape(log_probs, labels.shape, ndim=labels.ndim)
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+import math
+import logging
+from time import time, sleep
+from threading import Thread
+from multiprocessing import Process
+from utils import chunk_sentences, SentenceBuckets, token_batch_size, BucketSpeed, Prefetcher
+# noinspection PyUnresolvedReferences
+from lm.utils.preprocess import grouped_sentences
+# noinspection PyUnresolvedReferences
+from lm.utils.corpus import is_indexed_corpus, grouped_split
+
+logger = logging.getLogger('lm.real.models')
+MAX_SETN_LEN = 65  # actually 64
+
+
+class LogInfo(object):
+    def __init__(self, file_name=None):
+        super(LogInfo, self).__init__()
+        if file_name is not None:
+            self.logger = file(file_name, 'w')
+        else:
+            self.logger = None
+
+    def info(self, message):
+        if self.logger is not None:
+            self.logger.writelines(['INFO:', message, '\n'])
+
+    def debug(self, message):
+        if self.logger is not None:
+            self.logger.writelines(['DEBUG:', message, '\n'])
+
+    def close(self):
+        if self.logger is not None:
+            self.logger.close()
+
+
+class Trainer(object):
+    """
+    The training loop of the language models, in stages: reading the corpus and holding
+    out the validation sentences (read, split), bucketing the sentences into chunks of the
+    same length (chunks), turning a chunk into the inputs of the compiled step (encode),
+    running the step (step) and evaluating (evaluate). The encoding, e.g. negative sampling
+    and sparse code lookups, runs in a Prefetcher thread ahead of the step (feed). The
+    trainer also does the timing, the logging, the validation schedule and the checkpoints,
+    so they are done in one place.
+
+    The model only declares how to turn a chunk into its inputs (encode_chunk) and provides
+    _loop_train, validation, get_val_data and save_params. A stage can be replaced by
+    overriding its method in a subclass, see WorkerPoolTrainer.
+    """
+    def __init__(self, model, data_file, save_path=None, batch_size=256, train_nb_words=100000000,
+                 val_nb_words=100000, train_val_nb=100000, validation_interval=1800, log_file=None,
+                 words_per_batch=None, prefetch_size=4, checkpoint=False, max_sent_len=MAX_SETN_LEN,
+                 chunk_size=None, initial_validation=True, log_interval=0.):
+        """
+        :param model: the language model to train
+        :param data_file: the corpus, see grouped_sentences
+        :param save_path: the parameters are saved there at the end if not None
+        :param log_file: name of the file the log is also written to
+        :param words_per_batch: see token_batch_size
+        :param prefetch_size: number of chunks encoded ahead of the step
+        :param checkpoint: if True, also save the parameters at each validation
+        :param chunk_size: number of sentences of a chunk (see token_batch_size), batch_size by default
+        :param initial_validation: if True, validate once before the training
+        :param log_interval: the train log lines are at least that many seconds apart, the loss
+        being averaged over the steps in between
+        """
+        self.model = model
+        self.data_file = data_file
+        self.save_path = save_path
+        self.batch_size = batch_size
+        self.train_nb_words = train_nb_words
+        self.val_nb_words = val_nb_words
+        self.train_val_nb = train_val_nb
+        self.validation_interval = validation_interval
+        self.log_file = LogInfo(log_file)
+        self.words_per_batch = words_per_batch
+        self.prefetch_size = prefetch_size
+        self.checkpoint = checkpoint
+        self.max_sent_len = max_sent_len
+        self.chunk_size = batch_size if chunk_size is None else chunk_size
+        self.initial_validation = initial_validation
+        self.log_interval = log_interval
+        self.name = model.__class__.__name__
+        self.bucket_speed = BucketSpeed()
+
+    def info(self, message):
+        logger.info(message)
+        self.log_file.info(message)
+
+    def read(self, split=None):
+        """
+        :param split: one of 'val', 'train_val' and 'train' to read only that split of an
+        indexed corpus, see lm.utils.corpus.split_groups. None reads the whole corpus.
+        :return: a generator of groups of sentences
+        """
+        if split is not None and is_indexed_corpus(self.data_file):
+            return grouped_split(self.data_file, split, self.val_nb_words, self.train_val_nb)
+        return grouped_sentences(self.data_file)
+
+    def split(self):
+        """
+        :return: the sentences for evaluation after training, those for validation during
+        training (see get_val_data of the model) and a generator of the groups to train on.
+        The splits of an indexed corpus are read from their own offsets; a stream is read
+        once, the held-out sentences being taken from its head.
+        """
+        if is_indexed_corpus(self.data_file):
+            val_sents = self.model.get_val_data(self.read('val'), self.val_nb_words)
+            train_val_sents = self.model.get_val_data(self.read('train_val'), self.train_val_nb)
+            return val_sents, train_val_sents, self.read('train')
+        sent_gen = self.read()
+        val_sents = self.model.get_val_data(sent_gen, self.val_nb_words)
+        train_val_sents = self.model.get_val_data(sent_gen, self.train_val_nb)
+        return val_sents, train_val_sents, sent_gen
+
+    def chunks(self, sent_gen):
+        """
+        :return: a generator of (chunk id, chunk), chunks of sentences of the same length, the
+        words out of the vocabulary being replaced by the last word of it. The id is given when
+        the chunk is read, see next_chunk_id of the model.
+        """
+        sentences = SentenceBuckets(self.max_sent_len)  # TODO: sentences longer than 64 are ignored.
+        max_vocab = self.model.vocab_size - 1
+        for sents in sent_gen:
+            mask = (sents > max_vocab)
+            sents[mask] = max_vocab
+            chunk = chunk_sentences(sentences, sents, token_batch_size(self.chunk_size, sents.shape[1],
+                                                                       self.words_per_batch))
+            if chunk is None:
+                continue
+            yield self.model.next_chunk_id(), chunk
+
+    def encode(self, chunks):
+        """
+        :return: a generator of (chunk, inputs of the step)
+        """
+        for chunk_id, chunk in chunks:
+            yield chunk, self.model.encode_chunk(chunk, self.batch_size, self.words_per_batch, chunk_id)
+
+    def start(self):
+        """
+        Start what the stages need, before the first validation. Nothing by default.
+        """
+        pass
+
+    def feed(self, sent_gen):
+        """
+        :return: an iterator of (chunk, inputs of the step); the chunks are encoded by a
+        Prefetcher thread while the previous ones are trained
+        """
+        return Prefetcher(self.encode(self.chunks(sent_gen)), self.prefetch_size)
+
+    def step(self, data):
+        """
+        :return: the loss, or the loss and the perplexity
+        """
+        # noinspection PyProtectedMember
+        return self.model._loop_train(data, self.batch_size, self.words_per_batch)
+
+    def step_info(self):
+        """
+        :return: what else to log about the steps since the last train log line
+        """
+        return ''
+
+    def count(self, chunk, data):
+        """
+        :return: the numbers of sentences and of words trained by the step on data
+        """
+        return chunk.shape[0], chunk.size
+
+    def evaluate(self, val_sents):
+        return self.model.validation(val_sents, self.batch_size, self.log_file)
+
+    def validate(self, feed, val_sents, nb_words_trained):
+        """
+        The validation during the training, after nb_words_trained words.
+        """
+        self.info('%s:Train - %s' % (self.name, self.bucket_speed.summary()))
+        self.info('%s:Train - %s' % (self.name, feed.summary()))
+        self.model.log_noise_pool(self.log_file)
+        # the validation draws its noise from ids of its own, the pause only keeps the prefetch
+        # thread off the CPU
+        feed.pause()
+        self.evaluate(val_sents)
+        feed.resume()
+
+    def finish(self, feed):
+        """
+        Stop the feed at the end of the training.
+        """
+        feed.close()
+
+    def save(self):
+        if self.save_path is not None:
+            self.model.save_params(self.save_path)
+
+    def close(self):
+        self.log_file.close()
+
+    def run(self):
+        opt_info = self.model.optimizer.get_config()
+        opt_info = ', '.join(["{}: {}".format(n, v) for n, v in opt_info.items()])
+        self.info('training with file: %s' % self.data_file)
+        self.info('training with batch size %d' % self.batch_size)
+        self.info('training with %d words; validate with %d words during training; evaluate with %d words '
+                  'after training' % (self.train_nb_words, self.train_val_nb, self.val_nb_words))
+        self.info('validate every %f seconds' % float(self.validation_interval))
+        self.info('optimizer: %s' % opt_info)
+
+        nb_trained = 0.
+        nb_words_trained = 0.0
+        val_sents, train_val_sents, sent_gen = self.split()
+
+        self.start()
+        if self.initial_validation:
+            self.evaluate(train_val_sents)
+        feed = self.feed(sent_gen)
+        # the loss (and code length) since the last train log line
+        loss_sum, code_len, nb_log_words = 0.0, 0.0, 0.0
+        start_ = time()
+        next_val_time = start_ + self.validation_interval
+        next_log_time = start_
+        for chunk, data in feed:
+            trn_start = time()
+            outs = self.step(data)
+            nb_sents, nb_words = self.count(chunk, data)
+            if chunk is not None:
+                self.bucket_speed.update(chunk.shape[1], nb_words, time() - trn_start)
+            loss, ppl = outs if isinstance(outs, tuple) else (outs, None)
+            loss_sum += loss * nb_words
+            if ppl is not None:
+                code_len += math.log(ppl) * nb_words
+            nb_log_words += nb_words
+            if nb_sents is not None:
+                nb_trained += nb_sents
+            nb_words_trained += nb_words
+            end_ = time()
+            if end_ >= next_log_time:
+                elapsed = float(end_ - start_)
+                speed2 = nb_words_trained/elapsed
+                if nb_sents is None:
+                    speed = '%.1f words/s' % speed2
+                else:
+                    speed = '%.1f sent/s %.1f words/s' % (nb_trained/elapsed, speed2)
+                eta = (self.train_nb_words - nb_words_trained) / speed2
+                eta_h = int(math.floor(eta/3600))
+                eta_m = int(math.ceil((eta - eta_h * 3600)/60.))
+                loss = loss_sum / nb_log_words
+                if ppl is None:
+                    logger.info('%s:Train - ETA: %02d:%02d - loss: %5.3f%s - speed: %s' %
+                                (self.name, eta_h, eta_m, loss, self.step_info(), speed))
+                    self.log_file.info('%s:Train - time: %f - loss: %.6f' % (self.name, end_, loss))
+                else:
+                    ppl = math.exp(code_len / nb_log_words)
+                    logger.info('%s:Train - ETA: %02d:%02d - loss: %5.3f - ppl: %7.2f%s - speed: %s'
+                                % (self.name, eta_h, eta_m, loss, ppl, self.step_info(), speed))
+                    self.log_file.info('%s:Train - time: %f - loss: %.6f - ppl: %.6f' % (self.name, end_, loss, ppl))
+                loss_sum, code_len, nb_log_words = 0.0, 0.0, 0.0
+                next_log_time = end_ + self.log_interval
+
+            if end_ > next_val_time:
+                self.validate(feed, train_val_sents, nb_words_trained)
+                if self.checkpoint:
+                    self.save()
+                next_val_time = time() + self.validation_interval
+
+            if nb_words_trained >= self.train_nb_words:
+                break
+
+        self.finish(feed)
+        self.info('Training finished. Evaluating ...')
+        self.evaluate(val_sents)
+        self.save()
+        self.close()
+
+
+class WorkerPoolTrainer(Trainer):
+    """
+    The Trainer of the models whose batches are made by data worker processes, see
+    start_data_workers of the models: a reader thread sends the chunks to the workers, which
+    encode them and hand the batches over through a BatchRing, and a step trains one batch.
+    The validations during the training run on a snapshot of the parameters in a process of
+    their own, see start_validation of the models.
+    """
+    def __init__(self, model, data_file, nb_data_workers=6, data_pool_size=10, nb_val_workers=1, **kwargs):
+        """
+        :param nb_data_workers: number of processes encoding the training chunks
+        :param data_pool_size: capacity of the queue of the chunks sent to them
+        :param nb_val_workers: number of processes encoding the validation sentences
+        :param kwargs: see Trainer, the train log lines are a second apart by default
+        """
+        kwargs.setdefault('log_interval', 1.)
+        super(WorkerPoolTrainer, self).__init__(model, data_file, **kwargs)
+        self.nb_data_workers = nb_data_workers
+        self.data_pool_size = data_pool_size
+        self.nb_val_workers = nb_val_workers
+        self.data_workers = []
+        # the largest values of the other outputs of _train since the last train log line
+        self.peaks = None
+
+    def start(self):
+        self.data_workers = self.model.start_data_workers(self.batch_size, self.nb_data_workers,
+                                                          self.data_pool_size, self.nb_val_workers)
+        self.model.in_training_phase.clear()
+
+    def feed(self, sent_gen):
+        """
+        :return: a generator of (None, batch made by the data workers)
+        """
+        model = self.model
+
+        def send_chunks():
+            for chunk_id, chunk in self.chunks(sent_gen):
+                if model.trn_finished.is_set():
+                    break
+                model.in_training_phase.wait()
+                model.jobs_pools.put((chunk_id, chunk))
+            model.trn_finished.set()
+            logger.debug('trn data finished')
+
+        reader = Thread(target=send_chunks)
+        reader.setDaemon(True)
+        reader.start()
+        model.in_training_phase.set()
+        return self.batches()
+
+    def batches(self):
+        model = self.model
+        while not model.trn_finished.is_set() or not model.jobs_pools_post.empty():
+            yield None, model.take_batch(model.jobs_pools_post)
+
+    def step(self, data):
+        # noinspection PyProtectedMember
+        outs = self.model._train(*data)
+        if not isinstance(outs, list):
+            return outs
+        self.peaks = outs[1:] if self.peaks is None else [max(p, o) for p, o in zip(self.peaks, outs[1:])]
+        return outs[0]
+
+    def step_info(self):
+        if self.peaks is None:
+            return ''
+        # noinspection PyProtectedMember
+        labels = self.model._train.out_labels[1:]
+        info = ''.join(' - %s: %.3g' % (label, peak) for label, peak in zip(labels, self.peaks))
+        self.peaks = None
+        return info
+
+    def count(self, chunk, data):
+        # each word of the sentences gives one sample
+        return None, data[0].shape[0]
+
+    def evaluate(self, val_sents):
+        return self.model.validation(val_sents, self.log_file)
+
+    def validate(self, feed, val_sents, nb_words_trained):
+        self.model.log_noise_pool(self.log_file)
+        # validate a snapshot of the parameters in the background, the training goes on meanwhile
+        if not self.model.start_validation(val_sents, nb_words_trained, self.log_file):
+            logger.debug('the previous validation is still running, skipped')
+
+    def finish(self, feed):
+        model = self.model
+        model.trn_finished.set()
+        model.in_training_phase.set()  # make sure the reader is not blocking
+        # train on the chunks already sent to the workers
+        while not model.jobs_pools_post.empty() or not model.jobs_pools.empty():
+            # noinspection PyProtectedMember
+            model._train(*model.take_batch(model.jobs_pools_post))
+        model.wait_validation(self.log_file)
+
+    def close(self):
+        self.model.all_finished.set()  # shut all the data workers down
+        super(WorkerPoolTrainer, self).close()
+        for _ in range(10):
+            flags = map(Process.is_alive, self.data_workers)
+            if not any(flags):
+                break
+            for flag, p in zip(flags, self.data_workers):
+                if flag is True:
+                    logger.info("%s is alive" % p.name)
+            sleep(5)
@@ -2,7 +2,7 @@
 # -*- coding: utf-8 -*-
 __author__ = 'Yunchuan Chen'
 
-from .utils import floatX, categorical_crossentropy, objective_fnc, chunk_sentences,\
-    slice_X, get_unigram_probtable, TableSampler, load_huffman_tree, save_tree, create_tree,\
-    LangModelLogger, LangHistory, epsilon
+from .utils import floatX, categorical_crossentropy, objective_fnc, chunk_sentences, SentenceBuckets,\
+    token_batch_size, BucketSpeed, Prefetcher, slice_X, get_unigram_probtable, TableSampler, load_huffman_tree,\
+    save_tree, create_tree, LangModelLogger, LangHistory, epsilon
 from .preprocess import data4sri
\ No newline at end of file
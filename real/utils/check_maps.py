@@ -16,11 +16,12 @@ def check_maps(map1, map2):
 
 if __name__ == '__main__':
     import cPickle as pickle
+    # noinspection PyUnresolvedReferences
+    from lm.utils.wordmap import load_wordmap
     wp_file = '../../data/wiki-wordmap-trunc300k.wp'
     embeds_file = '/home/cyc/Data/models/embeddings/rw2vec_embeddings-size200.pkl'
 
-    with file(wp_file, 'rb') as f:
-        wp = pickle.load(f)
+    wp = load_wordmap(wp_file)
 
     with file(embeds_file, 'rb') as f:
         em = pickle.load(f)
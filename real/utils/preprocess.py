@@ -8,7 +8,19 @@ import numpy as np
 import cPickle as pickle
 import logging
 import re
-from utils import chunk_sentences
+from collections import deque
+from multiprocessing import Pool, cpu_count
+# noinspection PyUnresolvedReferences
+from lm.utils.compress import smart_open
+# noinspection PyUnresolvedReferences
+from lm.utils.corpus import is_indexed_corpus, indexed_grouped_sentences, IndexedCorpusWriter
+# noinspection PyUnresolvedReferences
+from lm.utils.wordcount import count_words
+# noinspection PyUnresolvedReferences
+from lm.utils.wordmap import load_wordmap
+# noinspection PyUnresolvedReferences
+from lm.utils.tokenizer import BlockTokenizer, split_block, line_blocks, group_by_length
+from utils import chunk_sentences, SentenceBuckets
 
 __author__ = 'Yunchuan Chen'
 MAX_SETN_LEN = 65
@@ -40,37 +52,22 @@ class ReadFileTest(unittest.TestCase):
         self.failUnless('idx2wc' in wpi, 'idx2wc key lost for the wordmap.')
 
 
-def smart_open(fname, mode='rb', buffering=5*2**20):
-    _, ext = os.path.splitext(fname)
-    if ext == '.bz2':
-        from bz2 import BZ2File
-        return BZ2File(fname, mode, buffering)
-    # if ext == '.gz':
-    #     from gzip import GzipFile
-    #     return GzipFile(fname, mode, buffering)
-    return open(fname, mode, buffering)
-
-
 def export_wordmap(dist_file=DATA_ROOT+'wiki-wordmap.wp',
-                   corpus_file=DATA_ROOT+'corpus/wiki-sg-norm-lc.txt', rebuild=False):
+                   corpus_file=DATA_ROOT+'corpus/wiki-sg-norm-lc.txt', rebuild=False,
+                   nb_workers=None, top_k=None, max_tracked=None):
     """
     :param dist_file: file name to store the wordmap
     :param corpus_file: corpus source to build wordmap against
     :param rebuild: whether rebuild wordmap if it already exists.
+    :param nb_workers: number of processes counting the corpus in parallel.
+    :param top_k: if not None, only keep the top_k most frequent words.
+    :param max_tracked: memory budget of each counting process in number of distinct words,
+    only used with top_k. See count_words.
     :return: exported model and a flag.
     """
     if os.path.exists(dist_file) and not rebuild:
         return None, True
-    word2cnt = dict()
-    with smart_open(corpus_file, buffering=5*2**20) as f:
-        for sent in f:
-            words = sent.split()
-            for w in words:
-                try:
-                    word2cnt[w] += 1
-                except KeyError:
-                    word2cnt[w] = 1
-    kv = sorted(word2cnt.items(), key=lambda x: x[1], reverse=True)
+    kv = count_words(corpus_file, nb_workers=nb_workers, top_k=top_k, max_tracked=max_tracked)
     idx2word = [w for w, _ in kv]
     idx2wc = [c for _, c in kv]
     word2idx = dict((w, idx) for idx, (w, _) in enumerate(kv))
@@ -82,12 +79,11 @@ def export_wordmap(dist_file=DATA_ROOT+'wiki-wordmap.wp',
 
 def import_wordmap(fname=DATA_ROOT+'wiki-wordmap.wp'):
     """
-    :param fname: a string indicate where the wordmap stores.
+    :param fname: a string indicate where the wordmap stores. Both pickled and binary
+    wordmaps (see lm.utils.wordmap) are accepted.
     :return: wordmap
     """
-    with file(fname, 'rb') as f:
-        wp = pickle.load(f)
-    return wp
+    return load_wordmap(fname)
 
 
 def preprocess_corpus(corpus_file=DATA_ROOT+'corpus/wiki-sg-norm-lc.txt',
@@ -128,29 +124,84 @@ def binarize_corpus(group_size=20000, corpus_file=DATA_ROOT+'corpus/wiki-sg-norm
     :param wordmap: wordmap.
     :return: None
     """
-    def _index_sentence(sent):
-        """
-        :param sent: a sentence as a string
-        :type sent: str
-        :return: a list of word index
-        Represents a sentence using word indexes.
-        """
-        words = sent.split()
-        return [word2idx[w] for w in words]
+    dist_file = smart_open(dist_file, 'wb', multistream=True)
+    assert dist_file is not None
+    if isinstance(wordmap, str):
+        wp = import_wordmap(fname=wordmap)
+    elif isinstance(wordmap, dict):
+        wp = wordmap
+    else:
+        logging.error('can not recognize wordmap type')
+        raise TypeError('wordamp must be dict or str')
+    tokenizer = BlockTokenizer(wp)
+    with smart_open(corpus_file) as f:
+        for block in line_blocks(f, group_size):
+            idxes, lens = tokenizer.tokenize(block)
+            for sent_len, sents in group_by_length(idxes, lens):
+                if 3 <= sent_len <= max_len:
+                    dist_file.write(np.array(sents.shape, dtype=np.int32).tobytes())
+                    dist_file.write(sents.tobytes())
 
-    def _commit_result():
-        for idx_sent in result[3:]:
-            if len(idx_sent) > 0:
-                sents = np.array(idx_sent, dtype=np.int32)
-                shape = np.array(sents.shape, dtype=np.int32)
-                dist_file.write(shape.tobytes())
-                dist_file.write(sents.tobytes())
+    dist_file.close()
 
-        for j in range(len(result)):
-            result[j] = []
 
-    dist_file = smart_open(dist_file, 'wb')
-    assert dist_file is not None
+_tokenizer = None
+_sent_len_range = (3, 64)
+
+
+def _init_index_worker(tokenizer, min_len, max_len):
+    global _tokenizer, _sent_len_range
+    _tokenizer = tokenizer
+    _sent_len_range = (min_len, max_len)
+
+
+def _filter_index_lines(lines):
+    """
+    :param lines: a block of raw corpus lines
+    :return: the word indexes of the kept sentences as a flat int32 array, and the
+    lengths of the kept sentences.
+    Runs in the worker processes of preprocess_binarize_corpus.
+    """
+    min_len, max_len = _sent_len_range
+    buf, starts, ends, token_lines, nb_lines = split_block(lines)
+    lens = np.bincount(token_lines, minlength=max(nb_lines, 1))
+    kept = (min_len <= lens) & (lens <= max_len)
+    sel = kept[token_lines]
+    return _tokenizer.lookup(buf, starts[sel], ends[sel]), lens[kept].astype(np.int32)
+
+
+def _ordered_map(pool, func, iterable, max_pending):
+    """
+    Like pool.imap, but reads at most max_pending items ahead of the consumer.
+    """
+    jobs = deque()
+    for item in iterable:
+        jobs.append(pool.apply_async(func, (item, )))
+        if len(jobs) >= max_pending:
+            yield jobs.popleft().get()
+    while jobs:
+        yield jobs.popleft().get()
+
+
+def preprocess_binarize_corpus(corpus_file=DATA_ROOT+'corpus/wiki-sg-norm-lc.txt',
+                               dist_file=DATA_ROOT+'corpus/wiki-sg-norm-lc-drop-bin.bz2',
+                               wordmap=DATA_ROOT+'wiki-wordmap.wp', group_size=20000,
+                               min_len=3, max_len=64, nb_workers=None, block_size=10000, indexed=False):
+    """
+    :param corpus_file: original corpus file name
+    :param dist_file: the file to store the binarized corpus
+    :param wordmap: wordmap, a dict or its file name.
+    :param group_size: number of kept sentences per group, see binarize_corpus
+    :param min_len: sentences shorter than this are dropped
+    :param max_len: sentences longer than this are dropped
+    :param nb_workers: number of worker processes. None means all the cores.
+    :param block_size: number of raw lines sent to a worker at a time
+    :param indexed: write an indexed corpus (see lm.utils.corpus) instead of a grouped stream
+    :return: number of sentences kept
+    Does preprocess_corpus and binarize_corpus in one pass over the raw corpus. Workers
+    filter and index blocks of lines; the results are grouped in corpus order, so the
+    (decompressed) output is the same as the one of the two-step path.
+    """
     if isinstance(wordmap, str):
         wp = import_wordmap(fname=wordmap)
     elif isinstance(wordmap, dict):
@@ -158,23 +209,68 @@ def binarize_corpus(group_size=20000, corpus_file=DATA_ROOT+'corpus/wiki-sg-norm
     else:
         logging.error('can not recognize wordmap type')
         raise TypeError('wordamp must be dict or str')
-    word2idx = wp['word2idx']
+
+    if indexed:
+        writer = IndexedCorpusWriter(dist_file)
+        write_group = writer.write_group
+    else:
+        writer = smart_open(dist_file, 'wb', multistream=True)
+
+        def write_group(sents):
+            writer.write(np.array(sents.shape, dtype=np.int32).tobytes())
+            writer.write(sents.tobytes())
+
     result = [[] for _ in range(max_len + 1)]
-    with smart_open(corpus_file) as f:
-        for i, sent in enumerate(f, start=1):
-            idxs = _index_sentence(sent)
-            try:
-                result[len(idxs)].append(idxs)
-                if i % group_size == 0:
-                    _commit_result()
-            except IndexError:
-                continue
-        _commit_result()
 
-    dist_file.close()
+    def _commit_result():
+        for sents in result[min_len:]:
+            if len(sents) > 0:
+                write_group(np.vstack(sents))
+        for j in range(len(result)):
+            result[j] = []
+
+    def _collect(idxes, lens):
+        for sent_len, sents in group_by_length(idxes, lens):
+            result[sent_len].append(sents)
+
+    nb_workers = cpu_count() if nb_workers is None else nb_workers
+    pool = Pool(nb_workers, initializer=_init_index_worker, initargs=(BlockTokenizer(wp), min_len, max_len))
+    nb_sents = 0
+    try:
+        with smart_open(corpus_file) as f:
+            blocks = _ordered_map(pool, _filter_index_lines, line_blocks(f, block_size), 4*nb_workers)
+            for idxes, lens in blocks:
+                # split the block at the group boundaries
+                starts = np.cumsum(lens) - lens
+                i = 0
+                while i < lens.size:
+                    j = min(lens.size, i + group_size - nb_sents % group_size)
+                    end = starts[j] if j < lens.size else idxes.size
+                    _collect(idxes[starts[i]:end], lens[i:j])
+                    nb_sents += j - i
+                    if nb_sents % group_size == 0:
+                        _commit_result()
+                    i = j
+        _commit_result()
+    finally:
+        pool.terminate()
+        pool.join()
+        writer.close()
+    return nb_sents
 
 
 def grouped_sentences(binary_corpus=DATA_ROOT+'corpus/wiki-sg-norm-lc-drop-bin.bz2'):
+    """
+    :param binary_corpus: either a grouped stream produced by binarize_corpus or the token
+    file of an indexed corpus (see lm.utils.corpus)
+    :return: generator of int32 matrices, each holds a group of sentences with the same length
+    """
+    if is_indexed_corpus(binary_corpus):
+        return indexed_grouped_sentences(binary_corpus)
+    return _stream_grouped_sentences(binary_corpus)
+
+
+def _stream_grouped_sentences(binary_corpus):
     with smart_open(binary_corpus) as f:
         while True:
             shape_data = f.read(2*4)
@@ -262,19 +358,15 @@ def get_val_data(data_file=DATA_ROOT+'corpus/wiki-sg-norm-lc-drop-bin.bz2', val_
         else:
             sent_gen = data_file
 
-        val_sents = [None for _ in range(MAX_SETN_LEN)]
+        val_sents = SentenceBuckets(MAX_SETN_LEN, mem_budget=None)
         val_nb = 0
         for sents in sent_gen:
             val_nb += sents.size
             chunk_sentences(val_sents, sents, 1000000, no_return=True)
             if val_nb >= val_nb_words:
                 break
-        val_sents_ = [None for _ in range(MAX_SETN_LEN)]
-        for idx in range(MAX_SETN_LEN):
-            if val_sents[idx]:
-                val_sents_[idx] = np.vstack(val_sents[idx]['sents'])
 
-        val_sents = [sents for sents in val_sents_ if sents is not None]
+        val_sents = val_sents.groups()
         for sents in val_sents:
             mask = (sents > max_vocab)
             sents[mask] = max_vocab
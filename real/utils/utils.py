@@ -5,7 +5,6 @@ __author__ = 'Yunchuan Chen'
 import math
 import os
 import cPickle as pickle
-from scipy.stats import rv_discrete
 from keras.callbacks import History, BaseLogger
 from keras.utils.generic_utils import Progbar
 import theano
@@ -13,6 +12,13 @@ import theano.tensor as T
 import numpy as np
 import Queue
 import re
+from collections import deque
+from threading import Thread, Lock, Event
+from time import time
+# noinspection PyUnresolvedReferences
+from lm.utils.wordmap import load_wordmap
+# noinspection PyUnresolvedReferences
+from lm.utils.sampler import AliasSampler
 
 floatX = theano.config.floatX
 epsilon = 1.0e-9
@@ -86,7 +92,11 @@ def chunk_sentences(old_sentences, new_sentences, chunk_size, no_return=False, m
     :param chunk_size:
     :param no_return:
     :return:
+    old_sentences can also be a SentenceBuckets, which avoids copying the buffered sentences
+    over and over again.
     """
+    if isinstance(old_sentences, SentenceBuckets):
+        return old_sentences.add(new_sentences, chunk_size, no_return, min_nb_ch)
     sent_len = new_sentences.shape[1]
 
     if old_sentences[sent_len]:
@@ -110,6 +120,264 @@ def chunk_sentences(old_sentences, new_sentences, chunk_size, no_return=False, m
         return None
 
 
+class SentenceBuckets(object):
+    """
+    Buffers of sentences grouped by length, a drop-in replacement of the
+    [None for _ in range(MAX_SETN_LEN)] lists used with chunk_sentences.
+
+    Each length has a preallocated buffer which grows by doubling. New sentences are
+    copied in once, and chunks are returned as views of the buffer, so the buffered
+    sentences are not stacked again every time a chunk is taken. A buffer which has
+    handed out views is never written over: when it runs out of room, the remaining
+    sentences move to a new buffer and the old one lives as long as the views.
+
+    The buffers of all lengths share a memory budget. When it is exceeded, the buckets
+    which have waited longest for a chunk are flushed as (possibly short) chunks, which
+    are handed out by the following calls of add.
+    """
+    def __init__(self, max_len=65, mem_budget=256*2**20, init_size=1024, dtype='int32'):
+        """
+        :param max_len: sentences must be shorter than this
+        :param mem_budget: maximum number of bytes of the buffers, None means no limit
+        :param init_size: initial number of sentences of a buffer
+        :param dtype: data type of the word indexes
+        """
+        self.max_len = max_len
+        self.mem_budget = mem_budget
+        self.init_size = init_size
+        self.dtype = np.dtype(dtype)
+        self.bufs = [None] * max_len
+        self.heads = [0] * max_len
+        self.sizes = [0] * max_len
+        self.exported = [False] * max_len
+        self.last_chunk = [0] * max_len
+        self.nb_adds = 0
+        self.nbytes = 0
+        self.pending = deque()
+        self.nb_flushed = 0
+
+    def __len__(self):
+        return self.max_len
+
+    def __getitem__(self, sent_len):
+        """
+        :return: the buffered sentences of length sent_len, or None if there is none.
+        """
+        if self.sizes[sent_len] == 0:
+            return None
+        head = self.heads[sent_len]
+        return self.bufs[sent_len][head:head + self.sizes[sent_len]]
+
+    def nb_sents(self):
+        return sum(self.sizes)
+
+    def groups(self):
+        """
+        :return: list of the buffered sentences, one matrix per length in increasing length
+        """
+        return [self[l] for l in range(self.max_len) if self.sizes[l] > 0]
+
+    def _reserve(self, sent_len, nb):
+        buf = self.bufs[sent_len]
+        head, size = self.heads[sent_len], self.sizes[sent_len]
+        if buf is not None and head + size + nb <= buf.shape[0]:
+            return
+        if buf is not None and not self.exported[sent_len] and size + nb <= buf.shape[0]:
+            buf[:size] = buf[head:head + size]
+            self.heads[sent_len] = 0
+            return
+        cap = self.init_size if buf is None else buf.shape[0]
+        while cap < size + nb:
+            cap *= 2
+        new_buf = np.empty((cap, sent_len), dtype=self.dtype)
+        if size > 0:
+            new_buf[:size] = buf[head:head + size]
+        self.nbytes += new_buf.nbytes - (0 if buf is None else buf.nbytes)
+        self.bufs[sent_len] = new_buf
+        self.heads[sent_len] = 0
+        self.exported[sent_len] = False
+
+    def _take(self, sent_len, nb):
+        head = self.heads[sent_len]
+        chunk = self.bufs[sent_len][head:head + nb]
+        self.heads[sent_len] = head + nb
+        self.sizes[sent_len] -= nb
+        self.exported[sent_len] = True
+        self.last_chunk[sent_len] = self.nb_adds
+        return chunk
+
+    def _release(self, sent_len):
+        self.nbytes -= self.bufs[sent_len].nbytes
+        self.bufs[sent_len] = None
+        self.heads[sent_len] = 0
+        self.sizes[sent_len] = 0
+        self.exported[sent_len] = False
+
+    def _flush_starving(self, keep):
+        starving = sorted((self.last_chunk[l], l) for l in range(self.max_len)
+                          if self.bufs[l] is not None and l != keep)
+        for _, l in starving:
+            if self.nbytes <= self.mem_budget:
+                break
+            if self.sizes[l] > 0:
+                self.pending.append(self._take(l, self.sizes[l]))
+                self.nb_flushed += 1
+            self._release(l)
+
+    def add(self, sents, chunk_size, no_return=False, min_nb_ch=5):
+        """
+        :param sents: a group of sentences with the same length
+        :param chunk_size: chunks are multiples of chunk_size sentences
+        :param no_return: only buffer the sentences
+        :param min_nb_ch: a chunk is taken once a bucket holds chunk_size*min_nb_ch sentences
+        :return: a chunk of sentences or None, see chunk_sentences
+        """
+        sent_len = sents.shape[1]
+        nb = sents.shape[0]
+        self.nb_adds += 1
+        self._reserve(sent_len, nb)
+        start = self.heads[sent_len] + self.sizes[sent_len]
+        self.bufs[sent_len][start:start + nb] = sents
+        self.sizes[sent_len] += nb
+        if no_return:
+            return None
+
+        chunk = None
+        if self.sizes[sent_len] >= chunk_size*min_nb_ch:
+            chunk = self._take(sent_len, self.sizes[sent_len] // chunk_size * chunk_size)
+        if self.mem_budget is not None and self.nbytes > self.mem_budget:
+            self._flush_starving(sent_len)
+        if chunk is None and self.pending:
+            chunk = self.pending.popleft()
+        return chunk
+
+
+def token_batch_size(batch_size, sent_len, words_per_batch=None):
+    """
+    :param batch_size: number of sentences per batch
+    :param sent_len: length of the sentences
+    :param words_per_batch: if not None, batches hold about this many words instead of
+    batch_size sentences, so batches of short sentences are not dominated by the cost of
+    the call itself and batches of long sentences are not oversized.
+    :return: number of sentences per batch
+    """
+    if words_per_batch is None:
+        return batch_size
+    return max(1, int(words_per_batch) // max(1, int(sent_len)))
+
+
+class BucketSpeed(object):
+    """
+    Training speed of each sentence length.
+    """
+    def __init__(self):
+        self.nb_words = {}
+        self.elapsed = {}
+
+    def update(self, sent_len, nb_words, elapsed):
+        self.nb_words[sent_len] = self.nb_words.get(sent_len, 0) + nb_words
+        self.elapsed[sent_len] = self.elapsed.get(sent_len, 0.) + elapsed
+
+    def summary(self):
+        """
+        :return: a string like 'len 3: 1234.5 words/s, len 4: ...'
+        """
+        return ', '.join('len %d: %.1f words/s' % (l, self.nb_words[l]/max(self.elapsed[l], 1e-9))
+                         for l in sorted(self.nb_words))
+
+
+class Prefetcher(object):
+    """
+    Runs a generator in a background thread, at most size items ahead, so the items (e.g.
+    prepared batches) are made while the trainer works on the previous ones. The time the
+    consumer waits for items is counted, see summary.
+
+    The generator must not run while the consumer uses the state it shares with it (e.g.
+    the noise sampler during validation): call pause before and resume after.
+    """
+    def __init__(self, gen, size=4):
+        self.queue = Queue.Queue(size)
+        self.lock = Lock()
+        self.stopped = Event()
+        self.wait_time = 0.
+        self.paused_time = 0.
+        self.nb_items = 0
+        self.start_time = None
+        self._pause_start = None
+        self.thread = Thread(target=self._produce, args=(gen,))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def _produce(self, gen):
+        try:
+            while True:
+                with self.lock:
+                    if self.stopped.is_set():
+                        break
+                    item = next(gen)
+                self._put((True, item))
+        except StopIteration:
+            self._put((False, None))
+        except Exception as e:
+            self._put((False, e))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time()
+        if self.start_time is None:
+            self.start_time = start
+        ok, item = self.queue.get()
+        self.wait_time += time() - start
+        if not ok:
+            self.queue.put((ok, item))  # keep on stopping the next calls
+            if item is not None:
+                raise item
+            raise StopIteration
+        self.nb_items += 1
+        return item
+
+    def pause(self):
+        """
+        Wait for the item being made, if any, and keep the generator from going on until resume.
+        """
+        self.lock.acquire()
+        self._pause_start = time()
+
+    def resume(self):
+        self.paused_time += time() - self._pause_start
+        self._pause_start = None
+        self.lock.release()
+
+    def close(self):
+        """
+        Stop the generator, waiting for the item being made, if any.
+        """
+        self.stopped.set()
+        with self.lock:
+            pass
+
+    def wait_fraction(self):
+        """
+        :return: the fraction of the time the consumer waited for items, the paused time excluded.
+        """
+        if self.start_time is None:
+            return 0.
+        return self.wait_time / max(time() - self.start_time - self.paused_time, 1e-9)
+
+    def summary(self):
+        return 'data wait: %.1f%% (%.1fs, %d items)' % (100. * self.wait_fraction(), self.wait_time, self.nb_items)
+
+
 def slice_X(X, start_, end_=None, axis=1):
     if end_ is None:
         return [x.take(start_, axis=axis) for x in X]
@@ -130,9 +398,7 @@ def get_unigram_probtable(nb_words, wordmap='../data/wiki-wordmap-trunc300k.wp',
             freq = pickle.load(f)
         return freq
 
-    with file(wordmap, 'rb') as f:
-        wp = pickle.load(f)
-
+    wp = load_wordmap(wordmap)
     idx2wc = wp['idx2wc']
     idx2wc[nb_words-1] = sum(idx2wc[nb_words-1:])
     nb_total = sum(idx2wc[:nb_words])
@@ -305,13 +571,12 @@ def convert_logs(log, val_line=_VAL_LINE, trn_line=_TRAIN_LINE):
     return t_trn, trn_loss, val_loss, val_ppl
 
 
-class TableSampler(rv_discrete):
-    def __init__(self, table):
-        nk = np.arange(len(table))
-        super(TableSampler, self).__init__(b=len(table)-1, values=(nk, table))
-
-    def sample(self, shape, dtype='int32'):
-        return self.rvs(size=shape).astype(dtype)
+class TableSampler(AliasSampler):
+    """
+    Samples word indexes from a probability table, e.g. the unigram table of the noise
+    distribution. See lm.utils.sampler.AliasSampler.
+    """
+    pass
 
 
 class LangHistory(History):
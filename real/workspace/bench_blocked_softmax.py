@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+# The log probabilities of the labels of a validation batch under the full softmax: the
+# (N, V) probabilities indexed at the labels, as encode_length does, against
+# lm.real.ops.blocked_label_log_softmax. Each variant runs in its own process; the memory is
+# its peak resident size, the (d, V) output weights included.
+import resource
+import time
+from multiprocessing import Process, Queue
+import numpy as np
+import theano
+import theano.tensor as T
+# noinspection PyUnresolvedReferences
+from lm.real.ops import blocked_label_log_softmax
+
+CONTEXT_DIMS = 200
+BATCH_WORDS = 1024
+NB_REPEATS = 5
+
+
+def full_label_log_softmax(features, W, b, labels):
+    probs = T.nnet.softmax(T.dot(features, W) + b)
+    return T.log(probs[T.arange(labels.shape[0]), labels] + 1.0e-37)
+
+
+def run(variant, vocab_size, results):
+    rng = np.random.RandomState(1234)
+    W = theano.shared(rng.randn(CONTEXT_DIMS, vocab_size).astype(theano.config.floatX) * 0.1)
+    b = theano.shared(np.zeros((vocab_size,), dtype=theano.config.floatX))
+    features = T.matrix()
+    labels = T.ivector()
+    f = theano.function([features, labels], -T.sum(variant(features, W, b, labels)))
+
+    feat_val = rng.randn(BATCH_WORDS, CONTEXT_DIMS).astype(theano.config.floatX)
+    label_val = rng.randint(0, vocab_size, size=(BATCH_WORDS,)).astype('int32')
+    f(feat_val, label_val)
+    start = time.time()
+    for _ in range(NB_REPEATS):
+        f(feat_val, label_val)
+    elapsed = (time.time() - start) / NB_REPEATS
+    results.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024., f(feat_val, label_val)))
+
+
+def measure(variant, vocab_size):
+    results = Queue()
+    p = Process(target=run, args=(variant, vocab_size, results))
+    p.start()
+    ret = results.get()
+    p.join()
+    return ret
+
+
+if __name__ == '__main__':
+    print '%d words per batch, dl=%d, %s' % (BATCH_WORDS, CONTEXT_DIMS, theano.config.floatX)
+    for vocab_size in [10000, 50000, 100000, 300000]:
+        full_time, full_mem, full_len = measure(full_label_log_softmax, vocab_size)
+        blocked_time, blocked_mem, blocked_len = measure(blocked_label_log_softmax, vocab_size)
+        assert abs(full_len - blocked_len) < 1e-4 * abs(full_len)
+        print 'V=%6d: full softmax %.0fms %.0fMB, blocked %.0fms %.0fMB' % \
+            (vocab_size, full_time*1e3, full_mem, blocked_time*1e3, blocked_mem)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+# Throughput of the context/label extraction of the data workers: get_cntx_label as it
+# used to be in models.py against lm.utils.ngram, in one thread and split over threads.
+import time
+import numpy as np
+import numba
+from multiprocessing.pool import ThreadPool
+# noinspection PyUnresolvedReferences
+from lm.utils.ngram import get_cntx_label
+
+VOCAB_SIZE = 50000
+NB_SENTS = 2000
+SENT_LEN = 30
+NB_REPEATS = 5
+NB_THREADS = 4
+
+
+# the bare @numba.jit of models.py could not type np.hstack and fell back to object mode
+@numba.jit(forceobj=True)
+def old_get_cntx_label(sents, vocab_size, context_size):
+    ns = sents.shape[0]
+    nt = sents.shape[1]
+    nb_ele = sents.size  # NO. of words in the sentences.
+
+    pad_idx = np.arange(vocab_size, vocab_size+context_size).reshape((1, -1))
+    pad_idx = pad_idx.repeat(ns, axis=0)  # (ns, c), where c is context size
+    idxes = np.hstack((pad_idx, sents))   # (ns, c+s), where s is sentence length
+
+    X = np.empty(shape=(nb_ele, context_size), dtype='int32')
+    y_label = np.empty(shape=(nb_ele, ), dtype='int32')
+    start_end = np.array([0, 0], dtype='int32')
+    k = 0
+    for i in range(ns):  # loop on sentences
+        start_end[0], start_end[1] = 0, context_size
+        for _ in range(nt):  # loop on time (each time step corresponds to a word)
+            X[k] = idxes[i, start_end[0]:start_end[1]]
+            y_label[k] = idxes[i, start_end[1]]
+            k += 1
+            start_end += 1
+    return X, y_label
+
+
+def timed(func):
+    func()  # compile
+    start = time.time()
+    for _ in range(NB_REPEATS):
+        ret = func()
+    return (time.time() - start) / NB_REPEATS, ret
+
+
+if __name__ == '__main__':
+    sents = np.random.randint(0, VOCAB_SIZE, size=(NB_SENTS, SENT_LEN)).astype('int32')
+    pool = ThreadPool(NB_THREADS)
+    for context_size in range(2, 11):
+        old_time, (X0, y0) = timed(lambda: old_get_cntx_label(sents, VOCAB_SIZE, context_size))
+        new_time, (X1, y1) = timed(lambda: get_cntx_label(sents, VOCAB_SIZE, context_size))
+        par_time, (X2, y2) = timed(lambda: get_cntx_label(sents, VOCAB_SIZE, context_size, pool, NB_THREADS))
+        assert (X0 == X1).all() and (y0 == y1).all() and (X0 == X2).all() and (y0 == y2).all()
+        print 'context %2d: old %.2fM words/s, new %.2fM words/s, %d threads %.2fM words/s' % \
+            (context_size, sents.size/old_time/1e6, sents.size/new_time/1e6, NB_THREADS, sents.size/par_time/1e6)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+# Forward and backward pass of the product of the sparse codes of a batch with the bases,
+# tsp.structured_dot against lm.real.ops.csr_dot, for one matrix and for the four gate
+# matrices of SparseEmbeddingV6. Run it with THEANO_FLAGS=openmp=True (see environ.sh) and
+# OMP_NUM_THREADS=1, 2, 4, ... to see how csr_dot scales with the threads.
+import os
+import time
+import numpy as np
+import scipy.sparse as sparse
+import theano
+import theano.tensor as T
+import theano.sparse as tsp
+# noinspection PyUnresolvedReferences
+from lm.real.ops import csr_dot
+
+NB_BASES = 15000
+CODE_NNZ = 30
+EMBED_DIMS = 200
+NB_REPEATS = 10
+
+
+def random_codes(nb_rows):
+    indices = np.concatenate([np.sort(np.random.choice(NB_BASES, CODE_NNZ, replace=False)) for _ in range(nb_rows)])
+    indptr = np.arange(0, nb_rows * CODE_NNZ + 1, CODE_NNZ)
+    data = np.random.rand(nb_rows * CODE_NNZ)
+    return sparse.csr_matrix((data.astype(theano.config.floatX), indices.astype('int32'), indptr.astype('int32')),
+                             shape=(nb_rows, NB_BASES))
+
+
+def compile_step(product, W):
+    codes = tsp.csr_matrix(dtype=theano.config.floatX)
+    out = product(codes, W)
+    return theano.function([codes], [out, T.grad(T.sum(T.sqr(out)), W)])
+
+
+def timed(func, codes):
+    func(codes)
+    start = time.time()
+    for _ in range(NB_REPEATS):
+        ret = func(codes)
+    return (time.time() - start) / NB_REPEATS, ret
+
+
+def structured_dot4(codes, W):
+    return T.stack([tsp.structured_dot(codes, W[i]) for i in range(4)], axis=1)
+
+
+if __name__ == '__main__':
+    np.random.seed(1234)
+    W = theano.shared(np.random.randn(NB_BASES, EMBED_DIMS).astype(theano.config.floatX) * 0.01)
+    W4 = theano.shared(np.random.randn(4, NB_BASES, EMBED_DIMS).astype(theano.config.floatX) * 0.01)
+    steps = [('structured_dot', compile_step(tsp.structured_dot, W)),
+             ('csr_dot', compile_step(csr_dot, W)),
+             ('4 x structured_dot', compile_step(structured_dot4, W4)),
+             ('csr_dot (4, B, d)', compile_step(csr_dot, W4))]
+    print 'openmp: %s, OMP_NUM_THREADS: %s' % (theano.config.openmp, os.environ.get('OMP_NUM_THREADS'))
+    for batch_size in [256, 512, 1024, 3096]:
+        codes = random_codes(batch_size)
+        times = []
+        for i in range(0, len(steps), 2):
+            (_, ref_step), (_, step) = steps[i:i+2]
+            ref_time, ref = timed(ref_step, codes)
+            new_time, ret = timed(step, codes)
+            assert all(np.allclose(a, b, rtol=1e-3, atol=1e-5) for a, b in zip(ref, ret))
+            times += [ref_time, new_time]
+        print '%4d rows: ' % batch_size + ', '.join('%s %.2fms' % (name, t*1e3) for (name, _), t in zip(steps, times))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+# The full softmax of the test function of the sparse-coded models (SharedWeightsDense*) on
+# a validation pass: the output weights decoded from the sparse codes for each batch against
+# decoded once into a shared buffer per pass (DecodedOutputWeights) and a plain GEMM.
+import time
+import numpy as np
+import scipy.sparse as sparse
+import theano
+import theano.tensor as T
+import theano.sparse as tsp
+# noinspection PyUnresolvedReferences
+from lm.real.ops import csr_dot
+
+NB_BASES = 8000
+CODE_NNZ = 30
+CONTEXT_DIMS = 200
+BATCH_WORDS = 512
+NB_BATCHES = 20
+
+
+def random_coding(nb_words, nb_bases, nnz):
+    indices = np.concatenate([np.sort(np.random.choice(nb_bases, nnz, replace=False)) for _ in range(nb_words)])
+    indptr = np.arange(0, nb_words * nnz + 1, nnz)
+    data = np.random.rand(nb_words * nnz)
+    return sparse.csr_matrix((data.astype('float32'), indices.astype('int32'), indptr.astype('int32')),
+                             shape=(nb_words, nb_bases))
+
+
+def validation_pass(f, batches, decode=None):
+    start = time.time()
+    if decode is not None:
+        decode()
+    for x in batches:
+        f(x)
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    np.random.seed(1234)
+    floatX = theano.config.floatX
+    W = theano.shared(np.random.randn(NB_BASES, CONTEXT_DIMS).astype(floatX) * 0.01)
+    b = theano.shared(np.zeros((NB_BASES, 1), dtype=floatX))
+    batches = [np.random.randn(BATCH_WORDS, CONTEXT_DIMS).astype(floatX) for _ in range(NB_BATCHES)]
+    x = T.matrix()
+    print '%d batches of %d words, %d bases, dl=%d, %s' % (NB_BATCHES, BATCH_WORDS, NB_BASES, CONTEXT_DIMS, floatX)
+    for vocab_size in [10000, 20000, 50000]:
+        codes = tsp.as_sparse_variable(random_coding(vocab_size, NB_BASES, CODE_NNZ))
+        W_dec = csr_dot(codes, W).T
+        b_dec = T.flatten(csr_dot(codes, b), 1)
+        W_full = theano.shared(np.zeros((CONTEXT_DIMS, vocab_size), dtype=floatX))
+        b_full = theano.shared(np.zeros((vocab_size,), dtype=floatX))
+        per_batch = theano.function([x], T.nnet.softmax(T.dot(x, W_dec) + b_dec))
+        cached = theano.function([x], T.nnet.softmax(T.dot(x, W_full) + b_full))
+        decode = theano.function([], [], updates=[(W_full, W_dec), (b_full, b_dec)])
+        decode()
+        assert np.allclose(per_batch(batches[0]), cached(batches[0]), atol=1e-6)
+        per_batch_time = validation_pass(per_batch, batches)
+        cached_time = validation_pass(cached, batches, decode)
+        print 'V=%5d: decoded per batch %.0fms, decoded once %.0fms' % \
+            (vocab_size, per_batch_time*1e3, cached_time*1e3)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+# Gathering the sparse codes of the labels and their negative samples of a batch: scipy
+# fancy row indexing against lm.utils.csr_gather.gather_rows, allocating the result or
+# writing it into preallocated buffers.
+import time
+import numpy as np
+import scipy.sparse as sparse
+# noinspection PyUnresolvedReferences
+from lm.utils.csr_gather import gather_rows
+
+NB_WORDS = 50000
+NB_BASES = 15000
+CODE_NNZ = 30
+NB_NEGATIVE = 50
+NB_REPEATS = 20
+
+
+def random_coding(nb_words, nb_bases, nnz):
+    indices = np.concatenate([np.sort(np.random.choice(nb_bases, nnz, replace=False)) for _ in range(nb_words)])
+    indptr = np.arange(0, nb_words * nnz + 1, nnz)
+    data = np.random.rand(nb_words * nnz)
+    return sparse.csr_matrix((data.astype('float32'), indices.astype('int32'), indptr.astype('int32')),
+                             shape=(nb_words, nb_bases))
+
+
+def timed(func):
+    func()
+    start = time.time()
+    for _ in range(NB_REPEATS):
+        ret = func()
+    return (time.time() - start) / NB_REPEATS, ret
+
+
+if __name__ == '__main__':
+    np.random.seed(1234)
+    coding = random_coding(NB_WORDS, NB_BASES, CODE_NNZ)
+    zipf = 1.0 / np.arange(1, NB_WORDS + 1)
+    zipf /= zipf.sum()
+    for batch_size in [256, 512, 1024, 3096]:
+        # labels and noise words follow the unigram distribution, roughly a Zipf law
+        rows = np.random.choice(NB_WORDS, size=(NB_NEGATIVE + 1, batch_size), p=zipf).astype('int32')
+        nnz = rows.size * CODE_NNZ
+        out = (np.empty((nnz,), dtype='float32'), np.empty((nnz,), dtype='int32'),
+               np.empty((rows.size + 1,), dtype='int32'))
+        scipy_time, ref = timed(lambda: coding[rows.ravel()])
+        gather_time, ret = timed(lambda: gather_rows(coding, rows))
+        buf_time, ret_buf = timed(lambda: gather_rows(coding, rows, out))
+        assert abs(ref - ret).sum() == 0 and abs(ref - ret_buf).sum() == 0
+        print '%4d x %d rows: scipy %.2fms, gather_rows %.2fms, with buffers %.2fms' % \
+            (batch_size, NB_NEGATIVE + 1, scipy_time*1e3, gather_time*1e3, buf_time*1e3)
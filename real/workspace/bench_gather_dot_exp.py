@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+# Forward and backward pass of the partial softmax of a batch, the scores of the labels and
+# their k negative samples: the gathered (k+1, ns, d) weights times the features against
+# lm.real.ops.gather_dot_exp. Each variant runs in its own process; the memory is its peak
+# resident size, the compiled function and the parameters (V, d) and their gradients included.
+import resource
+import time
+from multiprocessing import Process, Queue
+import numpy as np
+import theano
+import theano.tensor as T
+# noinspection PyUnresolvedReferences
+from lm.real.ops import gather_dot_exp
+
+VOCAB_SIZE = 50000
+EMBED_DIMS = 200
+BATCH_SIZE = 512
+NB_REPEATS = 10
+
+
+def take_dot_exp(W, b, idxes, features):
+    return T.exp(T.sum(W.take(idxes, axis=0) * features, axis=-1) + b.take(idxes, axis=0))
+
+
+def run(variant, nb_negative, results):
+    rng = np.random.RandomState(1234)
+    W = theano.shared(rng.randn(VOCAB_SIZE, EMBED_DIMS).astype(theano.config.floatX) * 0.01)
+    b = theano.shared(np.zeros((VOCAB_SIZE,), dtype=theano.config.floatX))
+    idxes = T.imatrix()
+    features = T.matrix()
+    probs = variant(W, b, idxes, features)
+    loss = -T.mean(T.log(probs[0] / T.sum(probs, axis=0)))
+    f = theano.function([idxes, features], [loss] + T.grad(loss, [W, b, features]))
+
+    idx_val = rng.randint(0, VOCAB_SIZE, size=(nb_negative + 1, BATCH_SIZE)).astype('int32')
+    feat_val = rng.randn(BATCH_SIZE, EMBED_DIMS).astype(theano.config.floatX)
+    f(idx_val, feat_val)
+    start = time.time()
+    for _ in range(NB_REPEATS):
+        f(idx_val, feat_val)
+    elapsed = (time.time() - start) / NB_REPEATS
+    results.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024., f(idx_val, feat_val)[0]))
+
+
+def measure(variant, nb_negative):
+    results = Queue()
+    p = Process(target=run, args=(variant, nb_negative, results))
+    p.start()
+    ret = results.get()
+    p.join()
+    return ret
+
+
+if __name__ == '__main__':
+    print 'V=%d, d=%d, batch %d, %s' % (VOCAB_SIZE, EMBED_DIMS, BATCH_SIZE, theano.config.floatX)
+    for k in [50, 100, 150, 200]:
+        take_time, take_mem, take_loss = measure(take_dot_exp, k)
+        fused_time, fused_mem, fused_loss = measure(gather_dot_exp, k)
+        assert abs(take_loss - fused_loss) < 1e-3 * abs(take_loss)
+        print 'k=%3d: take %.1fms %.0fMB, gather_dot_exp %.1fms %.0fMB' % \
+            (k, take_time*1e3, take_mem, fused_time*1e3, fused_mem)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+# Compare the alias method sampler with the scipy rv_discrete sampler TableSampler used
+# to be, drawing nb_negative noise words for each word of a batch. rv_discrete compares
+# every draw with the whole CDF at once, so it is timed on a part of the draws only.
+import time
+import numpy as np
+from scipy.stats import rv_discrete
+# noinspection PyUnresolvedReferences
+from lm.utils.sampler import AliasSampler
+
+BATCH_WORDS = 256 * 64
+NB_NEGATIVE = 50
+NB_BATCHES = 5
+# max number of CDF entries rv_discrete compares in one call
+MAX_CMP = 2**25
+
+
+def zipf_table(nb_words):
+    table = 1.0 / np.arange(1, nb_words + 1)
+    return (table / table.sum()).astype('float32')
+
+
+def rv_discrete_draw(table, out):
+    """
+    :return: number of draws
+    """
+    sampler = rv_discrete(b=len(table)-1, values=(np.arange(len(table)), table))
+    flat = out.reshape(-1)
+    step = max(1, MAX_CMP // len(table))
+    nb_draws = min(flat.size, 2**28 // len(table))
+    for start in range(0, nb_draws, step):
+        end = min(start + step, nb_draws)
+        flat[start:end] = sampler.rvs(size=end-start)
+    return nb_draws
+
+
+def alias_draw(table, out):
+    sampler = AliasSampler(table)
+    for _ in range(NB_BATCHES):
+        sampler.sample_into(out)
+    return out.size * NB_BATCHES
+
+
+if __name__ == '__main__':
+    np.random.seed(1234)
+    out = np.empty((NB_NEGATIVE, BATCH_WORDS), dtype='int32')
+    for nb_words in [10000, 50000, 300000]:
+        table = zipf_table(nb_words)
+        for name, func in [('rv_discrete', rv_discrete_draw), ('alias', alias_draw)]:
+            start = time.time()
+            nb_draws = func(table, out)
+            elapsed = time.time() - start
+            print 'V=%d %-12s %d draws in %.2fs, %.2fM draws/s' % (nb_words, name, nb_draws, elapsed,
+                                                                  nb_draws/elapsed/1e6)
+        freq = np.bincount(out.ravel(), minlength=nb_words) / float(out.size)
+        print 'V=%d alias max frequency error: %.5f' % (nb_words, np.abs(freq - table).max())
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+# Compare BlockTokenizer with the per word dict lookup binarize_corpus used to do.
+# BlockTokenizer runs a single pass numba kernel when numba is installed, and
+# vectorized numpy operations otherwise.
+import time
+import numpy as np
+# noinspection PyUnresolvedReferences
+from lm.utils.tokenizer import BlockTokenizer, line_blocks
+
+NB_LINES = 200000
+BLOCK_SIZE = 20000
+
+
+def make_corpus(nb_words, nb_lines, rng):
+    idx2word = ['w%d' % i for i in range(nb_words)]
+    wp = {'idx2word': idx2word, 'idx2wc': range(nb_words, 0, -1),
+          'word2idx': dict((w, i) for i, w in enumerate(idx2word))}
+    lens = rng.randint(3, 65, size=nb_lines)
+    idxes = np.minimum(rng.zipf(1.2, size=lens.sum()) - 1, nb_words - 1)
+    lines = []
+    start = 0
+    for l in lens:
+        lines.append(' '.join(idx2word[i] for i in idxes[start:start+l]) + '\n')
+        start += l
+    return wp, lines
+
+
+def dict_loop(wp, lines):
+    word2idx = wp['word2idx']
+    for block in line_blocks(lines, BLOCK_SIZE):
+        for sent in block:
+            _ = [word2idx[w] for w in sent.split()]
+
+
+def block_tokenizer(tokenizer, lines):
+    for block in line_blocks(lines, BLOCK_SIZE):
+        tokenizer.tokenize(block)
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(1234)
+    for nb_words in [10000, 300000]:
+        wp, lines = make_corpus(nb_words, NB_LINES, rng)
+        nb_tokens = sum(len(line.split()) for line in lines)
+        start = time.time()
+        tokenizer = BlockTokenizer(wp)
+        print 'V=%d building the tokenizer took %.2fs' % (nb_words, time.time() - start)
+        for name, func, arg in [('dict loop', dict_loop, wp), ('block tokenizer', block_tokenizer, tokenizer)]:
+            start = time.time()
+            func(arg, lines)
+            elapsed = time.time() - start
+            print 'V=%d %-16s %.2fs, %.2fM words/s' % (nb_words, name, elapsed, nb_tokens/elapsed/1e6)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+# Gathering and decoding the output weights of the labels and their negative samples of a
+# batch: every row as it comes against only the distinct ones (lm.utils.csr_gather.unique_rows)
+# expanded back by position, which is what the sparse-coded partial softmax layers are fed.
+import time
+import numpy as np
+import scipy.sparse as sparse
+# noinspection PyUnresolvedReferences
+from lm.utils.csr_gather import gather_rows, unique_rows
+
+NB_WORDS = 50000
+NB_BASES = 15000
+CODE_NNZ = 30
+EMBED_DIMS = 200
+NB_REPEATS = 10
+
+
+def random_coding(nb_words, nb_bases, nnz):
+    indices = np.concatenate([np.sort(np.random.choice(nb_bases, nnz, replace=False)) for _ in range(nb_words)])
+    indptr = np.arange(0, nb_words * nnz + 1, nnz)
+    data = np.random.rand(nb_words * nnz)
+    return sparse.csr_matrix((data.astype('float32'), indices.astype('int32'), indptr.astype('int32')),
+                             shape=(nb_words, nb_bases))
+
+
+def timed(func):
+    func()
+    start = time.time()
+    for _ in range(NB_REPEATS):
+        ret = func()
+    return (time.time() - start) / NB_REPEATS, ret
+
+
+def decode_all(coding, W, rows):
+    return gather_rows(coding, rows).dot(W)
+
+
+def decode_unique(coding, W, rows, nb_fixed):
+    uniq, poses = unique_rows(rows, nb_fixed)
+    return gather_rows(coding, uniq).dot(W)[poses]
+
+
+if __name__ == '__main__':
+    np.random.seed(1234)
+    coding = random_coding(NB_WORDS, NB_BASES, CODE_NNZ)
+    W = np.random.randn(NB_BASES, EMBED_DIMS).astype('float32')
+    zipf = 1.0 / np.arange(1, NB_WORDS + 1)
+    zipf /= zipf.sum()
+    batch_size = 512
+    for nb_negative in [50, 100, 200]:
+        # labels and noise words follow the unigram distribution, roughly a Zipf law
+        rows = np.random.choice(NB_WORDS, size=(nb_negative + 1, batch_size), p=zipf).astype('int32')
+        nb_unique = unique_rows(rows, batch_size)[0].size
+        all_time, ref = timed(lambda: decode_all(coding, W, rows))
+        uniq_time, ret = timed(lambda: decode_unique(coding, W, rows, batch_size))
+        assert np.allclose(ref, ret, atol=1e-4)
+        print '%d x %3d rows (%5d to decode): all %.1fms, unique %.1fms' % \
+            (batch_size, nb_negative + 1, nb_unique, all_time*1e3, uniq_time*1e3)
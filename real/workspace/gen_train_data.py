@@ -2,10 +2,13 @@
 # -*- coding: utf-8 -*-
 __author__ = 'Yunchuan Chen'
 # noinspection PyUnresolvedReferences
-from lm.utils.preprocess import grouped_sentences, smart_open
+from lm.utils.preprocess import smart_open
+# noinspection PyUnresolvedReferences
+from lm.utils.corpus import grouped_sentences_at
 import numpy as np
 
-DATA_PATH = '../../data/corpus/wiki-sg-norm-lc-drop-bin.bz2'
+# an indexed corpus, see lm.utils.corpus.convert_corpus
+DATA_PATH = '../../data/corpus/wiki-sg-norm-lc-drop-bin.mm'
 DATA_DIST = '../../data/corpus/wiki-sg-norm-lc-drop-bin-sample0.2B.bz2'
 
 
@@ -20,24 +23,14 @@ total_size = 200000000
 nb_words = 0
 
 dist_file = smart_open(DATA_DIST, 'wb')
-sents = grouped_sentences(DATA_PATH)
-for chunk in sents:
-    if nb_words > first_chunk_size:
-        break
+for chunk in grouped_sentences_at(DATA_PATH, 0, first_chunk_size):
     nb_words += chunk.size
     _commit_result(dist_file, chunk)
 
-nb_words_ = nb_words
-for chunk in sents:
-    nb_words_ += chunk.size
-    if nb_words_ > next_chunk_start:
-        break
-
-for chunk in sents:
+for chunk in grouped_sentences_at(DATA_PATH, next_chunk_start):
     if nb_words >= total_size:
         break
     nb_words += chunk.size
     _commit_result(dist_file, chunk)
 
 dist_file.close()
-
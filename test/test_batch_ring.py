@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+from multiprocessing import Queue
+import numpy as np
+import scipy.sparse as sparse
+# noinspection PyUnresolvedReferences
+from lm.utils.batch_ring import BatchRing
+# noinspection PyUnresolvedReferences
+from lm.utils.csr_gather import gather_rows
+__author__ = 'Yunchuan Chen'
+
+
+class BatchRingTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1234)
+        self.coding = sparse.csr_matrix(rng.rand(50, 20) * (rng.rand(50, 20) < 0.3), dtype='float32')
+        self.ring = BatchRing(2, [('array', 'int32', 10), ('csr', 'float32', 200, 10)])
+        self.queue = Queue()
+
+    def test_copied(self):
+        rows = np.array([3, 7, 3, 0], dtype='int32')
+        self.ring.put(self.queue, (rows, gather_rows(self.coding, rows)))
+        x, sp = self.ring.take(self.queue)
+        self.assertTrue(np.array_equal(x, rows))
+        self.assertTrue(np.array_equal(sp.toarray(), self.coding[rows].toarray()))
+
+    def test_in_place(self):
+        rows = np.array([9, 1, 1, 42, 5], dtype='int32')
+        slot = self.ring.reserve()
+        sp = gather_rows(self.coding, rows, out=self.ring.csr_buffers(slot, 1))
+        self.assertEqual(sp.data.ctypes.data, self.ring.csr_buffers(slot, 1)[0].ctypes.data)
+        self.ring.put(self.queue, (rows, sp), slot)
+        x, sp = self.ring.take(self.queue)
+        self.assertTrue(np.array_equal(x, rows))
+        self.assertTrue(np.array_equal(sp.toarray(), self.coding[rows].toarray()))
+
+    def test_too_large(self):
+        rows = np.arange(12, dtype='int32')
+        slot = self.ring.reserve()
+        self.assertRaises(ValueError, gather_rows, self.coding, rows, out=self.ring.csr_buffers(slot, 1))
+        self.ring.put(self.queue, (rows, gather_rows(self.coding, rows)), slot)
+        x, sp = self.ring.take(self.queue)
+        self.assertTrue(np.array_equal(sp.toarray(), self.coding[rows].toarray()))
+        # the slot is given back
+        self.assertEqual(sorted([self.ring.reserve(), self.ring.reserve()]), [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import bz2
+import shutil
+import tempfile
+import unittest
+from collections import deque
+# noinspection PyUnresolvedReferences
+from lm.utils.compress import MultiStreamBZ2Writer, ParallelBZ2Reader, find_bz2_streams, _decompress_streams
+__author__ = 'Yunchuan Chen'
+
+
+class ParallelBZ2ReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.tmp_dir, 'corpus.bz2')
+        lines = ['%d %s\n' % (i, 'word ' * (i % 17)) for i in range(100000)]
+        self.text = ''.join(lines)
+        with MultiStreamBZ2Writer(self.fname, stream_size=2**20) as f:
+            f.writelines(lines)
+        with open(self.fname, 'rb') as f:
+            self.raw = f.read()
+        self.offsets = find_bz2_streams(self.fname)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def decompress_each_stream(self):
+        bounds = self.offsets + [len(self.raw)]
+        return ''.join(bz2.decompress(self.raw[start:end]) for start, end in zip(bounds[:-1], bounds[1:]))
+
+    def test_unfinished_stream(self):
+        # the output of an unfinished stream is left to the call which completes it
+        data, rest = _decompress_streams(self.raw[:self.offsets[1] - 20])
+        self.assertEqual(data, '')
+        self.assertTrue(rest == self.raw[:self.offsets[1] - 20], 'the unfinished stream is not returned')
+        data, rest = _decompress_streams(self.raw[:self.offsets[2] - 20])
+        self.assertTrue(data == bz2.decompress(self.raw[:self.offsets[1]]), 'the first stream differs')
+        self.assertTrue(rest == self.raw[self.offsets[1]:self.offsets[2] - 20], 'the unfinished stream is not returned')
+
+    def test_false_stream_header(self):
+        self.assertTrue(len(self.offsets) > 2)
+        reader = ParallelBZ2Reader(self.fname, nb_workers=2, job_size=1)
+        # split the first stream as a header pattern inside its compressed data would
+        fake = self.offsets[1] - 20
+        reader._job_ranges = deque(reader._merge_ranges(sorted(self.offsets + [fake, len(self.raw)])))
+        try:
+            data = reader.read()
+        finally:
+            reader.close()
+        self.assertEqual(len(data), len(self.text))
+        self.assertTrue(data == self.decompress_each_stream(), 'the data differs from bz2.decompress')
+        self.assertTrue(data == self.text, 'the data differs from what was written')
+
+
+if __name__ == '__main__':
+    unittest.main()
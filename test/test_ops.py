@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+import numpy as np
+import scipy.sparse as sparse
+import theano
+import theano.tensor as T
+import theano.sparse as tsp
+from theano.gradient import verify_grad
+# noinspection PyUnresolvedReferences
+from lm.real.ops import csr_dot, gather_dot_exp
+__author__ = 'Yunchuan Chen'
+
+
+class CSRDotTest(unittest.TestCase):
+    def setUp(self):
+        self.rng = np.random.RandomState(1234)
+        # a row without non zeros and a base used by no row
+        dense = self.rng.rand(6, 9) * (self.rng.rand(6, 9) < 0.4)
+        dense[2] = 0.
+        dense[:, 4] = 0.
+        self.codes = sparse.csr_matrix(dense.astype(theano.config.floatX))
+
+    def check(self, W):
+        codes = tsp.as_sparse_variable(self.codes)
+        out = theano.function([], csr_dot(codes, theano.shared(W)))()
+        if W.ndim == 2:
+            expected = self.codes.dot(W)
+        else:
+            expected = np.stack([self.codes.dot(W[g]) for g in range(W.shape[0])], axis=1)
+        self.assertTrue(np.allclose(out, expected))
+        verify_grad(lambda W_: csr_dot(codes, W_), [W], rng=self.rng)
+
+    def test_matrix(self):
+        self.check(self.rng.randn(9, 5).astype(theano.config.floatX))
+
+    def test_gates(self):
+        self.check(self.rng.randn(4, 9, 5).astype(theano.config.floatX))
+
+
+class GatherDotExpTest(unittest.TestCase):
+    def test_grad(self):
+        rng = np.random.RandomState(1234)
+        floatX = theano.config.floatX
+        W = rng.randn(10, 4).astype(floatX) * 0.5
+        b = rng.randn(10).astype(floatX) * 0.5
+        features = rng.randn(2, 3, 4).astype(floatX) * 0.5
+        # the labels followed by their noise words, with repeated words
+        idxes = rng.randint(0, 10, size=(3, 2, 3)).astype('int32')
+        idxes[1] = idxes[0]
+        idx_var = T.as_tensor_variable(idxes)
+
+        out = gather_dot_exp(theano.shared(W), theano.shared(b), idx_var, theano.shared(features))
+        out = theano.function([], out)()
+        self.assertTrue(np.allclose(out, np.exp(np.sum(W[idxes] * features, axis=-1) + b[idxes])))
+        verify_grad(lambda W_, b_, h_: gather_dot_exp(W_, b_, idx_var, h_), [W, b, features], rng=rng)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import unittest
+from multiprocessing.pool import ThreadPool
+import numpy as np
+# noinspection PyUnresolvedReferences
+from lm.utils import philox
+# noinspection PyUnresolvedReferences
+from lm.utils.philox import CounterRNG, parallel_sample_into
+# noinspection PyUnresolvedReferences
+from lm.utils.sampler import AliasSampler
+__author__ = 'Yunchuan Chen'
+
+SEED = 0x123456789ABCDEF
+
+
+class PhiloxTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1234)
+        table = rng.rand(1000)
+        self.sampler = AliasSampler(table / table.sum())
+
+    def test_offsets(self):
+        # a stream read from any offset gives the same numbers as read from its start
+        stream = CounterRNG(SEED, 7, 3).random_sample(40)
+        for offset in range(8):
+            for size in range(1, 10):
+                part = CounterRNG(SEED, 7, 3, offset).random_sample(size)
+                self.assertTrue(np.array_equal(part, stream[offset:offset+size]), (offset, size))
+
+    def test_parts(self):
+        pool = ThreadPool(3)
+        try:
+            for size in [1, 6, 7, 13, 1001]:
+                ref = parallel_sample_into(self.sampler, np.empty((size,), dtype='int32'), SEED, 11)
+                for nb_parts in [2, 7]:
+                    for p in [None, pool]:
+                        out = parallel_sample_into(self.sampler, np.empty((size,), dtype='int32'), SEED, 11,
+                                                   pool=p, nb_parts=nb_parts)
+                        self.assertTrue(np.array_equal(out, ref), (size, nb_parts, p))
+        finally:
+            pool.close()
+
+    def test_keys(self):
+        out = [parallel_sample_into(self.sampler, np.empty((100,), dtype='int32'), SEED, batch, stream)
+               for batch, stream in [(0, 0), (1, 0), (0, 1)]]
+        self.assertFalse(np.array_equal(out[0], out[1]))
+        self.assertFalse(np.array_equal(out[0], out[2]))
+
+    @unittest.skipIf(philox.numba is None, 'numba is not installed')
+    def test_numba_kernel(self):
+        k0, k1 = SEED & 0xFFFFFFFF, SEED >> 32
+        for offset in range(4):
+            for size in range(7):
+                ref = np.empty((size,))
+                out = np.empty((size,))
+                philox._uniform_py(k0, k1, 5, 2, offset, ref)
+                philox._uniform(k0, k1, 5, 2, offset, out)
+                self.assertTrue(np.array_equal(out, ref), (offset, size))
+
+
+if __name__ == '__main__':
+    unittest.main()
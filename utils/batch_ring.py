@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+import ctypes
+import numpy as np
+from multiprocessing import Array, Queue
+# noinspection PyUnresolvedReferences
+from lm.utils.csr_gather import csr_view
+
+_CTYPES = {np.dtype('int32'): ctypes.c_int32, np.dtype('int64'): ctypes.c_int64,
+           np.dtype('float32'): ctypes.c_float, np.dtype('float64'): ctypes.c_double}
+
+
+class _SlotRef(object):
+    """
+    What goes through the queue for a batch written into the ring: the slot and, for each
+    item, its shape (and the number of non zeros of a CSR matrix).
+    """
+    def __init__(self, slot, metas):
+        self.slot = slot
+        self.metas = metas
+
+
+class BatchRing(object):
+    """
+    Fixed capacity slots in shared memory for passing batches from the data workers to
+    the trainer. A batch is a tuple of dense arrays and CSR matrices; the workers write
+    them into a free slot and only the slot id and the shapes go through the queue. The
+    trainer gets views of the slot (the CSR matrices are rebuilt from the views of their
+    data, indices and indptr), and the slot is given back when the trainer takes the next
+    batch, so a batch must not be used after that.
+
+    A batch too large for the slots is sent through the queue as it is.
+    """
+    def __init__(self, nb_slots, specs):
+        """
+        :param nb_slots: number of slots
+        :param specs: one per item of the batches, ('array', dtype, size) for a dense array
+        of at most size elements, or ('csr', dtype, nnz, nb_rows) for a CSR matrix with at
+        most nnz non zeros and nb_rows rows and int32 indices.
+        """
+        if nb_slots < 2:
+            raise ValueError('a batch ring needs at least 2 slots')
+        self.nb_slots = nb_slots
+        self.specs = specs
+        self._buffers = []
+        for spec in specs:
+            if spec[0] == 'array':
+                self._buffers.append([self._alloc(spec[1], spec[2])])
+            elif spec[0] == 'csr':
+                self._buffers.append([self._alloc(spec[1], spec[2]), self._alloc('int32', spec[2]),
+                                      self._alloc('int32', spec[3] + 1)])
+            else:
+                raise ValueError('unknown item kind: %s' % spec[0])
+        self.free = Queue()
+        for slot in range(nb_slots):
+            self.free.put(slot)
+        self._held = None
+
+    def _alloc(self, dtype, size):
+        dtype = np.dtype(dtype)
+        buf = Array(_CTYPES[dtype], self.nb_slots * max(1, size), lock=False)
+        return np.frombuffer(buf, dtype=dtype).reshape((self.nb_slots, max(1, size)))
+
+    def _fits(self, items):
+        for spec, item in zip(self.specs, items):
+            if spec[0] == 'array':
+                if item.size > spec[2]:
+                    return False
+            elif item.nnz > spec[2] or item.shape[0] > spec[3]:
+                return False
+        return True
+
+    def reserve(self):
+        """
+        :return: a free slot, waiting for one if needed, for writing a batch in place before
+        it is handed over by put.
+        """
+        return self.free.get()
+
+    def csr_buffers(self, slot, index):
+        """
+        :return: the (data, indices, indptr) buffers of the CSR item index of slot, e.g. the
+        out buffers of lm.utils.csr_gather.gather_rows.
+        """
+        return tuple(buf[slot] for buf in self._buffers[index])
+
+    def put(self, queue, items, slot=None):
+        """
+        Write items into a free slot, waiting for one if needed, and put its reference in queue.
+        :param slot: the slot of reserve; the items already written into it are not copied
+        """
+        if not self._fits(items):
+            if slot is not None:
+                # the items may be views of the slot, which another worker can take from now on
+                items = [item.copy() for item in items]
+                self.free.put(slot)
+            queue.put(tuple(items))
+            return
+        if slot is None:
+            slot = self.free.get()
+        metas = []
+        for spec, bufs, item in zip(self.specs, self._buffers, items):
+            if spec[0] == 'array':
+                bufs[0][slot, :item.size] = item.ravel()
+                metas.append(item.shape)
+            else:
+                if not self._in_slot(item, bufs, slot):
+                    bufs[0][slot, :item.nnz] = item.data[:item.nnz]
+                    bufs[1][slot, :item.nnz] = item.indices[:item.nnz]
+                    bufs[2][slot, :item.shape[0]+1] = item.indptr
+                metas.append((item.shape, item.nnz))
+        queue.put(_SlotRef(slot, metas))
+
+    @staticmethod
+    def _in_slot(item, bufs, slot):
+        return all(arr.ctypes.data == buf[slot].ctypes.data
+                   for arr, buf in zip((item.data, item.indices, item.indptr), bufs))
+
+    def release(self):
+        """
+        Give back the slot of the last batch taken, if any.
+        """
+        if self._held is not None:
+            self.free.put(self._held)
+            self._held = None
+
+    def take(self, queue):
+        """
+        :return: the next batch from queue as a tuple of views of its slot. The slot of the
+        batch taken before is given back first.
+        """
+        item = queue.get()
+        self.release()
+        if not isinstance(item, _SlotRef):
+            return item
+        slot = item.slot
+        items = []
+        for spec, bufs, meta in zip(self.specs, self._buffers, item.metas):
+            if spec[0] == 'array':
+                items.append(bufs[0][slot, :int(np.prod(meta))].reshape(meta))
+            else:
+                shape, nnz = meta
+                items.append(csr_view(bufs[0][slot, :nnz], bufs[1][slot, :nnz], bufs[2][slot, :shape[0]+1], shape))
+        self._held = slot
+        return tuple(items)
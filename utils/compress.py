@@ -0,0 +1,509 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+import os
+import re
+import bz2
+import zlib
+import logging
+from collections import deque
+from multiprocessing import Pool, cpu_count
+
+logger = logging.getLogger('lm.utils.compress')
+
+# every bz2 stream starts with the stream header 'BZh[1-9]' which is immediately followed by
+# the magic number of its first block (the BCD digits of pi). The block boundaries inside a
+# stream are not byte aligned, so streams are the unit of parallel decompression.
+_BZ2_STREAM_HEADER = re.compile(r'BZh[1-9]1AY&SY')
+_SCAN_SIZE = 16*2**20
+
+
+def _stream_finished(decompressor):
+    try:
+        return decompressor.eof
+    except AttributeError:
+        try:
+            decompressor.decompress('')
+        except EOFError:
+            return True
+        return False
+
+
+def _decompress_streams(raw):
+    """
+    :param raw: a string which holds one or more concatenated bz2 streams
+    :return: a tuple of the decompressed data of the complete streams and the tail of raw
+    which does not form a complete stream (empty if all the streams are complete).
+    """
+    out = []
+    while raw:
+        decompressor = bz2.BZ2Decompressor()
+        try:
+            data = decompressor.decompress(raw)
+        except IOError:
+            return ''.join(out), raw
+        if not _stream_finished(decompressor):
+            # the tail is decompressed again from its start with the data which follows
+            return ''.join(out), raw
+        out.append(data)
+        raw = decompressor.unused_data
+    return ''.join(out), ''
+
+
+def find_bz2_streams(fname, scan_size=_SCAN_SIZE):
+    """
+    :param fname: a bz2 file
+    :param scan_size: number of bytes to scan at a time
+    :return: list of byte offsets where the bz2 streams (probably) start.
+    A header pattern may also occur inside compressed data by chance; such false
+    boundaries are detected and merged when decompressing.
+    """
+    header_len = 10
+    offsets = []
+    with open(fname, 'rb') as f:
+        base = 0
+        tail = ''
+        while True:
+            data = f.read(scan_size)
+            if not data:
+                break
+            window = tail + data
+            start = base - len(tail)
+            for m in _BZ2_STREAM_HEADER.finditer(window):
+                pos = start + m.start()
+                if not offsets or pos > offsets[-1]:
+                    offsets.append(pos)
+            tail = window[-(header_len-1):]
+            base += len(data)
+    return offsets
+
+
+class BufferedStreamReader(object):
+    """
+    Base of the read-only file-like objects of this module. Subclasses implement
+    _next_data, which returns the next piece of decompressed data or None at the end.
+    """
+    def __init__(self, fname):
+        self.name = fname
+        self.closed = False
+        self._buf = ''
+        self._pos = 0
+        self._offset = 0            # decompressed bytes before self._buf
+
+    def _next_data(self):
+        raise NotImplementedError
+
+    def _fill(self):
+        data = self._next_data()
+        if data is None:
+            return False
+        self._offset += self._pos
+        self._buf = self._buf[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._fill():
+                pass
+            ret = self._buf[self._pos:]
+            self._pos = len(self._buf)
+            return ret
+        while len(self._buf) - self._pos < size:
+            if not self._fill():
+                break
+        ret = self._buf[self._pos:self._pos+size]
+        self._pos += len(ret)
+        return ret
+
+    def readline(self, size=-1):
+        while True:
+            end = self._buf.find('\n', self._pos)
+            if end >= 0 or not self._fill():
+                break
+        end = len(self._buf) if end < 0 else end + 1
+        if 0 <= size < end - self._pos:
+            end = self._pos + size
+        ret = self._buf[self._pos:end]
+        self._pos = end
+        return ret
+
+    def readlines(self, sizehint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    __next__ = next
+
+    def tell(self):
+        return self._offset + self._pos
+
+    def close(self):
+        self.closed = True
+        self._buf = ''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ParallelBZ2Reader(BufferedStreamReader):
+    """
+    A read-only file-like object over a bz2 file. Multi-stream files (e.g. written by
+    MultiStreamBZ2Writer or pbzip2) are decompressed by a pool of processes, several
+    streams per job, and the data is returned in order. Single-stream files are
+    decompressed in this process.
+    """
+    def __init__(self, fname, nb_workers=None, job_size=4*2**20, buffering=5*2**20):
+        super(ParallelBZ2Reader, self).__init__(fname)
+        self.nb_workers = cpu_count() if nb_workers is None else nb_workers
+        self.job_size = job_size
+        self.buffering = buffering
+        self._raw = open(fname, 'rb')
+        self._pool = None
+        self._jobs = deque()
+
+        offsets = find_bz2_streams(fname) if self.nb_workers > 1 else [0]
+        if len(offsets) > 1:
+            offsets.append(os.path.getsize(fname))
+            self._job_ranges = deque(self._merge_ranges(offsets))
+            self._pool = Pool(self.nb_workers)
+            self._decompressor = None
+        else:
+            self._job_ranges = None
+            self._decompressor = bz2.BZ2Decompressor()
+
+    def _merge_ranges(self, offsets):
+        start = offsets[0]
+        for end in offsets[1:]:
+            if end - start >= self.job_size or end == offsets[-1]:
+                yield start, end
+                start = end
+
+    def _submit(self):
+        while self._job_ranges and len(self._jobs) < 2*self.nb_workers:
+            start, end = self._job_ranges.popleft()
+            self._raw.seek(start)
+            raw = self._raw.read(end - start)
+            self._jobs.append((raw, self._pool.apply_async(_decompress_streams, (raw, ))))
+
+    def _next_parallel(self):
+        self._submit()
+        if not self._jobs:
+            return None
+        raw, job = self._jobs.popleft()
+        data, rest = job.get()
+        if rest:
+            # a false stream boundary: decompress the remainder together with the
+            # following jobs in this process until the streams are complete again.
+            out = [data]
+            while rest:
+                if not self._jobs:
+                    self._submit()
+                if not self._jobs:
+                    break
+                raw_, job_ = self._jobs.popleft()
+                job_.wait()
+                data, rest = _decompress_streams(rest + raw_)
+                out.append(data)
+            if rest:
+                raise IOError('invalid bz2 data in %s' % self.name)
+            data = ''.join(out)
+        return data
+
+    def _next_serial(self):
+        while True:
+            raw = self._raw.read(self.buffering)
+            if not raw:
+                return None
+            data = []
+            while raw:
+                data.append(self._decompressor.decompress(raw))
+                raw = ''
+                if _stream_finished(self._decompressor):
+                    raw = self._decompressor.unused_data
+                    self._decompressor = bz2.BZ2Decompressor()
+            data = ''.join(data)
+            if data:
+                return data
+
+    def _next_data(self):
+        return self._next_parallel() if self._pool is not None else self._next_serial()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        self._raw.close()
+        super(ParallelBZ2Reader, self).close()
+
+
+class MultiStreamBZ2Writer(object):
+    """
+    A write-only file-like object which compresses every stream_size bytes of data into
+    an independent bz2 stream, so the file can be decompressed in parallel by
+    ParallelBZ2Reader. The streams are compressed by a pool of processes when
+    nb_workers > 1. The result is a valid bz2 file for bzip2 and other multi-stream
+    aware readers.
+    """
+    def __init__(self, fname, stream_size=8*2**20, compresslevel=9, nb_workers=1):
+        self.name = fname
+        self.stream_size = stream_size
+        self.compresslevel = compresslevel
+        self.nb_workers = nb_workers
+        self.closed = False
+        self._raw = open(fname, 'wb')
+        self._buf = []
+        self._buf_size = 0
+        self._offset = 0
+        self._pool = Pool(nb_workers) if nb_workers > 1 else None
+        self._jobs = deque()
+
+    def _flush_stream(self):
+        if self._buf_size == 0:
+            return
+        data = ''.join(self._buf)
+        self._buf = []
+        self._buf_size = 0
+        if self._pool is None:
+            self._raw.write(bz2.compress(data, self.compresslevel))
+            return
+        self._jobs.append(self._pool.apply_async(bz2.compress, (data, self.compresslevel)))
+        while len(self._jobs) > 2*self.nb_workers:
+            self._raw.write(self._jobs.popleft().get())
+
+    def write(self, data):
+        self._buf.append(data)
+        self._buf_size += len(data)
+        self._offset += len(data)
+        if self._buf_size >= self.stream_size:
+            self._flush_stream()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def tell(self):
+        return self._offset
+
+    def close(self):
+        if self.closed:
+            return
+        self._flush_stream()
+        while self._jobs:
+            self._raw.write(self._jobs.popleft().get())
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._raw.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class StreamReader(BufferedStreamReader):
+    """
+    A read-only file-like object which decompresses a file in this process with
+    decompressor objects (zlib.decompressobj style) created by new_decompressor.
+    Concatenated members (e.g. of gzip files) are handled via unused_data.
+    """
+    def __init__(self, fname, new_decompressor, buffering=5*2**20):
+        super(StreamReader, self).__init__(fname)
+        self.buffering = buffering
+        self._new_decompressor = new_decompressor
+        self._decompressor = new_decompressor()
+        self._raw = open(fname, 'rb')
+
+    def _next_data(self):
+        while True:
+            raw = self._raw.read(self.buffering)
+            if not raw:
+                if hasattr(self._decompressor, 'flush'):
+                    data = self._decompressor.flush()
+                    self._decompressor = self._new_decompressor()
+                    if data:
+                        return data
+                return None
+            data = []
+            while raw:
+                data.append(self._decompressor.decompress(raw))
+                raw = getattr(self._decompressor, 'unused_data', None) or ''
+                if raw:
+                    self._decompressor = self._new_decompressor()
+            data = ''.join(data)
+            if data:
+                return data
+
+    def close(self):
+        if self.closed:
+            return
+        self._raw.close()
+        super(StreamReader, self).close()
+
+
+class StreamWriter(object):
+    """
+    A write-only file-like object which compresses data with a compressor object
+    (zlib.compressobj style, i.e. with compress and flush methods).
+    """
+    def __init__(self, fname, compressor, buffering=5*2**20):
+        self.name = fname
+        self.closed = False
+        self._compressor = compressor
+        self._raw = open(fname, 'wb', buffering)
+        self._offset = 0
+
+    def write(self, data):
+        self._offset += len(data)
+        self._raw.write(self._compressor.compress(data))
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def tell(self):
+        return self._offset
+
+    def close(self):
+        if self.closed:
+            return
+        self._raw.write(self._compressor.flush())
+        self._raw.close()
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _LZ4Compressor(object):
+    def __init__(self, level):
+        import lz4.frame
+        self._compressor = lz4.frame.LZ4FrameCompressor(compression_level=level)
+        self._header = self._compressor.begin()
+
+    def compress(self, data):
+        out = self._header + self._compressor.compress(data)
+        self._header = ''
+        return out
+
+    def flush(self):
+        return self._header + self._compressor.flush()
+
+
+def _open_bz2(fname, mode, buffering, nb_workers=None, multistream=False, level=None):
+    if 'r' in mode:
+        return ParallelBZ2Reader(fname, nb_workers=nb_workers, buffering=buffering)
+    level = 9 if level is None else level
+    if multistream:
+        return MultiStreamBZ2Writer(fname, compresslevel=level, nb_workers=1 if nb_workers is None else nb_workers)
+    return bz2.BZ2File(fname, mode, buffering, compresslevel=level)
+
+
+def _open_gzip(fname, mode, buffering, level=None, **kwargs):
+    # zlib with the gzip header is much faster than reading lines through gzip.GzipFile
+    if 'r' in mode:
+        return StreamReader(fname, lambda: zlib.decompressobj(16+zlib.MAX_WBITS), buffering)
+    level = 6 if level is None else level
+    return StreamWriter(fname, zlib.compressobj(level, zlib.DEFLATED, 16+zlib.MAX_WBITS), buffering)
+
+
+def _open_zstd(fname, mode, buffering, level=None, **kwargs):
+    import zstandard
+    if 'r' in mode:
+        return StreamReader(fname, lambda: zstandard.ZstdDecompressor().decompressobj(), buffering)
+    level = 3 if level is None else level
+    return StreamWriter(fname, zstandard.ZstdCompressor(level=level).compressobj(), buffering)
+
+
+def _open_lz4(fname, mode, buffering, level=None, **kwargs):
+    import lz4.frame
+    if 'r' in mode:
+        return StreamReader(fname, lz4.frame.LZ4FrameDecompressor, buffering)
+    return StreamWriter(fname, _LZ4Compressor(0 if level is None else level), buffering)
+
+
+_CODECS = {'.bz2': _open_bz2,
+           '.gz': _open_gzip,
+           '.zst': _open_zstd,
+           '.lz4': _open_lz4}
+
+# fast codecs in order of preference and the python module each one needs
+_FAST_CODECS = (('.zst', 'zstandard'), ('.lz4', 'lz4.frame'), ('.gz', 'zlib'))
+
+
+def register_codec(ext, opener):
+    """
+    :param ext: file extension, e.g. '.xz'
+    :param opener: a function (fname, mode, buffering, **kwargs) -> file-like object
+    """
+    _CODECS[ext] = opener
+
+
+def is_compressed(fname):
+    """
+    :param fname: file name
+    :return: True if smart_open decompresses the file, i.e. it can not be seeked into.
+    """
+    return os.path.splitext(fname)[1] in _CODECS
+
+
+def fast_codec():
+    """
+    :return: extension of the fastest codec available. Falls back to gzip, which
+    only needs the standard library.
+    """
+    for ext, module in _FAST_CODECS:
+        try:
+            __import__(module)
+        except ImportError:
+            continue
+        return ext
+    return '.gz'
+
+
+def smart_open(fname, mode='rb', buffering=5*2**20, nb_workers=None, multistream=False, level=None):
+    """
+    :param fname: file name. The compression is chosen by the extension: .bz2, .gz,
+    .zst (needs zstandard), .lz4 (needs lz4) or anything registered by register_codec.
+    Other files are opened as plain files.
+    :param mode: open mode
+    :param buffering: buffer size
+    :param nb_workers: number of processes used to (de)compress bz2 files. None means
+    all the cores when reading and one when writing.
+    :param multistream: write bz2 files as multiple streams which can be decompressed
+    in parallel later.
+    :param level: compression level, None for the default of the codec
+    :return: a file-like object
+    """
+    _, ext = os.path.splitext(fname)
+    opener = _CODECS.get(ext)
+    if opener is not None:
+        return opener(fname, mode, buffering, nb_workers=nb_workers, multistream=multistream, level=level)
+    return open(fname, mode, buffering)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+import os
+import logging
+import numpy as np
+
+INDEX_SUFFIX = '.idx'
+logger = logging.getLogger('lm.utils.corpus')
+
+
+def is_indexed_corpus(fname):
+    """
+    :param fname: corpus file name
+    :return: True if fname is the token file of an indexed (memory-mapped) corpus.
+    An indexed corpus is a pair of files: fname holds all the sentences as raw int32
+    word indexes, fname + '.idx' holds one (offset, nb_sents, sent_len) row per group.
+    """
+    return isinstance(fname, basestring) and os.path.isfile(fname + INDEX_SUFFIX)
+
+
+def load_corpus_index(fname):
+    """
+    :param fname: token file of an indexed corpus
+    :return: numpy.ndarray with shape (nb_groups, 3), each row is (offset, nb_sents, sent_len),
+    where offset is counted in words.
+    """
+    with file(fname + INDEX_SUFFIX, 'rb') as f:
+        index = np.load(f)
+    return index
+
+
+class IndexedCorpusWriter(object):
+    """
+    Write groups of equal length sentences into an indexed corpus.
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        self.tokens = file(fname, 'wb')
+        self.index = []
+        self.nb_words = 0
+
+    def write_group(self, sents):
+        """
+        :param sents: a matrix with shape (nb_sents, sent_len) of word indexes
+        :type sents: numpy.ndarray
+        """
+        sents = np.ascontiguousarray(sents, dtype=np.int32)
+        if sents.size == 0:
+            return
+        self.tokens.write(sents.tobytes())
+        self.index.append((self.nb_words, sents.shape[0], sents.shape[1]))
+        self.nb_words += sents.size
+
+    def close(self):
+        if self.tokens is None:
+            return
+        self.tokens.close()
+        self.tokens = None
+        index = np.array(self.index, dtype=np.int64).reshape((-1, 3))
+        with file(self.fname + INDEX_SUFFIX, 'wb') as f:
+            np.save(f, index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def indexed_grouped_sentences(fname, start=0, stop=None):
+    """
+    :param fname: token file of an indexed corpus
+    :param start: index of the first group to yield
+    :param stop: index of the group to stop at (exclusive). None means to the end.
+    :return: generator of int32 matrices with shape (nb_sents, sent_len)
+    The groups are views of a copy-on-write memory map, so they are not copied from
+    the page cache and modifying them in place (e.g. clamping OOV words) does not
+    touch the file.
+    """
+    index = load_corpus_index(fname)
+    if index.shape[0] == 0:
+        return
+    tokens = np.memmap(fname, dtype=np.int32, mode='c')
+    for offset, nb_sents, sent_len in index[start:stop]:
+        yield tokens[offset:offset + nb_sents*sent_len].reshape((nb_sents, sent_len))
+
+
+def group_at_word(index, nb_words):
+    """
+    :param index: group index of an indexed corpus, see load_corpus_index
+    :param nb_words: number of words to skip
+    :return: index of the group a reader is at after skipping nb_words words
+    Skipping follows the way the trainers consume the corpus: whole groups are read
+    until at least nb_words words are consumed, so the group which crosses the boundary
+    is skipped too.
+    """
+    if nb_words <= 0:
+        return 0
+    ends = np.cumsum(index[:, 1] * index[:, 2])
+    return int(np.searchsorted(ends, nb_words, side='left')) + 1
+
+
+def split_groups(index, val_nb_words=100000, train_val_nb=100000):
+    """
+    :param index: group index of an indexed corpus
+    :param val_nb_words: number of words for evaluation after training
+    :param train_val_nb: number of words for validation during training
+    :return: a dict maps 'val', 'train_val' and 'train' to (start, stop) group ranges
+    The splits are the same as the ones the train() methods obtain by calling
+    get_val_data twice on the sentence generator before training.
+    """
+    val_end = min(group_at_word(index, val_nb_words), index.shape[0])
+    ends = np.cumsum(index[:, 1] * index[:, 2])
+    skipped = ends[val_end-1] if val_end > 0 else 0
+    train_val_end = min(group_at_word(index, skipped + train_val_nb), index.shape[0])
+    train_val_end = max(train_val_end, val_end)
+    return {'val': (0, val_end),
+            'train_val': (val_end, train_val_end),
+            'train': (train_val_end, None)}
+
+
+def grouped_sentences_at(fname, start_word=0, stop_word=None):
+    """
+    :param fname: token file of an indexed corpus
+    :param start_word: number of words to skip before reading
+    :param stop_word: stop once this many words (counted from the head of the corpus)
+    are consumed. None means to the end.
+    :return: generator of sentence groups
+    """
+    index = load_corpus_index(fname)
+    start = group_at_word(index, start_word)
+    stop = None if stop_word is None else group_at_word(index, stop_word)
+    return indexed_grouped_sentences(fname, start, stop)
+
+
+def grouped_split(fname, split, val_nb_words=100000, train_val_nb=100000):
+    """
+    :param fname: token file of an indexed corpus
+    :param split: one of 'val', 'train_val' and 'train'
+    :return: generator of sentence groups of the split. See split_groups.
+    """
+    start, stop = split_groups(load_corpus_index(fname), val_nb_words, train_val_nb)[split]
+    return indexed_grouped_sentences(fname, start, stop)
+
+
+def convert_corpus(binary_corpus, dist_file, grouped_sentences=None):
+    """
+    :param binary_corpus: a corpus in the grouped stream format produced by binarize_corpus
+    :param dist_file: token file of the indexed corpus to create
+    :param grouped_sentences: reader of the grouped stream format.
+    :return: number of words converted
+    """
+    if grouped_sentences is None:
+        from preprocess import grouped_sentences
+    with IndexedCorpusWriter(dist_file) as writer:
+        for sents in grouped_sentences(binary_corpus):
+            writer.write_group(sents)
+    logger.info('converted %d words from %s to %s' % (writer.nb_words, binary_corpus, dist_file))
+    return writer.nb_words
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 3:
+        sys.stderr.write('usage: %s BINARY_CORPUS INDEXED_CORPUS\n' % sys.argv[0])
+        sys.exit(1)
+    convert_corpus(sys.argv[1], sys.argv[2])
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+import numpy as np
+import scipy.sparse as sparse
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _row_ptr_py(indptr, rows, out_indptr):
+    out_indptr[0] = 0
+    np.cumsum(indptr[rows + 1] - indptr[rows], out=out_indptr[1:])
+    return int(out_indptr[-1])
+
+
+def _gather_py(data, indices, indptr, rows, out_indptr, out_data, out_indices):
+    nnz = int(out_indptr[-1])
+    # position in data of each output element: the start of its row plus its offset in the row
+    src = np.arange(nnz, dtype=np.int64) + np.repeat(indptr[rows] - out_indptr[:-1], np.diff(out_indptr))
+    np.take(data, src, out=out_data[:nnz])
+    np.take(indices, src, out=out_indices[:nnz])
+
+
+if numba is not None:
+    @numba.jit(nopython=True, nogil=True)
+    def _row_ptr(indptr, rows, out_indptr):
+        nnz = 0
+        out_indptr[0] = 0
+        for k in range(rows.size):
+            r = rows[k]
+            nnz += indptr[r+1] - indptr[r]
+            out_indptr[k+1] = nnz
+        return nnz
+
+    @numba.jit(nopython=True, nogil=True)
+    def _gather(data, indices, indptr, rows, out_indptr, out_data, out_indices):
+        for k in range(rows.size):
+            start = np.int64(indptr[rows[k]])
+            dst = np.int64(out_indptr[k])
+            n = np.int64(out_indptr[k+1]) - dst
+            for j in range(n):
+                out_data[dst+j] = data[start+j]
+            for j in range(n):
+                out_indices[dst+j] = indices[start+j]
+else:
+    _row_ptr = _row_ptr_py
+    _gather = _gather_py
+
+
+def csr_view(data, indices, indptr, shape):
+    """
+    A csr_matrix on the given arrays as they are. The scipy constructor copies arrays which are
+    small views of a larger buffer (see csr_matrix.prune), e.g. the slots of a BatchRing.
+    """
+    ret = sparse.csr_matrix(shape, dtype=data.dtype)
+    ret.data, ret.indices, ret.indptr = data, indices, indptr
+    return ret
+
+
+def gather_rows(matrix, rows, out=None):
+    """
+    Same as matrix[rows] for a CSR matrix and an integer array rows, without the overhead of
+    the scipy fancy indexing: the row pointers of the result are the prefix sums of the
+    lengths of the rows, then the data and indices of the rows are copied in one pass.
+    :param matrix: a scipy.sparse.csr_matrix; other formats fall back to matrix[rows]
+    :param rows: row indexes, any shape
+    :param out: optional buffers (data, indices, indptr) the result is written into, indices
+    and indptr int32; they must be large enough and the result is a view of them.
+    :return: a csr_matrix of shape (rows.size, matrix.shape[1])
+    """
+    rows = np.asarray(rows).ravel()
+    if not sparse.isspmatrix_csr(matrix):
+        return matrix[rows]
+    if out is None:
+        indptr = np.empty((rows.size + 1,), dtype='int32')
+        nnz = _row_ptr(matrix.indptr, rows, indptr)
+        data = np.empty((nnz,), dtype=matrix.dtype)
+        indices = np.empty((nnz,), dtype='int32')
+    else:
+        data, indices, indptr = out
+        if indptr.size < rows.size + 1:
+            raise ValueError('the buffers hold %d rows, %d needed' % (indptr.size - 1, rows.size))
+        indptr = indptr[:rows.size + 1]
+        nnz = _row_ptr(matrix.indptr, rows, indptr)
+        if nnz > data.size or nnz > indices.size:
+            raise ValueError('the buffers hold %d values, %d needed' % (min(data.size, indices.size), nnz))
+        data = data[:nnz]
+        indices = indices[:nnz]
+    _gather(matrix.data, matrix.indices, matrix.indptr, rows, indptr, data, indices)
+    return csr_view(data, indices, indptr, (rows.size, matrix.shape[1]))
+
+
+def unique_rows(rows, nb_fixed=0):
+    """
+    The rows of a batch of labels and negative samples repeat a lot (the noise words follow
+    the unigram distribution), so only the unique ones need to be gathered and decoded; each
+    of rows then refers to its row by position.
+    :param rows: row indexes, any shape
+    :param nb_fixed: the first nb_fixed of rows.ravel() are kept in front as they are, e.g. the
+    rows also read by the input embedding
+    :return: the rows to gather and the position in them of each of rows.ravel(), both int32
+    """
+    rows = np.asarray(rows).ravel()
+    unique, inverse = np.unique(rows[nb_fixed:], return_inverse=True)
+    poses = np.empty((rows.size,), dtype='int32')
+    poses[:nb_fixed] = np.arange(nb_fixed)
+    poses[nb_fixed:] = inverse + nb_fixed
+    return np.concatenate([rows[:nb_fixed], unique]).astype('int32'), poses
@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 __author__ = 'Yunchuan Chen'
 from preprocess import smart_open
+from tokenizer import split_block, token_positions, line_blocks
+import numpy as np
 import sys
 import os
 
@@ -13,41 +15,54 @@ def chunks(l, n):
 
 
 def generate(dist_dir, corpus_file='../data/corpus/wiki-sg-norm-lc.tar.bz2', sent_len=64,
-             max_size=100*2**20, file_size=2**20):
+             max_size=100*2**20, file_size=2**20, file_spec='%03d.bz2'):
+    def char_codes(block):
+        """
+        :return: for each line of the block, the letters of the words not starting
+        with '_' mapped to (c-'a')//2 + 1
+        """
+        buf, starts, ends, token_lines, nb_lines = split_block(block)
+        kept = buf[starts] != ord('_')
+        lens = (ends - starts)[kept]
+        pos = token_positions(starts[kept], lens)
+        chars = buf[pos]
+        letters = (ord('a') <= chars) & (chars <= ord('z'))
+        char_lines = np.repeat(token_lines[kept], lens)[letters]
+        codes = (chars[letters] - ord('a')) // 2 + 1
+        splits = np.cumsum(np.bincount(char_lines, minlength=nb_lines))[:-1]
+        return np.split(codes, splits)
+
     def sentence_generator():
         with smart_open(corpus_file) as f:
-            for sent in f:
-                words_ = sent.split()
-                words = [w for w in words_ if not w.startswith('_')]
-                chars_ = list(''.join(words))
-                chars = [c for c in chars_ if ord('a') <= ord(c) <= ord('z')]
-                chunk_len = sent_len - 1
-                if len(chars) < chunk_len:
-                    continue
-
-                num_chars = [(ord(x)-ord('a'))//2 + 1 for x in chars]
-
-                def prefix_line(prefix_char, line):
-                    tmp = [prefix_char]
-                    for c in line:
-                        tmp.append(str(c))
-                    return ' '.join(tmp) + '\n'
-
-                cnks = list(chunks(num_chars, chunk_len))
-                line = cnks[0]
-                yield prefix_line('0', line)
-                for line in cnks[:-1]:
-                    yield prefix_line('14', line)
-                line = cnks[-1]
-                if len(cnks) == chunk_len:
-                    yield prefix_line('14', line)
+            for block in line_blocks(f, 10000):
+                for codes in char_codes(block):
+                    chunk_len = sent_len - 1
+                    if len(codes) < chunk_len:
+                        continue
+
+                    num_chars = codes.tolist()
+
+                    def prefix_line(prefix_char, line):
+                        tmp = [prefix_char]
+                        for c in line:
+                            tmp.append(str(c))
+                        return ' '.join(tmp) + '\n'
+
+                    cnks = list(chunks(num_chars, chunk_len))
+                    line = cnks[0]
+                    yield prefix_line('0', line)
+                    for line in cnks[:-1]:
+                        yield prefix_line('14', line)
+                    line = cnks[-1]
+                    if len(cnks) == chunk_len:
+                        yield prefix_line('14', line)
 
     def file_name_generator(max_nb_file=100000, spec='%03d.bz2'):
         for idx in xrange(max_nb_file):
             dist_file_ = spec % idx
             yield os.path.join(dist_dir, dist_file_)
 
-    dfn_gen = file_name_generator()
+    dfn_gen = file_name_generator(spec=file_spec)
     dist_file_name = dfn_gen.next()
     dist_file = smart_open(dist_file_name, mode='wb', buffering=2**10)
     sentences = sentence_generator()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _cntx_label_py(sents, vocab_size, X, y_label):
+    """
+    Strided window view of the padded sentences: window t of sentence i is the context of
+    its word t, so the windows are copied into X in one go.
+    """
+    ns, nt = sents.shape
+    context_size = X.shape[1]
+    idxes = np.empty((ns, context_size + nt), dtype=X.dtype)
+    idxes[:, :context_size] = np.arange(vocab_size, vocab_size + context_size)
+    idxes[:, context_size:] = sents
+    s0, s1 = idxes.strides
+    windows = as_strided(idxes, shape=(ns, nt, context_size), strides=(s0, s1, s1))
+    X.reshape((ns, nt, context_size))[...] = windows
+    y_label.reshape((ns, nt))[...] = sents
+
+
+if numba is not None:
+    @numba.jit(nopython=True, nogil=True)
+    def _cntx_label(sents, vocab_size, X, y_label):
+        ns, nt = sents.shape
+        context_size = X.shape[1]
+        k = 0
+        for i in range(ns):
+            for t in range(nt):
+                for j in range(context_size):
+                    # the context of the first words is padded with vocab_size, vocab_size+1, ...
+                    pos = t + j - context_size
+                    if pos < 0:
+                        X[k, j] = vocab_size + t + j
+                    else:
+                        X[k, j] = sents[i, pos]
+                y_label[k] = sents[i, t]
+                k += 1
+else:
+    _cntx_label = _cntx_label_py
+
+
+def cntx_label_into(sents, vocab_size, X, y_label, pool=None, nb_parts=1):
+    """
+    Fill X with the context of each word of sents and y_label with the words, sentence by
+    sentence. The context of the t-th word of a sentence is the context_size words before
+    it, where the words before the sentence are vocab_size, vocab_size+1, ...
+    :param sents: sentences of the same length, (ns, nt)
+    :param X: contexts, (ns*nt, context_size), C contiguous
+    :param y_label: labels, (ns*nt,)
+    :param pool: a multiprocessing.pool.ThreadPool, or None to work in this thread
+    :param nb_parts: number of groups of sentences handed to the threads of pool
+    :return: X, y_label
+    """
+    ns, nt = sents.shape
+    nb_parts = max(1, min(nb_parts, ns))
+    bounds = [ns * i // nb_parts for i in range(nb_parts + 1)]
+
+    def fill(i):
+        start, end = bounds[i], bounds[i+1]
+        _cntx_label(sents[start:end], vocab_size, X[start*nt:end*nt], y_label[start*nt:end*nt])
+
+    if pool is None or nb_parts == 1:
+        for i in range(nb_parts):
+            fill(i)
+    else:
+        pool.map(fill, range(nb_parts))
+    return X, y_label
+
+
+def get_cntx_label(sents, vocab_size, context_size, pool=None, nb_parts=1):
+    """
+    :return: the contexts (ns*nt, context_size) and the labels (ns*nt,) of sents, see cntx_label_into
+    """
+    X = np.empty((sents.size, context_size), dtype='int32')
+    y_label = np.empty((sents.size,), dtype='int32')
+    return cntx_label_into(sents, vocab_size, X, y_label, pool, nb_parts)
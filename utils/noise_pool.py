@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+import os
+import time
+import ctypes
+import Queue
+import numpy as np
+from multiprocessing import Process, Array, Queue as MQueue
+from sampler import AliasSampler
+
+# indexes of the counters in NoisePool.counters
+_NB_SLOTS, _NB_STALLS, _STALL_TIME, _NB_REUSES = range(4)
+
+
+def _fill_slots(table, idxes, probs, free, ready, slot_size, seed):
+    """
+    Producer process: fill the free slots with noise samples and their probabilities
+    until it gets None.
+    """
+    idxes = np.frombuffer(idxes, dtype='int32')
+    probs = np.frombuffer(probs, dtype='float32')
+    sampler = AliasSampler(table)
+    rng = np.random.RandomState(seed)
+    while True:
+        slot = free.get()
+        if slot is None:
+            break
+        start = slot * slot_size
+        slot_idxes = idxes[start:start+slot_size]
+        sampler.sample_into(slot_idxes, rng)
+        np.take(table, slot_idxes, out=probs[start:start+slot_size])
+        ready.put(slot)
+
+
+class NoisePool(object):
+    """
+    A ring of noise samples in shared memory. A background process fills the slots of
+    the ring with draws from the table and their probabilities, the consumers (the
+    training thread or the data workers) take the samples slot by slot, so no random
+    numbers are drawn on their side. A slot goes back to the producer once a consumer
+    has moved to the next one.
+
+    When no fresh slot is ready, a consumer reads the slot it holds once more if it
+    has not done so max_reuse times yet, otherwise it waits. Both cases are counted,
+    see stats.
+    """
+    def __init__(self, table, nb_slots=8, slot_size=2**20, max_reuse=0, seed=None):
+        """
+        :param table: probability of each word, e.g. the unigram table
+        :param nb_slots: number of slots in the ring
+        :param slot_size: number of samples per slot
+        :param max_reuse: how many times a slot may be read again while no fresh slot is ready
+        :param seed: seed of the producer, random if None
+        """
+        if nb_slots < 2:
+            raise ValueError('a noise pool needs at least 2 slots')
+        self.table = np.asarray(table, dtype='float32')
+        self.nb_slots = nb_slots
+        self.slot_size = slot_size
+        self.max_reuse = max_reuse
+        self.seed = seed if seed is not None else abs(int(np.frombuffer(os.urandom(4), dtype='int32')))
+        self._idxes = Array(ctypes.c_int32, nb_slots * slot_size, lock=False)
+        self._probs = Array(ctypes.c_float, nb_slots * slot_size, lock=False)
+        self.idxes = np.frombuffer(self._idxes, dtype='int32')
+        self.probs = np.frombuffer(self._probs, dtype='float32')
+        self.counters = Array(ctypes.c_double, 4)
+        self.free = MQueue()
+        self.ready = MQueue()
+        self.producer = None
+        # state of the consumer in this process
+        self._pid = None
+        self._slot = None
+        self._offset = 0
+        self._reused = 0
+
+    def start(self):
+        for slot in range(self.nb_slots):
+            self.free.put(slot)
+        self.producer = Process(target=_fill_slots, args=(self.table, self._idxes, self._probs, self.free,
+                                                          self.ready, self.slot_size, self.seed))
+        self.producer.daemon = True
+        self.producer.start()
+
+    def stop(self):
+        if self.producer is not None:
+            self.free.put(None)
+            self.producer.join(1.)
+            self.producer = None
+
+    def _count(self, k, v=1):
+        with self.counters.get_lock():
+            self.counters[k] += v
+
+    def _next_slot(self):
+        if self._pid != os.getpid():
+            # a forked consumer does not own the slot of its parent
+            self._pid = os.getpid()
+            self._slot = None
+        if self._slot is not None:
+            try:
+                slot = self.ready.get_nowait()
+            except Queue.Empty:
+                if self._reused < self.max_reuse:
+                    self._reused += 1
+                    self._offset = 0
+                    self._count(_NB_REUSES)
+                    return
+                # give the slot back before waiting, or consumers holding all the slots would wait forever
+                self.free.put(self._slot)
+                self._count(_NB_STALLS)
+                start = time.time()
+                slot = self.ready.get()
+                self._count(_STALL_TIME, time.time() - start)
+            else:
+                self.free.put(self._slot)
+        else:
+            slot = self.ready.get()
+        self._count(_NB_SLOTS)
+        self._slot = slot
+        self._offset = 0
+        self._reused = 0
+
+    def take_into(self, out, probs=None):
+        """
+        Fill out with the next noise samples, and probs with their probabilities.
+        :return: out
+        """
+        if not out.flags.c_contiguous or (probs is not None and not probs.flags.c_contiguous):
+            flat_probs = None if probs is None else np.empty((probs.size,), dtype=probs.dtype)
+            flat = self.take_into(np.empty((out.size,), dtype=out.dtype), flat_probs)
+            out[...] = flat.reshape(out.shape)
+            if probs is not None:
+                probs[...] = flat_probs.reshape(probs.shape)
+            return out
+        flat = out.reshape(-1)
+        flat_probs = None if probs is None else probs.reshape(-1)
+        pos = 0
+        while pos < flat.size:
+            if self._pid != os.getpid() or self._slot is None or self._offset == self.slot_size:
+                self._next_slot()
+            n = min(flat.size - pos, self.slot_size - self._offset)
+            start = self._slot * self.slot_size + self._offset
+            flat[pos:pos+n] = self.idxes[start:start+n]
+            if flat_probs is not None:
+                flat_probs[pos:pos+n] = self.probs[start:start+n]
+            self._offset += n
+            pos += n
+        return out
+
+    def sample_into(self, out, rng=None):
+        """
+        Same interface as AliasSampler.sample_into. rng is ignored.
+        """
+        return self.take_into(out)
+
+    def stats(self):
+        """
+        :return: number of slots taken, number of times a consumer waited, total wait time
+        in seconds and number of slots read again.
+        """
+        with self.counters.get_lock():
+            return tuple(self.counters[:])
+
+    def summary(self):
+        nb_slots, nb_stalls, stall_time, nb_reuses = self.stats()
+        return 'noise pool: %d slots taken, %d stalls (%.1fs), %d reused' % (nb_slots, nb_stalls, stall_time,
+                                                                           nb_reuses)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+# Counter based random numbers (Philox4x32-10, Salmon et al., Parallel random numbers: as easy
+# as 1, 2, 3). The j-th number of the stream (seed, batch, stream) is a function of these four
+# values only, so any thread or process can generate any part of any stream without sharing
+# state with the others.
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
+
+_M0 = 0xD2511F53
+_M1 = 0xCD9E8D57
+_W0 = 0x9E3779B9
+_W1 = 0xBB67AE85
+_MASK = 0xFFFFFFFF
+_ROUNDS = 10
+
+
+def philox4x32(c0, c1, c2, c3, k0, k1):
+    """
+    :param c0, c1, c2, c3: the 4 words of the counters, uint64 arrays holding 32 bit values
+    :param k0, k1: the 2 words of the key, ints
+    :return: the 4 words of the random blocks, uint64 arrays holding 32 bit values
+    """
+    mask = np.uint64(_MASK)
+    shift = np.uint64(32)
+    c0, c1, c2, c3 = [np.asarray(c, dtype=np.uint64) for c in (c0, c1, c2, c3)]
+    for _ in range(_ROUNDS):
+        p0 = np.uint64(_M0) * c0
+        p1 = np.uint64(_M1) * c2
+        c0, c1, c2, c3 = ((p1 >> shift) ^ c1 ^ np.uint64(k0), p1 & mask,
+                          (p0 >> shift) ^ c3 ^ np.uint64(k1), p0 & mask)
+        k0 = (k0 + _W0) & _MASK
+        k1 = (k1 + _W1) & _MASK
+    return c0, c1, c2, c3
+
+
+def _uniform_py(k0, k1, batch, stream, offset, out):
+    n = out.size
+    first = offset // 2
+    blocks = np.arange(first, (offset + n + 1) // 2, dtype=np.uint64)
+    r0, r1, r2, r3 = philox4x32(blocks & np.uint64(_MASK), blocks >> np.uint64(32),
+                                np.uint64(batch & _MASK), np.uint64(stream & _MASK), k0, k1)
+    # two uniforms per block, each made of 53 bits of two words
+    u = np.empty((2 * blocks.size,), dtype=np.float64)
+    u[0::2] = (r0 >> np.uint64(5)) * 67108864.0 + (r1 >> np.uint64(6))
+    u[1::2] = (r2 >> np.uint64(5)) * 67108864.0 + (r3 >> np.uint64(6))
+    u *= 1.0 / 9007199254740992.0
+    start = offset - 2 * first
+    out[...] = u[start:start+n]
+
+
+if numba is not None:
+    @numba.jit(nopython=True, nogil=True)
+    def _fill_blocks(k0, k1, batch, stream, first, out):
+        # the two uniforms of each of the blocks first, first+1, ... into out, as in _uniform_py
+        mask = np.uint64(_MASK)
+        shift = np.uint64(32)
+        m0 = np.uint64(_M0)
+        m1 = np.uint64(_M1)
+        for i in range(out.size // 2):
+            block = np.uint64(first + i)
+            c0 = block & mask
+            c1 = block >> shift
+            c2 = np.uint64(batch) & mask
+            c3 = np.uint64(stream) & mask
+            key0 = np.uint64(k0)
+            key1 = np.uint64(k1)
+            for _ in range(_ROUNDS):
+                p0 = m0 * c0
+                p1 = m1 * c2
+                c0, c1, c2, c3 = (p1 >> shift) ^ c1 ^ key0, p1 & mask, (p0 >> shift) ^ c3 ^ key1, p0 & mask
+                key0 = (key0 + np.uint64(_W0)) & mask
+                key1 = (key1 + np.uint64(_W1)) & mask
+            out[2*i] = ((c0 >> np.uint64(5)) * 67108864.0 + (c1 >> np.uint64(6))) / 9007199254740992.0
+            out[2*i+1] = ((c2 >> np.uint64(5)) * 67108864.0 + (c3 >> np.uint64(6))) / 9007199254740992.0
+
+    @numba.jit(nopython=True, nogil=True)
+    def _uniform(k0, k1, batch, stream, offset, out):
+        n = out.size
+        if n == 0:
+            return
+        edge = np.empty(2)
+        # an odd offset starts with the second uniform of its block
+        j = offset % 2
+        if j == 1:
+            _fill_blocks(k0, k1, batch, stream, offset // 2, edge)
+            out[0] = edge[1]
+        first = (offset + j) // 2
+        nb_blocks = (n - j) // 2
+        _fill_blocks(k0, k1, batch, stream, first, out[j:j + 2*nb_blocks])
+        if (n - j) % 2 == 1:
+            _fill_blocks(k0, k1, batch, stream, first + nb_blocks, edge)
+            out[n-1] = edge[0]
+else:
+    _uniform = _uniform_py
+
+
+class CounterRNG(object):
+    """
+    The stream of uniform numbers keyed by (seed, batch, stream), read from offset on. It
+    has the random_sample method of numpy.random.RandomState, so it can be given to
+    AliasSampler.sample_into.
+    """
+    def __init__(self, seed, batch, stream=0, offset=0):
+        """
+        :param seed: seed of the run, a 64 bit int
+        :param batch: id of the batch, 32 bits are used
+        :param stream: id of the stream within the batch, e.g. one for the negative samples, 32 bits are used
+        :param offset: position of the first number to return in the stream
+        """
+        self.k0 = int(seed) & _MASK
+        self.k1 = (int(seed) >> 32) & _MASK
+        self.batch = int(batch)
+        self.stream = int(stream)
+        self.offset = int(offset)
+
+    def random_sample(self, size=None):
+        out = np.empty((1 if size is None else int(np.prod(size)),), dtype=np.float64)
+        _uniform(self.k0, self.k1, self.batch, self.stream, self.offset, out)
+        self.offset += out.size
+        return out[0] if size is None else out.reshape(size)
+
+
+def parallel_sample_into(sampler, out, seed, batch, stream=0, pool=None, nb_parts=1):
+    """
+    Fill out with draws of sampler using the stream (seed, batch, stream), split in nb_parts
+    parts drawn by the threads of pool. Part i reads the stream from the position of its
+    first element, so the result does not depend on nb_parts or on the number of threads.
+    :param sampler: an AliasSampler
+    :param out: a contiguous integer array
+    :param pool: a multiprocessing.pool.ThreadPool, or None to draw in this thread
+    :return: out
+    """
+    flat = out.reshape(-1)
+    nb_parts = max(1, min(nb_parts, flat.size))
+    bounds = [flat.size * i // nb_parts for i in range(nb_parts + 1)]
+
+    def fill(i):
+        start, end = bounds[i], bounds[i+1]
+        sampler.sample_into(flat[start:end], CounterRNG(seed, batch, stream, start))
+
+    if pool is None or nb_parts == 1:
+        for i in range(nb_parts):
+            fill(i)
+    else:
+        pool.map(fill, range(nb_parts))
+    return out
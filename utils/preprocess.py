@@ -9,6 +9,11 @@ import numpy as np
 import cPickle as pickle
 import logging
 import re
+from compress import smart_open
+from corpus import is_indexed_corpus, indexed_grouped_sentences
+from wordcount import count_words
+from wordmap import load_wordmap
+from tokenizer import BlockTokenizer, line_blocks, group_by_length
 
 __author__ = 'Yunchuan Chen'
 logging.basicConfig(level=logging.INFO)
@@ -39,37 +44,22 @@ class ReadFileTest(unittest.TestCase):
         self.failUnless('idx2wc' in wpi, 'idx2wc key lost for the wordmap.')
 
 
-def smart_open(fname, mode='rb', buffering=5*2**20):
-    _, ext = os.path.splitext(fname)
-    if ext == '.bz2':
-        from bz2 import BZ2File
-        return BZ2File(fname, mode, buffering)
-    # if ext == '.gz':
-    #     from gzip import GzipFile
-    #     return GzipFile(fname, mode, buffering)
-    return open(fname, mode, buffering)
-
-
 def export_wordmap(dist_file='../data/wiki-wordmap.wp',
-                   corpus_file='../data/corpus/wiki-sg-norm-lc.txt', rebuild=False):
+                   corpus_file='../data/corpus/wiki-sg-norm-lc.txt', rebuild=False,
+                   nb_workers=None, top_k=None, max_tracked=None):
     """
     :param dist_file: file name to store the wordmap
     :param corpus_file: corpus source to build wordmap against
     :param rebuild: whether rebuild wordmap if it already exists.
+    :param nb_workers: number of processes counting the corpus in parallel.
+    :param top_k: if not None, only keep the top_k most frequent words.
+    :param max_tracked: memory budget of each counting process in number of distinct words,
+    only used with top_k. See count_words.
     :return: exported model and a flag.
     """
     if os.path.exists(dist_file) and not rebuild:
         return None, True
-    word2cnt = dict()
-    with smart_open(corpus_file, buffering=5*2**20) as f:
-        for sent in f:
-            words = sent.split()
-            for w in words:
-                try:
-                    word2cnt[w] += 1
-                except KeyError:
-                    word2cnt[w] = 1
-    kv = sorted(word2cnt.items(), key=lambda x: x[1], reverse=True)
+    kv = count_words(corpus_file, nb_workers=nb_workers, top_k=top_k, max_tracked=max_tracked)
     idx2word = [w for w, _ in kv]
     idx2wc = [c for _, c in kv]
     word2idx = dict((w, idx) for idx, (w, _) in enumerate(kv))
@@ -81,12 +71,11 @@ def export_wordmap(dist_file='../data/wiki-wordmap.wp',
 
 def import_wordmap(fname='../data/wiki-wordmap.wp'):
     """
-    :param fname: a string indicate where the wordmap stores.
+    :param fname: a string indicate where the wordmap stores. Both pickled and binary
+    wordmaps (see lm.utils.wordmap) are accepted.
     :return: wordmap
     """
-    with file(fname, 'rb') as f:
-        wp = pickle.load(f)
-    return wp
+    return load_wordmap(fname)
 
 
 def preprocess_corpus(corpus_file='../data/corpus/wiki-sg-norm-lc.txt',
@@ -134,28 +123,7 @@ def binarize_corpus(group_size=20000, corpus_file='../data/corpus/wiki-sg-norm-l
     :param wordmap: wordmap.
     :return: None
     """
-    def _index_sentence(sent):
-        """
-        :param sent: a sentence as a string
-        :type sent: str
-        :return: a list of word index
-        Represents a sentence using word indexes.
-        """
-        words = sent.split()
-        return [word2idx[w] for w in words]
-
-    def _commit_result():
-        for idx_sent in result[3:]:
-            if len(idx_sent) > 0:
-                sents = np.array(idx_sent, dtype=np.int32)
-                shape = np.array(sents.shape, dtype=np.int32)
-                dist_file.write(shape.tobytes())
-                dist_file.write(sents.tobytes())
-
-        for j in range(len(result)):
-            result[j] = []
-
-    dist_file = smart_open(dist_file, 'wb')
+    dist_file = smart_open(dist_file, 'wb', multistream=True)
     assert dist_file is not None
     if isinstance(wordmap, str):
         wp = import_wordmap(fname=wordmap)
@@ -164,23 +132,30 @@ def binarize_corpus(group_size=20000, corpus_file='../data/corpus/wiki-sg-norm-l
     else:
         logging.error('can not recognize wordmap type')
         raise TypeError('wordamp must be dict or str')
-    word2idx = wp['word2idx']
-    result = [[] for _ in range(max_len + 1)]
+    tokenizer = BlockTokenizer(wp)
     with smart_open(corpus_file) as f:
-        for i, sent in enumerate(f, start=1):
-            idxs = _index_sentence(sent)
-            try:
-                result[len(idxs)].append(idxs)
-                if i % group_size == 0:
-                    _commit_result()
-            except IndexError:
-                continue
-        _commit_result()
+        for block in line_blocks(f, group_size):
+            idxes, lens = tokenizer.tokenize(block)
+            for sent_len, sents in group_by_length(idxes, lens):
+                if 3 <= sent_len <= max_len:
+                    dist_file.write(np.array(sents.shape, dtype=np.int32).tobytes())
+                    dist_file.write(sents.tobytes())
 
     dist_file.close()
 
 
 def grouped_sentences(binary_corpus='../data/corpus/wiki-sg-norm-lc-drop-bin.bz2'):
+    """
+    :param binary_corpus: either a grouped stream produced by binarize_corpus or the token
+    file of an indexed corpus (see lm.utils.corpus)
+    :return: generator of int32 matrices, each holds a group of sentences with the same length
+    """
+    if is_indexed_corpus(binary_corpus):
+        return indexed_grouped_sentences(binary_corpus)
+    return _stream_grouped_sentences(binary_corpus)
+
+
+def _stream_grouped_sentences(binary_corpus):
     with smart_open(binary_corpus) as f:
         while True:
             shape_data = f.read(2*4)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _build_alias_py(q, prob, alias):
+    """
+    Vose's alias method. q holds the probabilities scaled by their number, so that
+    they sum up to len(q), and is modified in place.
+    """
+    small = [int(i) for i in np.flatnonzero(q < 1.0)]
+    large = [int(i) for i in np.flatnonzero(q >= 1.0)]
+    while small and large:
+        s = small.pop()
+        l = large.pop()
+        prob[s] = q[s]
+        alias[s] = l
+        q[l] += q[s] - 1.0
+        if q[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    # what is left is 1 up to rounding errors
+    for i in small + large:
+        prob[i] = 1.0
+        alias[i] = i
+
+
+def _draw_py(u, prob, alias, out):
+    n = prob.size
+    u *= n
+    idx = u.astype(np.intp)
+    np.minimum(idx, n - 1, out=idx)
+    u -= idx
+    out[...] = np.where(u < prob[idx], idx, alias[idx])
+
+
+if numba is not None:
+    @numba.jit(nopython=True, nogil=True)
+    def _build_alias(q, prob, alias):
+        n = q.size
+        small = np.empty((n,), dtype=np.int64)
+        large = np.empty((n,), dtype=np.int64)
+        nb_small = 0
+        nb_large = 0
+        for i in range(n):
+            if q[i] < 1.0:
+                small[nb_small] = i
+                nb_small += 1
+            else:
+                large[nb_large] = i
+                nb_large += 1
+        while nb_small > 0 and nb_large > 0:
+            nb_small -= 1
+            s = small[nb_small]
+            nb_large -= 1
+            l = large[nb_large]
+            prob[s] = q[s]
+            alias[s] = l
+            q[l] += q[s] - 1.0
+            if q[l] < 1.0:
+                small[nb_small] = l
+                nb_small += 1
+            else:
+                large[nb_large] = l
+                nb_large += 1
+        for k in range(nb_small):
+            prob[small[k]] = 1.0
+            alias[small[k]] = small[k]
+        for k in range(nb_large):
+            prob[large[k]] = 1.0
+            alias[large[k]] = large[k]
+
+    @numba.jit(nopython=True, nogil=True)
+    def _draw(u, prob, alias, out):
+        n = prob.size
+        for k in range(u.size):
+            x = u[k] * n
+            i = min(int(x), n - 1)
+            if x - i < prob[i]:
+                out[k] = i
+            else:
+                out[k] = alias[i]
+else:
+    _build_alias = _build_alias_py
+    _draw = _draw_py
+
+
+class AliasSampler(object):
+    """
+    Draws indexes from a discrete distribution with the alias method: a draw costs one
+    uniform random number and two table lookups, whatever the size of the distribution.
+    It replaces scipy.stats.rv_discrete, whose inverse CDF search gets slow for large
+    vocabularies.
+    """
+    def __init__(self, table):
+        """
+        :param table: probability (or weight) of each index, e.g. the unigram table
+        """
+        q = np.array(table, dtype=np.float64).ravel()
+        if q.size == 0 or (q < 0).any() or q.sum() <= 0:
+            raise ValueError('invalid probability table')
+        q *= q.size / q.sum()
+        self.prob = np.empty((q.size,), dtype=np.float64)
+        self.alias = np.empty((q.size,), dtype=np.int32)
+        _build_alias(q, self.prob, self.alias)
+
+    def __len__(self):
+        return self.prob.size
+
+    def sample_into(self, out, rng=None):
+        """
+        Fill out with independent draws.
+        :param out: an integer array, e.g. a preallocated int32 buffer
+        :param rng: a numpy RandomState; the global numpy random state by default
+        :return: out
+        """
+        rng = np.random if rng is None else rng
+        u = rng.random_sample(out.size)
+        if out.flags.c_contiguous:
+            _draw(u, self.prob, self.alias, out.reshape(-1))
+        else:
+            flat = np.empty((out.size,), dtype=out.dtype)
+            _draw(u, self.prob, self.alias, flat)
+            out[...] = flat.reshape(out.shape)
+        return out
+
+    def sample(self, shape, dtype='int32', rng=None):
+        """
+        :return: a new array of the given shape filled with draws
+        """
+        return self.sample_into(np.empty(shape, dtype=dtype), rng)
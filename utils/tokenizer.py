@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# bytes str.split() treats as white spaces
+_SPACE = np.zeros((256,), dtype=np.bool_)
+_SPACE[[9, 10, 11, 12, 13, 32]] = True
+_NEWLINE = ord('\n')
+
+# base of the polynomial hash over the bytes of a word, modulo 2**64
+_BASE = 0x9e3779b97f4a7c15
+_MOD = 2**64
+
+
+def _inverse(a):
+    # inverse of an odd number modulo 2**64 by Newton iteration
+    x = a
+    for _ in range(6):
+        x = x * (2 - a * x) % _MOD
+    return x
+
+_BASE_INV = _inverse(_BASE)
+_powers = np.ones((1,), dtype=np.uint64)
+_inv_powers = np.ones((1,), dtype=np.uint64)
+
+
+def _get_powers(n):
+    global _powers, _inv_powers
+    if _powers.size < n:
+        size = max(n, 2 * _powers.size)
+        _powers = np.empty((size,), dtype=np.uint64)
+        _inv_powers = np.empty((size,), dtype=np.uint64)
+        _powers[0] = _inv_powers[0] = 1
+        _powers[1:] = _BASE
+        _inv_powers[1:] = _BASE_INV
+        # cumprod wraps around on overflow, which gives the powers modulo 2**64
+        np.cumprod(_powers, out=_powers)
+        np.cumprod(_inv_powers, out=_inv_powers)
+    return _powers[:n], _inv_powers[:n]
+
+
+def hash_tokens(buf, starts, ends):
+    """
+    :param buf: uint8 array
+    :param starts: start positions of the tokens in buf
+    :param ends: end positions (exclusive) of the tokens in buf
+    :return: uint64 array of the polynomial hash sum((buf[i]+1) * BASE**(i-start)) of each
+    token, which does not depend on where the token is in buf.
+    """
+    powers, inv_powers = _get_powers(buf.size + 1)
+    prefix = np.empty((buf.size + 1,), dtype=np.uint64)
+    prefix[0] = 0
+    terms = prefix[1:]
+    np.add(buf, np.uint64(1), out=terms)
+    np.multiply(terms, powers[:buf.size], out=terms)
+    np.cumsum(terms, out=terms)
+    return (prefix[ends] - prefix[starts]) * inv_powers[starts]
+
+
+def split_block(lines):
+    """
+    :param lines: a list of lines, or a string holding a block of lines
+    :return: buf, starts, ends, token_lines, nb_lines.
+    buf is the block as a uint8 array, starts and ends are the positions of the tokens
+    (split as str.split does) in buf and token_lines is the index of the line each
+    token belongs to.
+    """
+    data = lines if isinstance(lines, str) else ''.join(lines)
+    buf = np.frombuffer(data, dtype=np.uint8)
+    if buf.size == 0:
+        empty = np.zeros((0,), dtype=np.int64)
+        return buf, empty, empty, empty, 0
+    word = np.zeros((buf.size + 2,), dtype=np.int8)
+    np.logical_not(_SPACE[buf], out=word[1:-1].view(np.bool_))
+    edges = np.diff(word)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    newlines = np.flatnonzero(buf == _NEWLINE)
+    token_lines = np.searchsorted(newlines, starts)
+    nb_lines = newlines.size + (buf[-1] != _NEWLINE)
+    return buf, starts, ends, token_lines, nb_lines
+
+
+def token_positions(starts, lens):
+    """
+    :return: positions of all the bytes of the tokens given by starts and lens
+    """
+    offsets = np.cumsum(lens) - lens
+    return np.repeat(starts - offsets, lens) + np.arange(lens.sum())
+
+
+def line_blocks(f, block_size):
+    """
+    :param f: an iterable of lines, e.g. a file
+    :param block_size: number of lines per block
+    :return: generator of lists of block_size lines, the last one may be shorter.
+    """
+    block = []
+    for line in f:
+        block.append(line)
+        if len(block) == block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def group_by_length(idxes, lens):
+    """
+    :param idxes: word indexes of a block of sentences as a flat array
+    :param lens: length of each sentence
+    :return: generator of (sent_len, sents) in increasing sent_len, where sents is a
+    (nb_sents, sent_len) matrix of the sentences of that length in their original order.
+    """
+    starts = np.cumsum(lens) - lens
+    for l in np.unique(lens):
+        sel = starts[lens == l]
+        yield int(l), idxes[sel[:, np.newaxis] + np.arange(l)]
+
+
+def _probe(keys, values, key_lens, shift, hashes, lens):
+    """
+    Vectorized lookup in the linear probing table, -1 for the missing ones.
+    """
+    mask = keys.size - 1
+    pos = (hashes >> shift).astype(np.intp)
+    res = values[pos]
+    pending = np.flatnonzero((res >= 0) & ((keys[pos] != hashes) | (key_lens[pos] != lens)))
+    while pending.size:
+        p = (pos[pending] + 1) & mask
+        pos[pending] = p
+        r = values[p]
+        res[pending] = r
+        pending = pending[(r >= 0) & ((keys[p] != hashes[pending]) | (key_lens[p] != lens[pending]))]
+    return res
+
+
+if numba is not None:
+    @numba.jit(nopython=True, nogil=True)
+    def _tokenize_block(buf, space, keys, values, key_lens, shift, unk, has_unk, idxes, lens):
+        """
+        Split buf into words and lines, hash and look up the words in one pass.
+        :return: number of words, number of lines and the position of the first word not
+        found if has_unk is False, otherwise -1.
+        """
+        mask = keys.size - 1
+        base = np.uint64(_BASE)
+        one = np.uint64(1)
+        nb_words = 0
+        nb_lines = 0
+        cnt = 0
+        start = -1
+        h = np.uint64(0)
+        pw = one
+        n = buf.size
+        for i in range(n + 1):
+            if i < n and not space[buf[i]]:
+                if start < 0:
+                    start = i
+                    h = np.uint64(0)
+                    pw = one
+                h += (np.uint64(buf[i]) + one) * pw
+                pw *= base
+                continue
+            if start >= 0:
+                slot = np.intp(h >> shift)
+                while True:
+                    v = values[slot]
+                    if v < 0 or (keys[slot] == h and key_lens[slot] == i - start):
+                        break
+                    slot = (slot + 1) & mask
+                if v < 0:
+                    if not has_unk:
+                        return nb_words, nb_lines, start
+                    v = unk
+                idxes[nb_words] = v
+                nb_words += 1
+                cnt += 1
+                start = -1
+            if i < n and buf[i] == _NEWLINE:
+                lens[nb_lines] = cnt
+                nb_lines += 1
+                cnt = 0
+        if n > 0 and buf[n - 1] != _NEWLINE:
+            lens[nb_lines] = cnt
+            nb_lines += 1
+        return nb_words, nb_lines, -1
+else:
+    _tokenize_block = None
+
+
+class BlockTokenizer(object):
+    """
+    Converts blocks of lines into word indexes at once. Words are looked up by a 64 bit
+    hash in a linear probing table built from the wordmap, and the word lengths are
+    checked too, so a wrong match needs two words of the same length to collide.
+    With numba, a block is split, hashed and looked up in a single pass; without it
+    the same is done with vectorized numpy operations.
+    """
+    def __init__(self, wordmap, unk=None):
+        """
+        :param wordmap: a wordmap, either a dict or a WordMap (see lm.utils.wordmap)
+        :param unk: index of the words not in the wordmap. None means to raise KeyError.
+        """
+        if 'idx2word' in wordmap:
+            idx2word = wordmap['idx2word']
+        else:
+            idx2word = sorted(wordmap['word2idx'], key=wordmap['word2idx'].get)
+        store = getattr(idx2word, 'store', None)
+        if store is not None:
+            offsets = store.offsets
+            blob = np.frombuffer(store.buf, dtype=np.uint8, count=int(offsets[-1]), offset=store.blob_start)
+        else:
+            offsets = np.zeros((len(idx2word) + 1,), dtype=np.int64)
+            offsets[1:] = np.cumsum([len(w) for w in idx2word])
+            blob = np.frombuffer(''.join(idx2word), dtype=np.uint8)
+        hashes = hash_tokens(blob, offsets[:-1], offsets[1:])
+        if np.unique(hashes).size != hashes.size:
+            raise ValueError('hash collision in the wordmap')
+        self._build_table(hashes, np.diff(offsets).astype(np.int32))
+        self.unk = unk
+
+    def _build_table(self, hashes, word_lens):
+        bits = 1
+        while (1 << bits) < 4 * max(hashes.size, 1):
+            bits += 1
+        size = 1 << bits
+        self.shift = np.uint64(64 - bits)
+        self.keys = np.zeros((size,), dtype=np.uint64)
+        self.values = -np.ones((size,), dtype=np.int32)
+        self.key_lens = np.zeros((size,), dtype=np.int32)
+        pos = (hashes >> self.shift).astype(np.intp)
+        pending = np.arange(hashes.size)
+        while pending.size:
+            p = pos[pending]
+            free = self.values[p] < 0
+            # words competing for the same free slot: the first one wins, the others move on
+            slots, first = np.unique(p[free], return_index=True)
+            winners = pending[free][first]
+            self.keys[slots] = hashes[winners]
+            self.values[slots] = winners
+            self.key_lens[slots] = word_lens[winners]
+            placed = np.zeros((hashes.size,), dtype=np.bool_)
+            placed[winners] = True
+            pending = pending[~placed[pending]]
+            pos[pending] = (pos[pending] + 1) & (size - 1)
+
+    def lookup(self, buf, starts, ends):
+        """
+        :return: int32 array, index of each token of buf
+        """
+        if starts.size == 0:
+            return np.zeros((0,), dtype=np.int32)
+        idxes = _probe(self.keys, self.values, self.key_lens, self.shift,
+                       hash_tokens(buf, starts, ends), (ends - starts).astype(np.int32))
+        missing = idxes < 0
+        if missing.any():
+            if self.unk is None:
+                i = np.flatnonzero(missing)[0]
+                raise KeyError(buf[starts[i]:ends[i]].tobytes())
+            idxes[missing] = self.unk
+        return idxes
+
+    def tokenize(self, lines):
+        """
+        :param lines: a list of lines, or a string holding a block of lines
+        :return: word indexes of all the lines as a flat int32 array, and the number of
+        words of each line
+        Same as converting every line by [word2idx[w] for w in line.split()].
+        """
+        if _tokenize_block is None:
+            buf, starts, ends, token_lines, nb_lines = split_block(lines)
+            if nb_lines == 0:
+                return np.zeros((0,), dtype=np.int32), np.zeros((0,), dtype=np.int32)
+            lens = np.bincount(token_lines, minlength=nb_lines).astype(np.int32)
+            return self.lookup(buf, starts, ends), lens
+
+        data = lines if isinstance(lines, str) else ''.join(lines)
+        buf = np.frombuffer(data, dtype=np.uint8)
+        idxes = np.empty((buf.size // 2 + 1,), dtype=np.int32)
+        lens = np.empty((buf.size + 1,), dtype=np.int32)
+        has_unk = self.unk is not None
+        nb_words, nb_lines, missing = _tokenize_block(buf, _SPACE, self.keys, self.values, self.key_lens,
+                                                      self.shift, self.unk if has_unk else 0, has_unk,
+                                                      idxes, lens)
+        if missing >= 0:
+            end = missing
+            while end < buf.size and not _SPACE[buf[end]]:
+                end += 1
+            raise KeyError(data[missing:end])
+        return idxes[:nb_words].copy(), lens[:nb_lines].copy()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+import os
+import sys
+import logging
+import optparse
+from time import time
+from compress import smart_open, fast_codec
+
+logger = logging.getLogger('lm.utils.transcode')
+
+
+def transcode(src_file, dist_file=None, chunk_size=16*2**20, nb_workers=None, level=None):
+    """
+    :param src_file: compressed source file, e.g. wiki-sg-norm-lc-drop-bin.bz2
+    :param dist_file: destination. Its extension chooses the codec. None means the name of
+    src_file with the extension replaced by the fastest available codec.
+    :param chunk_size: number of bytes to copy at a time
+    :param nb_workers: number of processes for bz2 (de)compression
+    :param level: compression level of the destination codec
+    :return: destination file name
+    """
+    if dist_file is None:
+        dist_file = os.path.splitext(src_file)[0] + fast_codec()
+    if os.path.abspath(dist_file) == os.path.abspath(src_file):
+        raise ValueError('source and destination are the same file: %s' % src_file)
+    start = time()
+    nb_bytes = 0
+    with smart_open(src_file, 'rb', nb_workers=nb_workers) as src:
+        with smart_open(dist_file, 'wb', nb_workers=nb_workers, multistream=True, level=level) as dist:
+            while True:
+                data = src.read(chunk_size)
+                if not data:
+                    break
+                dist.write(data)
+                nb_bytes += len(data)
+    logger.info('transcoded %d bytes from %s to %s in %.1f seconds' %
+                (nb_bytes, src_file, dist_file, time() - start))
+    return dist_file
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = optparse.OptionParser(usage="%prog [OPTIONS] SRC [DIST]")
+    parser.add_option("-j", "--workers", type="int", dest="workers", default=None,
+                      help="number of processes for bz2 (de)compression")
+    parser.add_option("-l", "--level", type="int", dest="level", default=None,
+                      help="compression level of the destination codec")
+    options, args = parser.parse_args()
+    if not 1 <= len(args) <= 2:
+        parser.print_help()
+        sys.exit(1)
+    transcode(args[0], args[1] if len(args) == 2 else None, nb_workers=options.workers, level=options.level)
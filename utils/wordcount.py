@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+import os
+import heapq
+import logging
+from operator import itemgetter
+from multiprocessing import Pool, cpu_count
+from compress import smart_open, is_compressed
+
+logger = logging.getLogger('lm.utils.wordcount')
+
+
+def shard_ranges(fname, nb_shards):
+    """
+    :param fname: a plain text file
+    :param nb_shards: number of shards wanted
+    :return: list of (start, stop) byte ranges, each one starts at the beginning of a line.
+    Fewer ranges are returned if the file is too small to be split that many times.
+    """
+    size = os.path.getsize(fname)
+    offsets = [0]
+    with file(fname, 'rb') as f:
+        for i in range(1, nb_shards):
+            f.seek(size * i // nb_shards)
+            f.readline()
+            pos = min(f.tell(), size)
+            if pos > offsets[-1]:
+                offsets.append(pos)
+    if offsets[-1] < size:
+        offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+
+def _prune(word2cnt, top_k):
+    """
+    Keep only the top_k most frequent words of word2cnt (in place).
+    """
+    if len(word2cnt) <= top_k:
+        return
+    kept = heapq.nlargest(top_k, word2cnt.iteritems(), key=itemgetter(1))
+    word2cnt.clear()
+    word2cnt.update(kept)
+
+
+def _count_chunks(chunks, top_k=None, max_tracked=None):
+    word2cnt = dict()
+    for data in chunks:
+        for w in data.split():
+            try:
+                word2cnt[w] += 1
+            except KeyError:
+                word2cnt[w] = 1
+        if max_tracked is not None and len(word2cnt) > max_tracked:
+            _prune(word2cnt, top_k)
+    return sorted(word2cnt.iteritems())
+
+
+def _range_chunks(fname, start, stop, chunk_size):
+    with file(fname, 'rb') as f:
+        f.seek(start)
+        remain = stop - start
+        carry = ''
+        while remain > 0:
+            data = f.read(min(chunk_size, remain))
+            if not data:
+                break
+            remain -= len(data)
+            cut = data.rfind('\n') + 1
+            if cut == 0:
+                carry += data
+                continue
+            yield carry + data[:cut]
+            carry = data[cut:]
+        if carry:
+            yield carry
+
+
+def _file_chunks(fname, chunk_size):
+    with smart_open(fname) as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data + f.readline()
+
+
+def _count_shard(args):
+    fname, start, stop, chunk_size, top_k, max_tracked = args
+    if start is None:
+        chunks = _file_chunks(fname, chunk_size)
+    else:
+        chunks = _range_chunks(fname, start, stop, chunk_size)
+    return _count_chunks(chunks, top_k, max_tracked)
+
+
+def merge_counts(runs):
+    """
+    :param runs: list of partial counts, each one is a list of (word, count) sorted by word
+    :return: generator of (word, count) sorted by word, with the counts of the same word summed up.
+    """
+    cur_w, cur_c = None, 0
+    for w, c in heapq.merge(*runs):
+        if w == cur_w:
+            cur_c += c
+            continue
+        if cur_w is not None:
+            yield cur_w, cur_c
+        cur_w, cur_c = w, c
+    if cur_w is not None:
+        yield cur_w, cur_c
+
+
+def count_words(corpus_file, nb_workers=None, top_k=None, max_tracked=None, chunk_size=8*2**20):
+    """
+    :param corpus_file: corpus to count, one sentence per line
+    :param nb_workers: number of worker processes, default to the number of cpus.
+    :param top_k: if not None, only the top_k most frequent words are returned.
+    :param max_tracked: memory budget of each worker in number of distinct words. Once a
+    worker tracks more words than this, all but its top_k most frequent words are dropped.
+    Default to 4*top_k when top_k is given. Counts of words dropped in this way restart from
+    zero if they show up again, so tail counts are lower bounds in this mode.
+    :param chunk_size: number of bytes a worker reads at a time
+    :return: list of (word, count) sorted by count in descending order, words with the
+    same count are sorted alphabetically.
+    A plain text corpus is split into byte ranges counted in parallel and the partial counts
+    are merged with a k-way merge. Compressed corpora can not be seeked, so they are counted
+    in a single shard.
+    """
+    if top_k is not None and max_tracked is None:
+        max_tracked = 4 * top_k
+    if max_tracked is not None and top_k is None:
+        raise ValueError('max_tracked requires top_k')
+    if top_k is not None and max_tracked < top_k:
+        raise ValueError('max_tracked must not be less than top_k')
+    nb_workers = nb_workers or cpu_count()
+
+    if is_compressed(corpus_file):
+        shards = [(None, None)]
+    else:
+        shards = shard_ranges(corpus_file, nb_workers)
+    jobs = [(corpus_file, start, stop, chunk_size, top_k, max_tracked) for start, stop in shards]
+    if len(jobs) > 1:
+        pool = Pool(min(nb_workers, len(jobs)))
+        try:
+            runs = pool.map(_count_shard, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        runs = map(_count_shard, jobs)
+    logger.info('counted %s in %d shard(s)' % (corpus_file, len(runs)))
+
+    merged = merge_counts(runs)
+    if top_k is not None:
+        return sorted(heapq.nlargest(top_k, merged, key=itemgetter(1)),
+                      key=lambda x: (-x[1], x[0]))
+    return sorted(merged, key=itemgetter(1), reverse=True)
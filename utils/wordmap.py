@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Yunchuan Chen'
+import mmap
+import struct
+import logging
+import cPickle as pickle
+from zlib import crc32
+import numpy as np
+
+MAGIC = 'LMWMAP1\n'
+_HEADER = struct.Struct('<8sqqq')
+logger = logging.getLogger('lm.utils.wordmap')
+
+
+def _word_hash(w):
+    return crc32(w) & 0xffffffff
+
+
+def is_binary_wordmap(fname):
+    """
+    :param fname: wordmap file name
+    :return: True if fname is a binary wordmap written by save_wordmap.
+    """
+    with file(fname, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_wordmap(wp, fname):
+    """
+    :param wp: a wordmap, i.e. a dict with keys 'idx2word' and 'idx2wc'.
+    :param fname: file to save the binary wordmap.
+    The file holds a header, the word offsets into the string blob, the word counts,
+    an open addressing hash table mapping words to indexes and the string blob itself,
+    in this order, so that every part can be memory-mapped by load_wordmap.
+    """
+    idx2word = wp['idx2word']
+    nb_words = len(idx2word)
+    offsets = np.zeros((nb_words + 1,), dtype=np.int64)
+    offsets[1:] = np.cumsum([len(w) for w in idx2word])
+    counts = np.asarray(wp['idx2wc'], dtype=np.int64)
+    table_size = 1
+    while table_size < 2 * nb_words:
+        table_size *= 2
+    mask = table_size - 1
+    table = -np.ones((table_size,), dtype=np.int32)
+    for idx, w in enumerate(idx2word):
+        i = _word_hash(w) & mask
+        while table[i] >= 0:
+            i = (i + 1) & mask
+        table[i] = idx
+    blob = ''.join(idx2word)
+
+    with file(fname, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, nb_words, table_size, len(blob)))
+        f.write(offsets.tobytes())
+        f.write(counts.tobytes())
+        f.write(table.tobytes())
+        f.write(blob)
+
+
+class _Idx2Word(object):
+    """
+    Read only sequence of words backed by the string blob.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.nb_words
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.store.word(i) for i in xrange(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('word index out of range')
+        return self.store.word(idx)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.store.word(i)
+
+    def __reduce__(self):
+        return _wordmap_item, (self.store.fname, 'idx2word')
+
+
+class _Word2Idx(object):
+    """
+    Read only mapping from words to indexes backed by the hash table.
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.nb_words
+
+    def __getitem__(self, w):
+        idx = self.store.lookup(w)
+        if idx < 0:
+            raise KeyError(w)
+        return idx
+
+    def get(self, w, default=None):
+        idx = self.store.lookup(w)
+        return default if idx < 0 else idx
+
+    def __contains__(self, w):
+        return self.store.lookup(w) >= 0
+
+    def __iter__(self):
+        return iter(_Idx2Word(self.store))
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        return ((w, idx) for idx, w in enumerate(_Idx2Word(self.store)))
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __reduce__(self):
+        return _wordmap_item, (self.store.fname, 'word2idx')
+
+
+class _WordMapStore(object):
+    def __init__(self, fname):
+        self.fname = fname
+        with file(fname, 'rb') as f:
+            magic, nb_words, table_size, blob_size = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError('%s is not a binary wordmap' % fname)
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.nb_words = nb_words
+        self.mask = table_size - 1
+        pos = _HEADER.size
+        self.offsets = np.frombuffer(self.buf, dtype=np.int64, count=nb_words + 1, offset=pos)
+        pos += self.offsets.nbytes
+        # counts are copy-on-write, as some callers adjust them in place
+        self.counts = np.memmap(fname, dtype=np.int64, mode='c', offset=pos,
+                                shape=(nb_words,)).view(np.ndarray)
+        pos += self.counts.nbytes
+        self.table = np.frombuffer(self.buf, dtype=np.int32, count=table_size, offset=pos)
+        pos += self.table.nbytes
+        self.blob_start = pos
+
+    def word(self, idx):
+        start = self.blob_start
+        return self.buf[start + int(self.offsets[idx]):start + int(self.offsets[idx + 1])]
+
+    def lookup(self, w):
+        """
+        :return: index of word w, or -1 if w is not in the wordmap.
+        """
+        if not isinstance(w, str):
+            return -1
+        mask, table = self.mask, self.table
+        i = _word_hash(w) & mask
+        while True:
+            idx = int(table[i])
+            if idx < 0 or self.word(idx) == w:
+                return idx
+            i = (i + 1) & mask
+
+
+class WordMap(dict):
+    """
+    A wordmap loaded from a binary wordmap file. It is a dict with the usual keys
+    'idx2word', 'idx2wc' and 'word2idx', but the values are views of a memory map
+    instead of python objects, so loading is nearly free and the pages are shared by
+    all the processes using the same file. Pickling a WordMap (e.g. to send it to a
+    worker process) only pickles the file name.
+    """
+    def __init__(self, fname):
+        store = _WordMapStore(fname)
+        super(WordMap, self).__init__(idx2word=_Idx2Word(store), idx2wc=store.counts,
+                                      word2idx=_Word2Idx(store))
+        self.fname = fname
+
+    def __reduce__(self):
+        return WordMap, (self.fname,)
+
+
+def _wordmap_item(fname, key):
+    return WordMap(fname)[key]
+
+
+def load_wordmap(fname):
+    """
+    :param fname: a binary wordmap or a pickled one
+    :return: wordmap
+    """
+    if is_binary_wordmap(fname):
+        return WordMap(fname)
+    with file(fname, 'rb') as f:
+        wp = pickle.load(f)
+    return wp
+
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) != 3:
+        sys.stderr.write('usage: %s PICKLED_WORDMAP BINARY_WORDMAP\n' % sys.argv[0])
+        sys.exit(1)
+    save_wordmap(load_wordmap(sys.argv[1]), sys.argv[2])
+    logger.info('converted %s to %s' % (sys.argv[1], sys.argv[2]))